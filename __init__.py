@@ -11,12 +11,21 @@ bl_info = {	"name": "Toshi TMD format (JPOG)",
 
 
 import bpy
-from bpy.props import StringProperty, BoolProperty
+from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty, IntProperty
 from bpy_extras.io_utils import ImportHelper, ExportHelper
 from bpy_extras.object_utils import AddObjectHelper, object_data_add
 import bpy.utils.previews
+from .utils.profiling import Profiler
 preview_collection = bpy.utils.previews.new()
 
+def report_profile(operator, profiler):
+	"""Print the stage timings of an import or export and show a summary in the UI."""
+	if profiler.enabled:
+		print(profiler.format())
+		if profiler.cprofile:
+			print(profiler.cprofile_stats())
+		operator.report({"INFO"}, profiler.summary())
+
 
 class Toshi_OT_ApplyScaleToObAndAnims(bpy.types.Operator):
 	"""Apply Scale to Objects and Animations."""
@@ -42,10 +51,14 @@ class Toshi_OT_ImportTMD(bpy.types.Operator, ImportHelper):
 	use_anims : BoolProperty(name="Import Anims", description="If checked, all animations will be imported.", default=True)
 	extract_textures : BoolProperty(name="Extract TMLs", description="Unpack textures from TML files.", default=True)
 	set_fps : BoolProperty(name="Adjust FPS", description="Set the scene to 30 frames per second to conform with the TMDs.", default=True)
+	profile : BoolProperty(name="Profile Stages", description="Time each stage of the import and print a report to the console.", default=False)
+	use_cprofile : BoolProperty(name="Profile Python", description="Also record a cProfile of the import for the report. Makes the import slower.", default=False)
 	def execute(self, context):
 		from . import import_tmd
-		keywords = self.as_keywords(ignore=("axis_forward", "axis_up", "filter_glob"))
-		errors = import_tmd.load(self, context, **keywords)
+		keywords = self.as_keywords(ignore=("axis_forward", "axis_up", "filter_glob", "profile", "use_cprofile"))
+		profiler = Profiler(self.profile, self.use_cprofile)
+		errors = import_tmd.load(self, context, profiler=profiler, **keywords)
+		report_profile(self, profiler)
 		for error in errors:
 			self.report({"ERROR"}, error)
 		return {'FINISHED'}
@@ -58,10 +71,21 @@ class Toshi_OT_ExportTMD(bpy.types.Operator, ExportHelper):
 	filter_glob : StringProperty(default="*.tmd", options={'HIDDEN'})
 	export_anims : BoolProperty(name="Export Anims", description="If checked, animations are exported from blender. If not, keyframes are copied from the imported TMD and no TKL is created.", default=False)
 	pad_anims : BoolProperty(name="Pad Anims", description="If checked, only keyframes from blender will be exported and then padded to the original length of the TKL. Good for quick tests. Warning - this can overwrite original TKLs. Use the tkl-merger for proper versions and turn this off. If it is off, the exported TKL file has the same name as your exported model.", default=False)
+	key_tolerance : FloatProperty(name="Key Tolerance", description="Keys closer than this are merged into one TKL entry, which shrinks the TKL shared by a dig site. 0 only merges identical keys.", default=0.0, min=0.0, max=0.1, precision=5)
+	strip_engine : EnumProperty(name="Stripifier", description="Algorithm that converts the triangles into triangle strips.", items=(
+		("greedy", "Greedy", "Fast, strips are about as long as with NvTriStrip"),
+		("nvtristrip", "NvTriStrip", "Tries many strips per step, slow on big meshes"),
+		), default="greedy")
+	strip_workers : IntProperty(name="Stripify Processes", description="Number of processes that stripify the mesh pieces in parallel. 0 uses all cores, 1 stripifies in blender's process.", default=0, min=0, max=64)
+	optimize_cache : BoolProperty(name="Optimize Vertex Cache", description="Order the strips and vertices for the GPU's vertex cache and print the ACMR and ATVR of each mesh. Strips get slightly longer.", default=False)
+	profile : BoolProperty(name="Profile Stages", description="Time each stage of the export and print a report to the console.", default=False)
+	use_cprofile : BoolProperty(name="Profile Python", description="Also record a cProfile of the export for the report. Makes the export slower.", default=False)
 	def execute(self, context):
 		from . import export_tmd
-		keywords = self.as_keywords(ignore=("axis_forward", "axis_up", "filter_glob", "check_existing"))
-		errors = export_tmd.save(self, context, **keywords)
+		keywords = self.as_keywords(ignore=("axis_forward", "axis_up", "filter_glob", "check_existing", "profile", "use_cprofile"))
+		profiler = Profiler(self.profile, self.use_cprofile)
+		errors = export_tmd.save(self, context, profiler=profiler, **keywords)
+		report_profile(self, profiler)
 		for error in errors:
 			self.report({"ERROR"}, error)
 		return {'FINISHED'}
@@ -1,4 +1,6 @@
 import bpy
+from .utils import keymath
+from .common_tmd import get_keys, set_keys
 
 def run(operator, context, change_speed = False):
 	print("Apply scale to objects & anims")
@@ -24,12 +26,10 @@ def run(operator, context, change_speed = False):
 		for group in action.groups:
 			translations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("location")]
 			for fcu in translations:
-				for i in range(0, len(fcu.keyframe_points)):
-					fcu.keyframe_points[i].co[1] *= scale
+				set_keys(fcu, keymath.scale_keys(get_keys(fcu), value_scale = scale))
 		if change_speed:
 			for fcu in action.fcurves:
-				for i in range(0, len(fcu.keyframe_points)):
-					fcu.keyframe_points[i].co[0] *= scale
+				set_keys(fcu, keymath.scale_keys(get_keys(fcu), time_scale = scale))
 	#redraw
 	bpy.context.scene.frame_set(bpy.context.scene.frame_current)
 	bpy.context.scene.update()
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""Batch driver for whole JPOG-like folder trees.
+
+Validate all TMDs with plain Python, no Blender required:
+	python batch_tmd.py validate <root> [--jobs 8] [--report report.json]
+
+Import or re-export all TMDs with Blender, one background instance per worker:
+	blender --background --factory-startup --python batch_tmd.py -- reexport <root> --out <dir> [--jobs 8] [--export-anims] [--pad-anims]
+	python batch_tmd.py import <root> --out <dir> --blender <path to blender> [--jobs 8]
+
+'import' saves a .blend per TMD, 'reexport' imports each TMD and exports it
+again, along with its TKL if anims are exported. Outputs mirror the folder
+structure below root."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_NAME = "jpog_blender"
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+def find_tmds(root):
+	"""All TMD files below root, sorted."""
+	tmds = []
+	for dirpath, dirnames, filenames in os.walk(root):
+		for filename in filenames:
+			if filename.lower().endswith(".tmd"):
+				tmds.append(os.path.join(dirpath, filename))
+	return sorted(tmds)
+
+def chunks(items, n):
+	"""Split items into n interleaved chunks, so big and small files mix."""
+	return [items[i::n] for i in range(n) if items[i::n]]
+
+def validate(tmd_path):
+	"""Parse a TMD, its TKL and check all cross references. Returns a result dict."""
+	if ADDON_DIR not in sys.path:
+		sys.path.insert(0, ADDON_DIR)
+	import tmd_format
+	result = {"file": tmd_path, "task": "validate", "errors": []}
+	errors = result["errors"]
+	start = time.perf_counter()
+	try:
+		with tmd_format.read_tmd(tmd_path) as tmd:
+			if tmd.magic[:4] != b"TMDL":
+				errors.append("Unexpected magic "+repr(tmd.magic))
+			result["nodes"] = tmd.num_nodes
+			for node in tmd.nodes:
+				if not -1 <= node.parent_id < tmd.num_nodes:
+					errors.append("Node "+node.name+" has an invalid parent")
+			num_tris = 0
+			for level, lod in enumerate(tmd.lods):
+				for mesh_i, mesh in enumerate(lod.meshes):
+					num_verts = sum(piece.num_verts for piece in mesh.pieces)
+					strips_ok = True
+					for piece in mesh.pieces:
+						strip = piece.strip
+						if len(strip) and (max(strip) >= num_verts or min(strip) < 0):
+							errors.append("LOD%d mesh %d: strip index out of range" % (level, mesh_i))
+							strips_ok = False
+						if len(piece.node_indices) and max(piece.node_indices) >= tmd.num_nodes:
+							errors.append("LOD%d mesh %d: bone index out of range" % (level, mesh_i))
+						num_tris += max(0, len(strip) - 2)
+					if strips_ok:
+						try:
+							mesh.skin()
+						except ValueError as err:
+							errors.append("LOD%d mesh %d: %s" % (level, mesh_i, err))
+			result["lods"] = len(tmd.lods)
+			result["strip_tris"] = num_tris
+			result["anims"] = tmd.num_anims
+			tkl_path = tmd_format.tkl_path_for(tmd_path, tmd)
+			if tmd.num_anims:
+				if not os.path.isfile(tkl_path):
+					errors.append(tkl_path+" is missing")
+				else:
+					#only the key counts are needed, don't map the whole table
+					tkl = tmd_format.read_tkl_header(tkl_path)
+					num_keys = 0
+					for anim in tmd.anims:
+						for channel in anim.channels:
+							if channel.mode == 2:
+								continue
+							keys = channel.keys()
+							if not len(keys):
+								continue
+							num_keys += len(keys)
+							#mode 0 uses the fallback trans, mode 3 the fallback quat
+							if (channel.mode != 0 and keys["loc"].max() >= tkl.num_loc) or (channel.mode != 3 and keys["rot"].max() >= tkl.num_rot):
+								errors.append("Anim "+anim.name+": key index out of range of "+os.path.basename(tkl_path))
+								break
+					result["keys"] = num_keys
+		matlibs = os.path.join(os.path.dirname(os.path.dirname(tmd_path)), "matlibs")
+		if not os.path.isdir(matlibs):
+			errors.append(matlibs+" is missing")
+	except Exception as err:
+		errors.append("Parsing failed: "+repr(err))
+	result["seconds"] = time.perf_counter() - start
+	result["ok"] = not errors
+	return result
+
+def load_addon():
+	"""Import the addon package from this folder so its modules can be used without the UI."""
+	if ADDON_NAME in sys.modules:
+		return sys.modules[ADDON_NAME]
+	import importlib.util
+	spec = importlib.util.spec_from_file_location(ADDON_NAME, os.path.join(ADDON_DIR, "__init__.py"), submodule_search_locations=[ADDON_DIR])
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[ADDON_NAME] = module
+	spec.loader.exec_module(module)
+	return module
+
+def out_path(tmd_path, root, out_dir, ext):
+	path = os.path.join(out_dir, os.path.relpath(tmd_path, root))
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	return os.path.splitext(path)[0] + ext
+
+def run_in_blender(task, tmd_path, args):
+	"""Import a TMD into an empty scene, then save it as .blend or export it again."""
+	load_addon()
+	from jpog_blender import import_tmd, export_tmd, common_tmd
+	from jpog_blender.utils.profiling import Profiler
+	result = {"file": tmd_path, "task": task, "errors": []}
+	start = time.perf_counter()
+	bpy.ops.wm.read_factory_settings(use_empty=True)
+	import_profiler = Profiler(args.profile)
+	export_profiler = Profiler(args.profile)
+	#load and save return the shared error list, start each file with an empty one
+	del common_tmd.errors[:]
+	try:
+		result["errors"].extend(import_tmd.load(None, bpy.context, filepath=tmd_path, use_anims=args.export_anims or task == "import", extract_textures=args.extract_textures, set_fps=True, profiler=import_profiler))
+		del common_tmd.errors[:]
+		if task == "import":
+			bpy.ops.wm.save_as_mainfile(filepath=out_path(tmd_path, args.root, args.out, ".blend"))
+		else:
+			#the files are already spread over the workers, so stripify in this process
+			result["errors"].extend(export_tmd.save(None, bpy.context, filepath=out_path(tmd_path, args.root, args.out, ".tmd"), export_anims=args.export_anims, pad_anims=args.pad_anims, key_tolerance=args.key_tolerance, strip_engine=args.strip_engine, strip_workers=1, optimize_cache=args.optimize_cache, profiler=export_profiler))
+			del common_tmd.errors[:]
+	except Exception as err:
+		#keep what was logged before it failed
+		result["errors"].extend(common_tmd.errors)
+		result["errors"].append(repr(err))
+	finally:
+		del common_tmd.errors[:]
+	if args.profile:
+		result["profile"] = {"import": import_profiler.report()}
+		if task == "reexport":
+			result["profile"]["export"] = export_profiler.report()
+	result["seconds"] = time.perf_counter() - start
+	result["ok"] = not result["errors"]
+	return result
+
+def blender_worker_args(task, files, args, results_path):
+	"""Command line for one background Blender worker processing files."""
+	cmd = [args.blender, "--background", "--factory-startup", "--python", os.path.abspath(__file__), "--",
+		   task, args.root, "--out", args.out, "--results", results_path, "--key-tolerance", str(args.key_tolerance), "--strip-engine", args.strip_engine]
+	for flag in ("export_anims", "pad_anims", "extract_textures", "optimize_cache", "profile"):
+		if getattr(args, flag):
+			cmd.append("--"+flag.replace("_", "-"))
+	return cmd + ["--files"] + files
+
+def run_blender_workers(task, tmds, args):
+	"""Fan the files out over several Blender instances and collect their results."""
+	def run_chunk(files):
+		fd, results_path = tempfile.mkstemp(suffix=".json")
+		os.close(fd)
+		try:
+			subprocess.run(blender_worker_args(task, files, args, results_path), stdout=subprocess.DEVNULL if args.quiet else None)
+			with open(results_path) as f:
+				return json.load(f)
+		except (OSError, ValueError) as err:
+			return [{"file": tmd_path, "task": task, "ok": False, "errors": ["Worker failed: "+repr(err)]} for tmd_path in files]
+		finally:
+			os.remove(results_path)
+	results = []
+	with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+		for chunk_results in pool.map(run_chunk, chunks(tmds, args.jobs)):
+			results.extend(chunk_results)
+	return results
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Batch validate, import or re-export JPOG TMD models.")
+	parser.add_argument("task", choices=("validate", "import", "reexport"))
+	parser.add_argument("root", help="Folder to search for TMD files, eg. a JPOG install or backup.")
+	parser.add_argument("--out", help="Output folder for import and reexport.")
+	parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of worker processes.")
+	parser.add_argument("--blender", default=bpy.app.binary_path if bpy else "blender", help="Blender executable for the workers.")
+	parser.add_argument("--export-anims", action="store_true", help="Export animations and TKLs from the imported actions.")
+	parser.add_argument("--pad-anims", action="store_true", help="Keep the original TKL name when exporting anims.")
+	parser.add_argument("--extract-textures", action="store_true", help="Extract textures from TMLs while importing.")
+	parser.add_argument("--key-tolerance", type=float, default=0.0, help="Merge TKL keys closer than this.")
+	parser.add_argument("--strip-engine", choices=("greedy", "nvtristrip"), default="greedy", help="Stripifier used for reexport.")
+	parser.add_argument("--optimize-cache", action="store_true", help="Order strips and vertices for the vertex cache on reexport.")
+	parser.add_argument("--report", help="Write all results to this JSON file.")
+	parser.add_argument("--profile", action="store_true", help="Time the stages of every import and export and add them to the report.")
+	parser.add_argument("--quiet", action="store_true", help="Hide the output of Blender workers.")
+	#internal, used by the coordinator to hand work to a Blender worker
+	parser.add_argument("--files", nargs="*", help=argparse.SUPPRESS)
+	parser.add_argument("--results", help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+	if args.task != "validate" and not args.out:
+		parser.error("--out is required for "+args.task)
+	args.jobs = max(1, args.jobs)
+	return args
+
+def main(argv):
+	args = parse_args(argv)
+	tmds = args.files if args.files is not None else find_tmds(args.root)
+	start = time.perf_counter()
+	if args.task == "validate":
+		if bpy or args.jobs == 1:
+			#blender's python can't spawn plain python workers
+			results = [validate(tmd_path) for tmd_path in tmds]
+		else:
+			with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+				results = list(pool.map(validate, tmds, chunksize=4))
+	elif args.files is not None:
+		#we are a worker
+		results = [run_in_blender(args.task, tmd_path, args) for tmd_path in tmds]
+	elif bpy and args.jobs == 1:
+		results = [run_in_blender(args.task, tmd_path, args) for tmd_path in tmds]
+	else:
+		results = run_blender_workers(args.task, tmds, args)
+
+	if args.results:
+		with open(args.results, "w") as f:
+			json.dump(results, f)
+		return 0
+	failed = [r for r in results if not r["ok"]]
+	for r in failed:
+		print("FAILED", r["file"])
+		for error in r["errors"]:
+			print("  ", error)
+	print("%s: %d files, %d failed, %.2f seconds" % (args.task, len(results), len(failed), time.perf_counter() - start))
+	if args.report:
+		with open(args.report, "w") as f:
+			json.dump(results, f, indent=1)
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	code = main(sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else sys.argv[1:])
+	if not bpy:
+		sys.exit(code)
@@ -0,0 +1,102 @@
+"""Compare the stripifier engines on synthetic meshes: strip count and
+length, stitches and runtime.
+
+	python benchmarks/compare_stripifiers.py [--sizes 30 60 100] [--out results.json]
+
+With --reference, it instead checks that the NvTriStrip engine still makes
+exactly the strips stored in benchmarks/nvtristrip_reference.json, which
+were made by the object based trianglemesh before it was moved to arrays.
+The meshes there are manifold; on non-manifold input the strips may differ."""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+for path in (ADDON_DIR, BENCH_DIR):
+	if path not in sys.path:
+		sys.path.insert(0, path)
+
+import synthetic
+from utils.tristrip import ENGINES, stripify, stitch_strips, _check_strips
+
+def meshes(sizes, seed):
+	"""Named triangle lists; the grids are shuffled so the input order does not help."""
+	rng = random.Random(seed)
+	for size in sizes:
+		grid = synthetic.grid_triangles(size, size)
+		rng.shuffle(grid)
+		yield "grid%d" % size, grid
+		yield "irregular%d" % size, synthetic.irregular_triangles(size, size, seed=seed)
+
+REFERENCE = os.path.join(BENCH_DIR, "nvtristrip_reference.json")
+REFERENCE_SIZES = (10, 20, 40)
+
+def reference_strips(sizes, seed):
+	return {name: [[int(v) for v in strip] for strip in stripify(triangles, engine="nvtristrip")] for name, triangles in meshes(sizes, seed)}
+
+def check_reference(path):
+	"""Compare the NvTriStrip strips with the stored ones. Returns the names of the meshes that differ."""
+	with open(path) as f:
+		reference = json.load(f)
+	strips = reference_strips(reference["sizes"], reference["seed"])
+	return [name for name in reference["strips"] if strips.get(name) != reference["strips"][name]]
+
+def measure(triangles, engine, check):
+	start = time.perf_counter()
+	strips = stripify(triangles, engine=engine)
+	seconds = time.perf_counter() - start
+	start = time.perf_counter()
+	stitched = stitch_strips(strips)
+	stitch_seconds = time.perf_counter() - start
+	if check:
+		_check_strips(triangles, [stitched])
+	return {
+		"strips": len(strips),
+		"strip_indices": sum(len(strip) for strip in strips),
+		"stitched_indices": len(stitched),
+		#indices of the degenerate triangles that join the strips
+		"stitches": len(stitched) - sum(len(strip) for strip in strips if len(strip) >= 3),
+		"seconds": seconds,
+		"stitch_seconds": stitch_seconds,
+		}
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Compare the stripifier engines.")
+	parser.add_argument("--sizes", type=int, nargs="*", default=(30, 60, 100), help="Grid sizes in vertices per side.")
+	parser.add_argument("--engines", nargs="*", default=ENGINES, choices=ENGINES)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--check", action="store_true", help="Verify that the strips reproduce the triangles.")
+	parser.add_argument("--out", help="Write the results to this JSON file.")
+	parser.add_argument("--reference", nargs="?", const=REFERENCE, help="Only check the NvTriStrip strips against a reference file.")
+	parser.add_argument("--save-reference", metavar="FILE", help="Only write the NvTriStrip strips of the reference meshes to a file.")
+	args = parser.parse_args(argv)
+	if args.save_reference:
+		with open(args.save_reference, "w") as f:
+			json.dump({"sizes": REFERENCE_SIZES, "seed": args.seed, "strips": reference_strips(REFERENCE_SIZES, args.seed)}, f)
+		return 0
+	if args.reference:
+		differ = check_reference(args.reference)
+		for name in differ:
+			print("%s: strips differ from %s" % (name, args.reference))
+		print("NvTriStrip reference: %s" % ("FAILED" if differ else "ok"))
+		return 1 if differ else 0
+	results = []
+	print("%-14s %-11s %7s %7s %9s %9s %9s %9s %9s" % ("mesh", "engine", "tris", "strips", "indices", "stitched", "stitches", "seconds", "stitch s"))
+	for name, triangles in meshes(args.sizes, args.seed):
+		for engine in args.engines:
+			result = measure(triangles, engine, args.check)
+			result.update(mesh=name, engine=engine, tris=len(triangles))
+			results.append(result)
+			print("%-14s %-11s %7d %7d %9d %9d %9d %9.3f %9.3f" % (name, engine, len(triangles), result["strips"], result["strip_indices"], result["stitched_indices"], result["stitches"], result["seconds"], result["stitch_seconds"]))
+	if args.out:
+		with open(args.out, "w") as f:
+			json.dump(results, f, indent=1)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else sys.argv[1:]))
@@ -0,0 +1,318 @@
+"""Time the stages of the TMD pipeline on synthetic models, without Blender.
+
+	python benchmarks/run_benchmarks.py [--out results.json] [--compare old.json]
+
+Every stage runs --repeat times and the best and mean wall times are
+reported. The results are JSON, tagged with the git commit, so runs of
+different commits can be compared with --compare. Run it with Blender's
+python to also time the per-key mathutils reference for the anim build:
+	blender --background --factory-startup --python benchmarks/run_benchmarks.py -- --out results.json"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from struct import pack
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+for path in (ADDON_DIR, BENCH_DIR):
+	if path not in sys.path:
+		sys.path.insert(0, path)
+
+import numpy as np
+
+import synthetic
+import tmd_format
+from utils import keymath
+from utils.keypool import KeyPool
+from utils.partition import partition
+from utils.tristrip import stripify, triangulate, triangulate_array
+from utils.weld import VertexWelder, weld_array
+
+try:
+	import mathutils
+except ImportError:
+	mathutils = None
+
+def timed(func, repeat):
+	"""Run func repeat times, return the timings and the result of the last run."""
+	times = []
+	result = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		times.append(time.perf_counter() - start)
+	return times, result
+
+def git_commit():
+	try:
+		return subprocess.check_output(("git", "rev-parse", "--short", "HEAD"), cwd=ADDON_DIR, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+#the stages, each takes the state built by the ones before it
+
+def parse(state):
+	tmd = tmd_format.TmdFile(state["tmd_data"])
+	tkl = tmd_format.TklFile(state["tkl_data"])
+	#touch everything that is parsed lazily
+	for anim in tmd.anims:
+		for channel in anim.channels:
+			pass
+	return tmd, tkl
+
+def vertex_decode(state):
+	return [[mesh.vertices() for mesh in lod.meshes] for lod in state["tmd"].lods]
+
+def triangulate_meshes(state):
+	return [[triangulate_array([piece.strip for piece in mesh.pieces]) for mesh in lod.meshes] for lod in state["tmd"].lods]
+
+def rigging(state):
+	num_assignments = 0
+	for lod, lod_verts in zip(state["tmd"].lods, state["verts"]):
+		for mesh, verts in zip(lod.meshes, lod_verts):
+			nodes, weights = mesh.skin(verts)
+			for node, weight, indices in tmd_format.weight_buckets(nodes, weights):
+				#this is the part that goes to vertex_group.add
+				indices.tolist()
+				num_assignments += len(indices)
+	return num_assignments
+
+def anim_channels(state):
+	"""All keyed channels with their looked up (n,4) wxyz quats and (n,3) locs."""
+	tmd = state["tmd"]
+	loc_lut = state["tkl"].locs()
+	rot_lut = state["tkl"].rots()
+	for anim in tmd.anims:
+		for channel, node in zip(anim.channels, tmd.nodes):
+			if channel.mode == 2 or not channel.num_keys:
+				continue
+			keys = channel.keys()
+			quats = rot_lut[keys["rot"]][:, (3, 0, 1, 2)]
+			locs = loc_lut[keys["loc"]]
+			if channel.mode == 0:
+				locs = np.broadcast_to(node.translation, locs.shape)
+			elif channel.mode == 3:
+				quats = np.broadcast_to((node.quat[3], *node.quat[:3]), quats.shape)
+			yield node, keys["time"], quats, locs
+
+def anim_build(state):
+	pre = np.eye(4)
+	pre[:3, 3] = (0.1, 0.2, 0.3)
+	post = np.eye(4)
+	post[:3, :3] = ((0, 0, 1), (1, 0, 0), (0, 1, 0))
+	out = []
+	for node, times, quats, locs in anim_channels(state):
+		locs, quats = keymath.transform_keys(pre, quats, locs, post)
+		out.append((locs, keymath.make_continuous(quats)))
+	return out
+
+def anim_build_mathutils(state):
+	"""The per-key reference, as the importer did it before the keymath kernels."""
+	pre = mathutils.Matrix.Translation((0.1, 0.2, 0.3))
+	post = mathutils.Matrix(((0, 0, 1, 0), (1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 0, 1)))
+	out = []
+	for node, times, quats, locs in anim_channels(state):
+		for q, l in zip(quats.tolist(), locs.tolist()):
+			key = mathutils.Quaternion(q).to_matrix().to_4x4()
+			key.translation = l
+			out.append((pre @ key @ post).decompose())
+	return out
+
+def mesh_triangles(state, limit):
+	"""Per piece triangle lists of the first LOD, at most limit triangles in total."""
+	pieces = []
+	total = 0
+	for mesh in state["tmd"].lods[0].meshes:
+		for piece in mesh.pieces:
+			tris = triangulate([piece.strip])
+			if total + len(tris) > limit:
+				return pieces
+			pieces.append(tris)
+			total += len(tris)
+	return pieces
+
+def stripify_pieces(state, engine="nvtristrip"):
+	return [stripify(tris, stitchstrips=True, engine=engine)[0] for tris in state["stripify_input"]]
+
+def partition_first_fit(state, max_bones=27, max_pieces=10):
+	"""The reference, as the exporter placed triangles before utils.partition."""
+	bones_pieces = [[] for i in range(max_pieces)]
+	tris_pieces = [[] for i in range(max_pieces)]
+	for tri_index, tri_bones in enumerate(state["triangle_bones"]):
+		for i in range(max_pieces):
+			bones_to_add = sum([1 for bone in tri_bones if bone not in bones_pieces[i]])
+			if len(bones_pieces[i]) + bones_to_add > max_bones:
+				continue
+			for bone in tri_bones:
+				if bone not in bones_pieces[i]:
+					bones_pieces[i].append(bone)
+			tris_pieces[i].append(tri_index)
+			break
+	return [(bones, tris) for bones, tris in zip(bones_pieces, tris_pieces) if bones]
+
+def partition_greedy(state, max_bones=27, max_pieces=10):
+	return partition(state["triangle_bones"], max_bones, max_pieces)[0]
+
+def loop_records(state):
+	"""Per loop vertex records of the first LOD, in the key layout the exporter welds on."""
+	records = []
+	for verts, tris in zip(state["verts"][0], state["tris"][0]):
+		records.append(verts[tris.ravel()])
+	return records
+
+def weld_dict(state):
+	out = []
+	for records in state["loop_records"]:
+		welder = VertexWelder()
+		for co, uv, bones in zip(records["co"].tolist(), records["uv"].tolist(), records["bones"].tolist()):
+			welder.add(pack("3f 2f 4B", *co, *uv, *bones))
+		out.append(len(welder))
+	return out
+
+def weld_numpy(state):
+	out = []
+	for records in state["loop_records"]:
+		keys = np.empty(len(records), dtype=[("co", "<f4", 3), ("uv", "<f4", 2), ("bones", "u1", 4)])
+		keys["co"] = records["co"]
+		keys["uv"] = records["uv"]
+		keys["bones"] = records["bones"]
+		out.append(len(weld_array(keys.view(np.uint8).reshape(len(keys), -1))[0]))
+	return out
+
+def key_pooling(state, tolerance):
+	loc_pool = KeyPool("3f", tolerance)
+	rot_pool = KeyPool("4f", tolerance)
+	for locs, quats in state["anim_keys"]:
+		for l, q in zip(locs.tolist(), quats.tolist()):
+			loc_pool.index(l)
+			rot_pool.index((q[1], q[2], q[3], q[0]))
+	return len(loc_pool), len(rot_pool)
+
+def file_write(state):
+	"""Pack the vertices of the first LOD and the stripified pieces as the exporter does and write them out."""
+	parts = []
+	for records in state["loop_records"]:
+		parts.append(np.ascontiguousarray(records, dtype=tmd_format.VERTEX_DTYPE).tobytes())
+	for strip in state["strips"]:
+		parts.append(pack(str(len(strip))+"h", *strip))
+	fd, path = tempfile.mkstemp(suffix=".tmd")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(b"".join(parts))
+		return os.path.getsize(path)
+	finally:
+		os.remove(path)
+
+def run(args):
+	config = {key: getattr(args, key) for key in ("bones", "lods", "meshes", "pieces", "verts", "bones_per_piece", "anims", "keys", "tkl_keys", "stripify_tris", "key_tolerance", "seed")}
+	state = {}
+	start = time.perf_counter()
+	state["tmd_data"] = synthetic.make_tmd(num_bones=args.bones, num_lods=args.lods, meshes_per_lod=args.meshes, pieces_per_mesh=args.pieces,
+		verts_per_piece=args.verts, bones_per_piece=args.bones_per_piece, num_anims=args.anims, keys_per_channel=args.keys,
+		num_loc=args.tkl_keys, num_rot=args.tkl_keys, seed=args.seed)
+	state["tkl_data"] = synthetic.make_tkl(num_loc=args.tkl_keys, num_rot=args.tkl_keys, seed=args.seed)
+	generate_seconds = time.perf_counter() - start
+
+	stages = [
+		("parse", parse, ("tmd", "tkl")),
+		("vertex_decode", vertex_decode, "verts"),
+		("triangulate", triangulate_meshes, "tris"),
+		("rigging", rigging, None),
+		("anim_build", anim_build, "anim_keys"),
+		("anim_build_mathutils", anim_build_mathutils if mathutils else None, None),
+		("stripify", stripify_pieces, "strips"),
+		("stripify_greedy", lambda state: stripify_pieces(state, "greedy"), None),
+		("partition_first_fit", partition_first_fit, None),
+		("partition", partition_greedy, None),
+		("weld_dict", weld_dict, None),
+		("weld_numpy", weld_numpy, None),
+		("key_pooling", lambda state: key_pooling(state, args.key_tolerance), None),
+		("file_write", file_write, None),
+		]
+	results = {}
+	for name, func, output in stages:
+		if func is None:
+			continue
+		if name == "stripify":
+			state["stripify_input"] = mesh_triangles(state, args.stripify_tris)
+		elif name == "partition_first_fit":
+			side = max(2, int((args.stripify_tris / 2) ** 0.5))
+			state["triangle_bones"] = synthetic.skinned_triangle_bones(side, side, args.bones, args.seed)
+		elif name == "weld_dict":
+			state["loop_records"] = loop_records(state)
+		selected = not args.stages or name in args.stages
+		if not selected and not output:
+			continue
+		#stages that were not asked for still run once if later stages need their output
+		times, result = timed(lambda: func(state), args.repeat if selected else 1)
+		if output == ("tmd", "tkl"):
+			state["tmd"], state["tkl"] = result
+		elif output:
+			state[output] = result
+		if not selected:
+			continue
+		results[name] = {"best": min(times), "mean": sum(times) / len(times), "runs": len(times)}
+		if not args.quiet:
+			print("%-22s best %9.4f s  mean %9.4f s" % (name, min(times), sum(times) / len(times)))
+	return {
+		"commit": git_commit(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"mathutils": mathutils is not None,
+		"config": config,
+		"tmd_bytes": len(state["tmd_data"]),
+		"tkl_bytes": len(state["tkl_data"]),
+		"generate_seconds": generate_seconds,
+		"stages": results,
+		}
+
+def compare(old, new):
+	"""Print the speedup of every stage in new over old."""
+	print("%-22s %10s %10s %8s" % ("stage", "old", "new", "speedup"))
+	for name, result in new["stages"].items():
+		if name in old["stages"]:
+			before = old["stages"][name]["best"]
+			print("%-22s %10.4f %10.4f %7.2fx" % (name, before, result["best"], before / result["best"] if result["best"] else float("inf")))
+	if old["config"] != new["config"]:
+		print("Warning: the runs used different configs")
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Benchmark the TMD pipeline on synthetic models.")
+	parser.add_argument("--bones", type=int, default=40)
+	parser.add_argument("--lods", type=int, default=2)
+	parser.add_argument("--meshes", type=int, default=2, help="Meshes per LOD.")
+	parser.add_argument("--pieces", type=int, default=3, help="Pieces per mesh.")
+	parser.add_argument("--verts", type=int, default=2500, help="Vertices per piece in the first LOD.")
+	parser.add_argument("--bones-per-piece", type=int, default=20)
+	parser.add_argument("--anims", type=int, default=20)
+	parser.add_argument("--keys", type=int, default=30, help="Keys per channel.")
+	parser.add_argument("--tkl-keys", type=int, default=4000, help="Number of locs and quats in the TKL.")
+	parser.add_argument("--stripify-tris", type=int, default=10000, help="Limit for the triangles passed to stripify.")
+	parser.add_argument("--key-tolerance", type=float, default=0.0)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--stages", nargs="*", help="Only run these stages.")
+	parser.add_argument("--out", help="Write the results to this JSON file.")
+	parser.add_argument("--compare", help="Compare against the results in this JSON file.")
+	parser.add_argument("--quiet", action="store_true")
+	return parser.parse_args(argv)
+
+def main(argv):
+	args = parse_args(argv)
+	results = run(args)
+	if args.out:
+		with open(args.out, "w") as f:
+			json.dump(results, f, indent=1)
+	if args.compare:
+		with open(args.compare) as f:
+			compare(json.load(f), results)
+	return 0
+
+if __name__ == "__main__":
+	main(sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else sys.argv[1:])
@@ -0,0 +1,150 @@
+"""Generators for synthetic TMD and TKL files with the layout read by
+tmd_format and import_tmd. The models are not meant to look like anything;
+they have realistic sizes and connectivity for timing the pipeline."""
+
+import random
+from struct import pack
+
+def grid_strip(width, height, offset=0):
+	"""A single stitched strip over a grid of width * height vertices."""
+	strip = []
+	for row in range(height - 1):
+		row_strip = []
+		for col in range(width):
+			row_strip.append(offset + row * width + col)
+			row_strip.append(offset + (row + 1) * width + col)
+		if strip:
+			#two degenerate triangles to join the rows, keeping the winding
+			strip.extend((strip[-1], row_strip[0]))
+			if len(strip) & 1:
+				strip.append(row_strip[0])
+		strip.extend(row_strip)
+	return strip
+
+def grid_triangles(width, height, offset=0):
+	"""The triangles of a grid of width * height vertices."""
+	tris = []
+	for row in range(height - 1):
+		for col in range(width - 1):
+			a = offset + row * width + col
+			b = a + 1
+			c = a + width
+			d = c + 1
+			tris.append((a, c, b))
+			tris.append((b, c, d))
+	return tris
+
+def irregular_triangles(width, height, holes=0.08, seed=0):
+	"""The triangles of a grid with randomly flipped diagonals and a fraction of the faces removed."""
+	rng = random.Random(seed)
+	tris = []
+	for row in range(height - 1):
+		for col in range(width - 1):
+			a = row * width + col
+			b = a + 1
+			c = a + width
+			d = c + 1
+			quad = ((a, c, b), (b, c, d)) if rng.random() < 0.5 else ((a, c, d), (a, d, b))
+			tris.extend(tri for tri in quad if rng.random() >= holes)
+	return tris
+
+def skinned_triangle_bones(width, height, num_bones=60, seed=0):
+	"""Bone indices used by each triangle of a grid whose vertices are weighted to up to 4 of the closest
+	of num_bones bones scattered over it, so neighbouring triangles share most of their bones."""
+	rng = random.Random(seed)
+	centers = [(rng.uniform(0, width), rng.uniform(0, height)) for i in range(num_bones)]
+	vert_bones = []
+	for row in range(height):
+		for col in range(width):
+			closest = sorted(range(num_bones), key=lambda i: (centers[i][0] - col) ** 2 + (centers[i][1] - row) ** 2)[:4]
+			vert_bones.append([closest[0]] + [bone for bone in closest[1:] if rng.random() < 0.5])
+	return [sorted(set(vert_bones[a] + vert_bones[b] + vert_bones[c])) for a, b, c in grid_triangles(width, height)]
+
+def make_nodes(num_bones, salt):
+	nodes = []
+	for i in range(num_bones):
+		name = ("Bone%d" % i).encode("utf-8")
+		bind = (1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, i * 0.1, 0, 1)
+		nodes.append(pack("<4f 16f 16f B 15s hH 3f", 0, 0, 0, 1, *bind, *bind, len(name), name, i - 1, 0, 0, 0.1, 0))
+	return b"".join(nodes)
+
+def make_piece(rng, width, height, offset, num_bones, bones_per_piece):
+	"""Header, bone table, vertices and strip of one piece; the strip only references its own vertices."""
+	node_indices = sorted(rng.sample(range(num_bones), min(bones_per_piece, num_bones)))
+	verts = []
+	for row in range(height):
+		for col in range(width):
+			weights = sorted((rng.randint(0, 255) for i in range(4)), reverse=True)
+			weights[1:] = [w if rng.random() < 0.5 else 0 for w in weights[1:]]
+			bones = [3 * rng.randrange(len(node_indices)) for i in range(4)]
+			verts.append(pack("<3f 3f 4B 4B 2f", col, row, rng.random(), 0, 0, 1, *weights, *bones, col / width, row / height))
+	strip = grid_strip(width, height, offset)
+	header = pack("<4I 3f 3f", len(strip), len(verts), len(node_indices), max(strip), 0, 0, 0, width, height, 1)
+	return header + pack("<%dI" % len(node_indices), *node_indices) + b"".join(verts) + pack("<%dh" % len(strip), *strip), len(strip), len(verts)
+
+def make_lods(rng, num_bones, num_lods, meshes_per_lod, pieces_per_mesh, verts_per_piece, bones_per_piece):
+	side = max(2, int(verts_per_piece ** 0.5))
+	lods = [pack("<I f", num_lods, 100)]
+	for level in range(num_lods):
+		#every LOD halves the vertex count
+		lod_side = max(2, int(side / 2 ** (level / 2)))
+		lods.append(pack("<I f 4f", meshes_per_lod, 0, 0, 0, 0, 10))
+		for mesh in range(meshes_per_lod):
+			pieces = []
+			num_strip = num_verts = 0
+			for piece in range(pieces_per_mesh):
+				data, n_strip, n_verts = make_piece(rng, lod_side, lod_side, num_verts, num_bones, bones_per_piece)
+				pieces.append(data)
+				num_strip += n_strip
+				num_verts += n_verts
+			lods.append(pack("<3I 32s", pieces_per_mesh, num_strip, num_verts, b"synthetic"))
+			lods.extend(pieces)
+	return b"".join(lods)
+
+def make_anims(rng, anim_pointer, salt, num_bones, num_anims, keys_per_channel, num_loc, num_rot):
+	offset = anim_pointer + num_anims * 4
+	pointers = []
+	blocks = []
+	for anim in range(num_anims):
+		pointers.append(pack("<I", offset - 60 + salt))
+		offset += 32 + num_bones * 4
+		name = ("anim%d" % anim).encode("utf-8")
+		head = [pack("<B 15s 3I f", len(name), name, 0, 0, num_bones, keys_per_channel / 30)]
+		channels = []
+		for bone in range(num_bones):
+			head.append(pack("<I", offset - 60 + salt))
+			mode = rng.choice((0, 1, 1, 3))
+			keys = [pack("<f 2H", k / 30, rng.randrange(num_loc), rng.randrange(num_rot)) for k in range(keys_per_channel)]
+			channels.append(pack("<2H", mode, keys_per_channel) + b"".join(keys))
+			offset += 4 + 8 * keys_per_channel
+		blocks.append(b"".join(head + channels))
+	return b"".join(pointers + blocks)
+
+def make_tmd(num_bones=40, num_lods=2, meshes_per_lod=2, pieces_per_mesh=3, verts_per_piece=2500, bones_per_piece=20,
+			 num_anims=20, keys_per_channel=30, num_loc=4000, num_rot=4000, tkl_name="synthetic", seed=0):
+	"""Bytes of a synthetic TMD, referencing a TKL with num_loc and num_rot keys."""
+	rng = random.Random(seed)
+	salt = 1234
+	nodes = make_nodes(num_bones, salt)
+	node_data = 124
+	anim_pointer = node_data + len(nodes)
+	anims = make_anims(rng, anim_pointer, salt, num_bones, num_anims, keys_per_channel, num_loc, num_rot)
+	lods = make_lods(rng, num_bones, num_lods, meshes_per_lod, pieces_per_mesh, verts_per_piece, bones_per_piece)
+	lod_offset = anim_pointer - 60 + len(anims)
+	remaining_bytes = 112 + len(nodes) + len(anims) + len(lods)
+	header = pack("<8s I 16s 4I 4I", b"TMDL", remaining_bytes, tkl_name.encode("utf-8"), lod_offset, salt, 0, 0, 0, 0, 0, 0)
+	header += pack("<I 4H 11I", lod_offset, num_bones, 0, num_anims, 0, *[0]*11) + pack("<2I", node_data - 60 + salt, anim_pointer - 60 + salt)
+	return b"".join((header, nodes, anims, lods))
+
+def make_tkl(num_loc=4000, num_rot=4000, name="synthetic", seed=0):
+	"""Bytes of a synthetic TKL with random translations and unit quaternions."""
+	rng = random.Random(seed)
+	locs = [pack("<3f", rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)) for i in range(num_loc)]
+	quats = []
+	for i in range(num_rot):
+		q = [rng.gauss(0, 1) for j in range(4)]
+		norm = sum(x * x for x in q) ** 0.5
+		quats.append(pack("<4f", *(x / norm for x in q)))
+	len_data = 12 * num_loc + 16 * num_rot
+	header = pack("<4s I I 16s 2I 5I", b"TPKL", 0, len_data + 44, name.encode("utf-8"), num_loc, num_rot, 0, 12, 16, 4, len_data)
+	return b"".join([header] + locs + quats)
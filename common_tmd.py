@@ -1,6 +1,7 @@
 from math import radians, atan2
 import mathutils
 import bpy
+import numpy as np
 
 global errors
 errors = []
@@ -30,6 +31,17 @@ def name_to_tmd(s):
 		s = s[:2]+"r_"+s[2:-2]
 	return s
 	
+def get_keys(fcurve):
+	"""The keyframes of an fcurve as (n,2) array of (frame, value)."""
+	co = np.empty(2 * len(fcurve.keyframe_points), dtype=np.float32)
+	fcurve.keyframe_points.foreach_get("co", co)
+	return co.reshape(-1, 2)
+
+def set_keys(fcurve, co):
+	"""Overwrite the (frame, value) of all existing keyframes of an fcurve."""
+	fcurve.keyframe_points.foreach_set("co", np.ascontiguousarray(co, dtype=np.float32).ravel())
+	fcurve.update()
+
 def log_error(error):
 	print(error)
 	global errors
@@ -2,9 +2,18 @@ import os
 import time
 import bpy
 import mathutils
-from struct import pack, unpack_from
-from .utils.tristrip import stripify
-from .common_tmd import errors, log_error, correction_local, correction_global, name_to_blender, name_to_tmd
+import numpy as np
+from struct import pack
+from . import tmd_format
+from .utils import keymath
+from .utils.parallel import stripify_all
+from .utils import vertexcache
+from .utils.weld import weld_array
+from .utils.partition import partition
+from .utils.weights import weight_table
+from .utils.keypool import KeyPool, MAX_KEYS
+from .utils.profiling import Profiler
+from .common_tmd import errors, log_error, correction_local, correction_global, name_to_blender, name_to_tmd, get_keys
 
 def get_armature():
 	src_armatures = [ob for ob in bpy.data.objects if type(ob.data) == bpy.types.Armature]
@@ -17,10 +26,32 @@ def get_armature():
 				return sel_armatures[0]
 		return src_armatures[0]
 		
+def get_mesh_arrays(me):
+	"""Vertex positions, the vertex index, split normal and uv of every loop and the first loop of every polygon of me as arrays."""
+	num_loops = len(me.loops)
+	co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+	me.vertices.foreach_get("co", co)
+	loop_verts = np.empty(num_loops, dtype=np.int32)
+	me.loops.foreach_get("vertex_index", loop_verts)
+	normals = np.empty(num_loops * 3, dtype=np.float32)
+	me.loops.foreach_get("normal", normals)
+	uvs = np.empty(num_loops * 2, dtype=np.float32)
+	me.uv_layers[0].data.foreach_get("uv", uvs)
+	loop_start = np.empty(len(me.polygons), dtype=np.int32)
+	me.polygons.foreach_get("loop_start", loop_start)
+	return co.reshape(-1, 3), loop_verts, normals.reshape(-1, 3), uvs.reshape(-1, 2), loop_start
+	
 def flatten(mat):
 	return [v for row in mat for v in row]
 	
-def save(operator, context, filepath = '', export_anims = False, pad_anims = False):
+def save(operator, context, filepath = '', export_anims = False, pad_anims = False, key_tolerance = 0.0, strip_engine = 'greedy', strip_workers = 0, optimize_cache = False, profiler = None):
+	"""Export a TMD (and TKL) and return the errors. Pass a Profiler to time the stages."""
+	if profiler is None:
+		profiler = Profiler(enabled=False)
+	with profiler:
+		return _save(operator, context, filepath, export_anims, pad_anims, key_tolerance, strip_engine, strip_workers, optimize_cache, profiler)
+
+def _save(operator, context, filepath, export_anims, pad_anims, key_tolerance, strip_engine, strip_workers, optimize_cache, profiler):
 
 	MAX_BONES_PER_PIECE = 27
 	MAX_PIECES = 10
@@ -40,234 +71,219 @@ def save(operator, context, filepath = '', export_anims = False, pad_anims = Fal
 	#1) always get some of the magic numbers from the header
 	print("Reading data from original",tmd_in_path)
 	try:
-		with open(tmd_in_path, 'rb') as f:
-			header = f.read(130)
-			remaining_bytes, tkl_ref, lod_data_offset, salt, u1, u2 = unpack_from("I 16s 4I", header, 8)
-			tkl_ref = tkl_ref.split(b"\x00")[0].decode("utf-8")
-			scene_block_bytes, num_nodes, u3, num_anims, u4 = unpack_from("I 4H", header, 60)
-			aux_node_data, node_data, anim_pointer = unpack_from("3I", header, 60+56)
-			#decrypt the addresses
-			aux_node_data += 60 - salt
-			node_data += 60 - salt
-			anim_pointer += 60 - salt
-			if aux_node_data == 124:
-				anim_pointer = node_data
-				node_data = aux_node_data
-			#2) set the bone names list into the original order
-			#3) copy the anim_bytes block from the imported file	
-			if not export_anims:
-				f.seek(anim_pointer)	
-				anim_bytes = f.read(lod_data_offset + 60 - anim_pointer)
-			
-				f.seek(node_data)
-				node_bytes = f.read(176 * num_nodes)
-				pos = 0
-				#note that these are not necessarily sorted the same way as in blender's armature!
-				bone_names = []
-				for i in range(0, num_nodes):
-					name_len =  unpack_from("B", node_bytes, pos+144)[0]
-					bone_name = name_to_blender(unpack_from(str(name_len)+"s", node_bytes, pos+145)[0])
-					bone_names.append(bone_name)
-					pos+=176
-				#do all bones match up between TMD and blender?
-				if set(bone_names) != set(armature.data.bones.keys()):
-					log_error("Bone mismatch between source TMD and blender armature. If you have imported another model since, re-import the desired source model, delete it and try again. Alternatively, you might want to export custom anims.")
-					return errors
-			else:
-				# create a new sorting from blender bones, updated bones before non-updated bones.
-				b_bones = armature.data.bones.keys()
-				bone_names = [b for b in b_bones if armature.data.bones[b].use_deform] + [b for b in b_bones if not armature.data.bones[b].use_deform]
+		with profiler.span("parse"):
+			tmd = tmd_format.read_tmd(tmd_in_path)
 	except FileNotFoundError:
 		log_error("Original tmd file not found! Make sure the armature's custom property 'tmd_path' points to an existing tmd file!")
 		return errors
+	#copy everything needed, then unmap the original so that it can be overwritten
+	with tmd:
+		tkl_ref = tmd.tkl_ref
+		salt, u1, u2, u3, num_anims, u4 = tmd.salt, tmd.u1, tmd.u2, tmd.u3, tmd.num_anims, tmd.u4
+		#2) set the bone names list into the original order
+		#3) copy the anim_bytes block from the imported file	
+		if not export_anims:
+			anim_bytes = bytes(tmd.anim_bytes)
+			#note that these are not necessarily sorted the same way as in blender's armature!
+			bone_names = [name_to_blender(node.raw_name) for node in tmd.nodes]
+	if not export_anims:
+		#do all bones match up between TMD and blender?
+		if set(bone_names) != set(armature.data.bones.keys()):
+			log_error("Bone mismatch between source TMD and blender armature. If you have imported another model since, re-import the desired source model, delete it and try again. Alternatively, you might want to export custom anims.")
+			return errors
+	else:
+		# create a new sorting from blender bones, updated bones before non-updated bones.
+		b_bones = armature.data.bones.keys()
+		bone_names = [b for b in b_bones if armature.data.bones[b].use_deform] + [b for b in b_bones if not armature.data.bones[b].use_deform]
 		
 	node_data = 124
 	anim_pointer = node_data + 176 * len(armature.data.bones)
-	bones_bytes = []
-	fallback_matrix = {}
-	#export all bones in the correct order
-	for bone_name in bone_names:
-		bone = armature.data.bones[bone_name]
-		#we get the original bind like this:
-		bind = correction_global.inverted() @ correction_local.inverted() @ bone.matrix_local @ correction_local
-		mat_local = bind
-		#only non-skeletal nodes can ignore updates
-		updates = 0 if bone.use_deform else 1
-		parent_id = -1
-		if bone.parent:
-			parent_id = bone_names.index(bone.parent.name)
-			p_bind_restored = correction_global.inverted() @ correction_local.inverted() @ bone.parent.matrix_local @ correction_local
-			mat_local = p_bind_restored.inverted() @ mat_local
-		fallback_matrix[bone_name] = mat_local
-		#mind the order of quat keys when packing!
-		q = mat_local.to_quaternion()
-		l = mat_local.to_translation()
-		#note that on import, the bind is transposed right after reading, so here we do it in the very end 
-		bones_bytes.append( pack('4f 16f 16f B 15s hH 3f', q.x, q.y, q.z, q.w, *flatten(bind.transposed()), *flatten(bind.inverted().transposed()), len(bone.name), name_to_tmd(bone_name).encode("utf-8"), parent_id, updates, *l) )
+	with profiler.span("bones"):
+		bones_bytes = []
+		fallback_matrix = {}
+		#export all bones in the correct order
+		for bone_name in bone_names:
+			bone = armature.data.bones[bone_name]
+			#we get the original bind like this:
+			bind = correction_global.inverted() @ correction_local.inverted() @ bone.matrix_local @ correction_local
+			mat_local = bind
+			#only non-skeletal nodes can ignore updates
+			updates = 0 if bone.use_deform else 1
+			parent_id = -1
+			if bone.parent:
+				parent_id = bone_names.index(bone.parent.name)
+				p_bind_restored = correction_global.inverted() @ correction_local.inverted() @ bone.parent.matrix_local @ correction_local
+				mat_local = p_bind_restored.inverted() @ mat_local
+			fallback_matrix[bone_name] = mat_local
+			#mind the order of quat keys when packing!
+			q = mat_local.to_quaternion()
+			l = mat_local.to_translation()
+			#note that on import, the bind is transposed right after reading, so here we do it in the very end 
+			bones_bytes.append( pack('4f 16f 16f B 15s hH 3f', q.x, q.y, q.z, q.w, *flatten(bind.transposed()), *flatten(bind.inverted().transposed()), len(bone.name), name_to_tmd(bone_name).encode("utf-8"), parent_id, updates, *l) )
 	bones_bytes = b"".join(bones_bytes)
 	
 	if export_anims:
-		animations = [action for action in bpy.data.actions if not action.name.startswith("*")]
-		num_anims = len(animations)
-		anim_bytes = []
-		channels_bytes = []
-		all_quats = []
-		all_locs = []
+		with profiler.span("anims"):
+			animations = [action for action in bpy.data.actions if not action.name.startswith("*")]
+			num_anims = len(animations)
+			anim_bytes = []
+			channels_bytes = []
+			#all keys of all anims go into the TKL's lookup tables
+			loc_pool = KeyPool("3f", key_tolerance)
+			rot_pool = KeyPool("4f", key_tolerance)
 
-		fps = bpy.context.scene.render.fps
-		#note this is not encrypted here
-		offset = anim_pointer + len(animations) * 4
-		for action in animations:
-			print(action.name)
-			#Animation Pointer Block
-			#offsets are encrypted
-			anim_bytes.append(pack('I', offset - 60 + salt))
-			#every bone, and only every bone, is written
-			offset += 32 + len(bone_names) * 4
+			fps = bpy.context.scene.render.fps
+			#the inverses are the same for every key of a bone
+			key_spaces = {bone_name: np.array(fallback_matrix[bone_name] @ correction_local.inverted()) for bone_name in bone_names}
+			#note this is not encrypted here
+			offset = anim_pointer + len(animations) * 4
+			for action in animations:
+				profiler.count("anims")
+				#Animation Pointer Block
+				#offsets are encrypted
+				anim_bytes.append(pack('I', offset - 60 + salt))
+				#every bone, and only every bone, is written
+				offset += 32 + len(bone_names) * 4
 			
-			channel_pointer_bytes = []
-			channel_bytes = []
+				channel_pointer_bytes = []
+				channel_bytes = []
 			
-			#decode the action name
-			action_name = action.name[:-2]
-			ub1 = int(action.name[-2])
-			ub2 = int(action.name[-1])
+				#decode the action name
+				action_name = action.name[:-2]
+				ub1 = int(action.name[-2])
+				ub2 = int(action.name[-1])
 			
-			channel_pointer_bytes.append(pack('B 15s 3I f', len(action_name), action_name.encode("utf-8"), ub1, ub2, len(bone_names), action.frame_range[1]/fps))
+				channel_pointer_bytes.append(pack('B 15s 3I f', len(action_name), action_name.encode("utf-8"), ub1, ub2, len(bone_names), action.frame_range[1]/fps))
 			
-			for bone_name in bone_names:
-				channel_pointer_bytes.append(pack('I', offset - 60 + salt))
-				if bone_name in action.groups:
-					group = action.groups[bone_name]
-					rotations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("quaternion")]
-					translations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("location")]
-				else:
-					rotations = []
-					translations = []
+				for bone_name in bone_names:
+					channel_pointer_bytes.append(pack('I', offset - 60 + salt))
+					if bone_name in action.groups:
+						group = action.groups[bone_name]
+						rotations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("quaternion")]
+						translations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("location")]
+					else:
+						rotations = []
+						translations = []
 					
-				#prepare the fcurves for export -> make sure they are properly sampled, with no keys missing
-				fcurves = rotations+translations
-				times = []
-				same_amount_of_keys = all(len(fcu.keyframe_points) == len(fcurves[0].keyframe_points) for fcu in fcurves)
-				if not same_amount_of_keys:
-					print(bone_name+" has differing keyframe numbers for each fcurve")
-					#get all times
-					for fcu in fcurves:
-						for key in fcu.keyframe_points:
-							key_time = key.co[0]
-							if key_time not in times: times.append(key_time)
-					times.sort()
-					#sample and recreate all fcurves according to the full times
-					for fcu in fcurves:
-						samples = [fcu.evaluate(key_time) for key_time in times]
-						fcu_dp, fcu_i = fcu.data_path, fcu.array_index
-						action.fcurves.remove(fcu)
-						fcu = action.fcurves.new(fcu_dp, index=fcu_i, action_group=bone_name)
-						fcu.keyframe_points.add(count=len(times))
-						fcu.keyframe_points.foreach_set("co", [x for co in zip(times, samples) for x in co])
-						fcu.update()
-					#get the new curves because we deleted the original ones
-					rotations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("quaternion")]
-					translations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("location")]
-				
-				#first, create define how to get the timestamp and key matrix for this bone
-				if (not rotations) and (not translations):
-					channel_mode = 2
-					num_keys = 0
-				elif not translations:
-					channel_mode = 0
-					num_keys = len(rotations[0].keyframe_points)
-					def get_key(rotations, translations, i):
-						key_matrix = mathutils.Quaternion([fcurve.keyframe_points[i].co[1] for fcurve in rotations]).to_matrix().to_4x4()
-						return rotations[0].keyframe_points[i].co[0]/fps, key_matrix
-				elif not rotations:
-					channel_mode = 3
-					num_keys = len(translations[0].keyframe_points)
-					def get_key(rotations, translations, i):
-						key_matrix = mathutils.Matrix()
-						key_matrix.translation = [fcurve.keyframe_points[i].co[1] for fcurve in translations]
-						return translations[0].keyframe_points[i].co[0]/fps, key_matrix
-				else:
-					channel_mode = 1
-					num_keys = len(rotations[0].keyframe_points)
-					def get_key(rotations, translations, i):
-						key_matrix = mathutils.Quaternion([fcurve.keyframe_points[i].co[1] for fcurve in rotations]).to_matrix().to_4x4()
-						key_matrix.translation = [fcurve.keyframe_points[i].co[1] for fcurve in translations]
-						return rotations[0].keyframe_points[i].co[0]/fps, key_matrix
+					#prepare the fcurves for export -> make sure they are properly sampled, with no keys missing
+					fcurves = rotations+translations
+					times = []
+					same_amount_of_keys = all(len(fcu.keyframe_points) == len(fcurves[0].keyframe_points) for fcu in fcurves)
+					if not same_amount_of_keys:
+						print(bone_name+" has differing keyframe numbers for each fcurve")
+						#get all times
+						for fcu in fcurves:
+							for key in fcu.keyframe_points:
+								key_time = key.co[0]
+								if key_time not in times: times.append(key_time)
+						times.sort()
+						#sample and recreate all fcurves according to the full times
+						for fcu in fcurves:
+							samples = [fcu.evaluate(key_time) for key_time in times]
+							fcu_dp, fcu_i = fcu.data_path, fcu.array_index
+							action.fcurves.remove(fcu)
+							fcu = action.fcurves.new(fcu_dp, index=fcu_i, action_group=bone_name)
+							fcu.keyframe_points.add(count=len(times))
+							fcu.keyframe_points.foreach_set("co", [x for co in zip(times, samples) for x in co])
+							fcu.update()
+						#get the new curves because we deleted the original ones
+						rotations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("quaternion")]
+						translations = [fcurve for fcurve in group.channels if fcurve.data_path.endswith("location")]
 				
-				#now, we assume that all curves are the same length and the keys are in columns
-				channel_bytes.append(pack('2H', channel_mode, num_keys ))
-				for i in range(0, num_keys):
-					try:
-						timestamp, key_matrix = get_key(rotations, translations, i)
-					except:
+					#first, get the timestamps and key matrices for this bone
+					#we assume that all curves are the same length and the keys are in columns
+					rot_keys = [get_keys(fcurve) for fcurve in rotations]
+					loc_keys = [get_keys(fcurve) for fcurve in translations]
+					num_keys = len(rot_keys[0]) if rot_keys else len(loc_keys[0]) if loc_keys else 0
+					if (rotations and len(rotations) != 4) or (translations and len(translations) != 3) or any(len(keys) != num_keys for keys in rot_keys+loc_keys):
 						log_error("Bone "+bone_name+" in "+action_name+" has incomplete / faulty keyframes.")
-					
-					#space conversion, simply inverse of import
-					key_matrix = correction_local.inverted() @ key_matrix @ correction_local
-					key_matrix = fallback_matrix[group.name] @ key_matrix
-					
-					q = key_matrix.to_quaternion()
-					l = key_matrix.to_translation()
+						rotations = []
+						translations = []
+					if (not rotations) and (not translations):
+						channel_mode = 2
+						num_keys = 0
+					elif not translations:
+						channel_mode = 0
+					elif not rotations:
+						channel_mode = 3
+					else:
+						channel_mode = 1
 				
-					#even if use_channel says no, things still have to be written!
-					if l not in all_locs: all_locs.append(l)
-					if q not in all_quats: all_quats.append(q)
-					
-					#super primitive indexing, it should be using a KD-Tree for closest neighbour search.
-					l_index = all_locs.index(l)
-					q_index = all_quats.index(q)
-					
-					channel_bytes.append(pack('f2H', timestamp, l_index, q_index ))
-				# size of this channel: channelinfo (4b) + num_keys * key (8b)
-				offset += 4 + num_keys * 8
-			channels_bytes += channel_pointer_bytes + channel_bytes
+					channel_bytes.append(pack('2H', channel_mode, num_keys ))
+					profiler.count("keys", num_keys)
+					if num_keys:
+						timestamps = (rot_keys or loc_keys)[0][:, 0] / fps
+						if rotations:
+							quats = np.stack([keys[:, 1] for keys in rot_keys], axis=1)
+						else:
+							quats = np.broadcast_to((1.0, 0.0, 0.0, 0.0), (num_keys, 4))
+						if translations:
+							locs = np.stack([keys[:, 1] for keys in loc_keys], axis=1)
+						else:
+							locs = np.zeros((num_keys, 3))
+						#space conversion, simply inverse of import
+						key_locs, key_quats = keymath.transform_keys(key_spaces[bone_name], quats, locs, correction_local)
+						for timestamp, l, (w, x, y, z) in zip(timestamps.tolist(), key_locs.tolist(), key_quats.tolist()):
+							#even if use_channel says no, things still have to be written!
+							l_index = loc_pool.index(l)
+							q_index = rot_pool.index((x, y, z, w))
+							if l_index >= MAX_KEYS or q_index >= MAX_KEYS:
+								log_error("Too many unique keys for a TKL, at most "+str(MAX_KEYS)+" are supported. Increase the key tolerance!")
+								return errors
+						
+							channel_bytes.append(pack('f2H', timestamp, l_index, q_index ))
+					# size of this channel: channelinfo (4b) + num_keys * key (8b)
+					offset += 4 + num_keys * 8
+				channels_bytes += channel_pointer_bytes + channel_bytes
 			
-		anim_bytes += channels_bytes
-		anim_bytes = b"".join(anim_bytes)
+			anim_bytes += channels_bytes
+			anim_bytes = b"".join(anim_bytes)
 	
-		print("Final Loc keys:",len(all_locs))
-		print("Final Rot keys:",len(all_quats))	
+			print("Final Loc keys:",len(loc_pool),"merged:",loc_pool.merged)
+			print("Final Rot keys:",len(rot_pool),"merged:",rot_pool.merged)
 		
-		#create an individualized dummy file which has to be merged, otherwise keep the old tkl_ref
-		if not pad_anims: tkl_ref = os.path.basename(filepath)[:-4][:15]
-		#create the TKL file
-		tkl_out_path = os.path.join(out_dir, tkl_ref+".tkl")
-		print("\nWriting",tkl_out_path)
+			#create an individualized dummy file which has to be merged, otherwise keep the old tkl_ref
+			if not pad_anims: tkl_ref = os.path.basename(filepath)[:-4][:15]
+			#create the TKL file
+			tkl_out_path = os.path.join(out_dir, tkl_ref+".tkl")
+			print("\nWriting",tkl_out_path)
 		
-		# NOTE: Not needed anymore
-		#this is used for testing, so we just fill the TKL with dummy data to avoid crashes
-		# if pad_anims:
-		# 	all_locs.extend([all_locs[0] for x in range(num_loc-len(all_locs))])
-		# 	all_quats.extend([all_quats[0] for x in range(num_rot-len(all_quats))])
+			# NOTE: Not needed anymore
+			#this is used for testing, so we just fill the TKL with dummy data to avoid crashes
+			# if pad_anims:
+			# 	all_locs.extend([all_locs[0] for x in range(num_loc-len(all_locs))])
+			# 	all_quats.extend([all_quats[0] for x in range(num_rot-len(all_quats))])
 		
 
-		tkl_locs   = [pack("3f", *l) for l in all_locs]
-		tkl_quats  = [pack("4f", q.x, q.y, q.z, q.w) for q in all_quats]
-		num_locs   = len(tkl_locs)
-		num_quats  = len(tkl_quats)
-		num_scales = 0              # Not used in JPOG
-		loc_size   = 12
-		quat_size  = 16
-		scale_size = 4
+			num_locs   = len(loc_pool)
+			num_quats  = len(rot_pool)
+			num_scales = 0              # Not used in JPOG
+			loc_size   = 12
+			quat_size  = 16
+			scale_size = 4
 
-		tkl_len_data = num_locs * loc_size + num_quats * quat_size
+			tkl_len_data = num_locs * loc_size + num_quats * quat_size
 		
-		# These are not used
-		tkl_offset_start = 0
-		tkl_offset_end   = tkl_len_data + 44
+			# These are not used
+			tkl_offset_start = 0
+			tkl_offset_end   = tkl_len_data + 44
 
-		tkl_name_bytes = tkl_ref.encode("utf-8") + b'\x00'
-		if len(tkl_name_bytes) > 16:
-			tkl_name_bytes[15] = b'\x00'
+			tkl_name_bytes = tkl_ref.encode("utf-8") + b'\x00'
+			if len(tkl_name_bytes) > 16:
+				tkl_name_bytes[15] = b'\x00'
 
-		tkl_header = pack("4s I I 16s 2I 5I", b"TPKL", tkl_offset_start, tkl_offset_end, tkl_name_bytes, len(all_locs), len(all_quats), num_scales, loc_size, quat_size, scale_size, tkl_len_data)
-		try:
-			with open(tkl_out_path, 'wb') as f:
-				f.write(b"".join( (tkl_header, b"".join(tkl_locs), b"".join(tkl_quats) ) ))
-		except PermissionError:
-			log_error("You do not have writing permissions for "+out_dir+". Gain writing permissions there or export to another folder!")
-			return errors
+			tkl_header = pack("4s I I 16s 2I 5I", b"TPKL", tkl_offset_start, tkl_offset_end, tkl_name_bytes, num_locs, num_quats, num_scales, loc_size, quat_size, scale_size, tkl_len_data)
+			#an imported TKL stays mapped for the next import, let go of it
+			tmd_format.release_tkl(tkl_out_path)
+			try:
+				#replace instead of truncating, in case the old file is still mapped somewhere
+				temp_path = tkl_out_path+".tmp"
+				with open(temp_path, 'wb') as f:
+					f.write(b"".join( (tkl_header, loc_pool.to_bytes(), rot_pool.to_bytes()) ))
+				os.replace(temp_path, tkl_out_path)
+			except PermissionError:
+				log_error("You do not have writing permissions for "+out_dir+". Gain writing permissions there or export to another folder!")
+				return errors
 		
 	#find all models
 	lod_bytes = []
@@ -280,178 +296,191 @@ def save(operator, context, filepath = '', export_anims = False, pad_anims = Fal
 		log_error("Could not find any LODs! Follow the naming convention of imported TMDs!")
 		return errors
 	
-	max_lod_distance = 2 * max(max(ob.dimensions) for ob in armature.children)
-	lod_bytes.append(pack('I f', len(lods), max_lod_distance))
+	#index of every bone in the written node list
+	bone_indices = {bone_name: i for i, bone_name in enumerate(bone_names)}
+	#first gather the triangles of all pieces of all meshes, they are stripified together
+	lod_meshes = []
+	strip_jobs = []
 	for lod in lods:
-		#todo: get these from the bounding box or center of gravity; note that x and y should be swizzled
-		s_x = 0.05 * max_lod_distance
-		s_y = -0.02 * max_lod_distance
-		s_z = 0.1 * max_lod_distance
-		d = 0.9 * max_lod_distance
-		lod_bytes.append(pack('I f 4f ',len(lod), 0, s_x, s_y, s_z, d))
+		meshes = []
 		for ob in lod:
-			print("\nProcessing mesh of",ob.name)
+			with profiler.span("mesh extract"):
+				#remove unneeded modifiers
+				for mod in ob.modifiers:
+					if mod.type in ('ARMATURE','TRIANGULATE'):
+						ob.modifiers.remove(mod)
+				ob.modifiers.new('Triangulate', 'TRIANGULATE')
+				# make a copy with all modifiers applied
+				dg = bpy.context.evaluated_depsgraph_get()
+				eval_obj = ob.evaluated_get(dg)
+				me = eval_obj.to_mesh(preserve_all_data_layers=True, depsgraph=dg)
 			
-			#remove unneeded modifiers
-			for mod in ob.modifiers:
-				if mod.type in ('ARMATURE','TRIANGULATE'):
-					ob.modifiers.remove(mod)
-			ob.modifiers.new('Triangulate', 'TRIANGULATE')
-			# make a copy with all modifiers applied
-			dg = bpy.context.evaluated_depsgraph_get()
-			eval_obj = ob.evaluated_get(dg)
-			me = eval_obj.to_mesh(preserve_all_data_layers=True, depsgraph=dg)
+				if not me.polygons:
+					log_error("Mesh "+ob.name+" contains no faces and will be ignored!")
+					continue
 			
-			if not me.polygons:
-				log_error("Mesh "+ob.name+" contains no faces and will be ignored!")
-				continue
+				me.calc_normals_split()
+				#and restore the armature modifier
+				ob.modifiers.new('SkinDeform', 'ARMATURE').object = armature
+				co, loop_verts, normals, uvs, loop_start = get_mesh_arrays(me)
+				#the loops of every triangle
+				tri_loops = loop_start[:, None] + np.arange(3, dtype = np.int32)
+			
+			with profiler.span("weights"):
+				#read all vertex group memberships once; only groups of written bones are used
+				group_bones = {vertex_group.index: bone_indices[vertex_group.name] for vertex_group in ob.vertex_groups if vertex_group.name in bone_indices}
+				group_vertices = []
+				group_bone_indices = []
+				group_weights = []
+				for vertex in me.vertices:
+					for vertex_group in vertex.groups:
+						bone = group_bones.get(vertex_group.group)
+						if bone is not None:
+							group_vertices.append(vertex.index)
+							group_bone_indices.append(bone)
+							group_weights.append(vertex_group.weight)
+				table_bones, table_weights = weight_table(group_vertices, group_bone_indices, group_weights, len(co))
+				#the bones of each vertex without padding
+				vertex_bones = [tuple(bone for bone in bones if bone >= 0) for bones in table_bones.tolist()]
 			
-			me.calc_normals_split()
-			#and restore the armature modifier
-			ob.modifiers.new('SkinDeform', 'ARMATURE').object = armature
+			with profiler.span("partition"):
+				#first step:
+				#go over all triangles and see which bones their verts use
+				triangle_bones = [{*vertex_bones[a], *vertex_bones[b], *vertex_bones[c]} for a, b, c in loop_verts[tri_loops].tolist()]
+				#then see which tri goes into which piece
+				bones_tris_pieces, unplaced = partition(triangle_bones, MAX_BONES_PER_PIECE, MAX_PIECES)
+				if unplaced:
+					log_error(str(len(unplaced))+" triangles of "+ob.name+" fit into no piece and are missing from the export! A triangle can use at most "+str(MAX_BONES_PER_PIECE)+" bones and a mesh at most "+str(MAX_PIECES*MAX_BONES_PER_PIECE)+" bones in total.")
+				if not bones_tris_pieces:
+					continue
 			
-			#initialize the piece lists
-			bones_pieces = [ [] for i in range(0, MAX_PIECES) ]
-			tris_pieces = [ [] for i in range(0, MAX_PIECES) ]
+			with profiler.span("pack"):
+				#all loops of all pieces, piece after piece
+				piece_loops = [tri_loops[piece_tris].ravel() for piece_bones, piece_tris in bones_tris_pieces]
+				loops = np.concatenate(piece_loops)
+				verts = loop_verts[loops]
+				if np.any(table_bones[verts, 0] < 0):
+					log_error("Weight painting error, at least one vertex is not weighted!")
+					return errors
+				#the bone ids of each loop in its piece's bone list, empty bones are 0
+				loop_bones = np.empty((len(loops), 4), dtype = np.uint8)
+				start = 0
+				for (piece_bones, piece_tris), piece_loop in zip(bones_tris_pieces, piece_loops):
+					piece_bone_ids = np.zeros(len(bone_names) + 1, dtype = np.uint8)
+					piece_bone_ids[piece_bones] = np.arange(len(piece_bones)) * 3
+					#-1 pads pick the last entry, which stays 0
+					loop_bones[start : start + len(piece_loop)] = piece_bone_ids[table_bones[verts[start : start + len(piece_loop)]]]
+					start += len(piece_loop)
+				#flip V
+				loop_uvs = uvs[loops] * np.array((1, -1), dtype = np.float32)
 				
-			print("Splitting into pieces of <= 28 bones")
-			#first step:
-			#go over all triangles, see which bones their verts use, see which tri goes into which piece
-			for polygon in me.polygons:
-				tri_bones = set()
-				for loop_index in polygon.loop_indices:
-					vertex = me.vertices[me.loops[loop_index].vertex_index]
-					#we can only look up the name here, and index it per piece
-					for vertex_group in vertex.groups:
-						bone_name = ob.vertex_groups[vertex_group.group].name
-						bone_weight = vertex_group.weight
-						#should this vertex group be used?
-						if bone_weight > 0 and bone_name in bone_names:
-							#add it to the set
-							tri_bones.add(bone_name)
-					
-				#go over all pieces and see where we can add this tri
-				for i in range(0, MAX_PIECES):
-					#see how many bones this triangle would add to the piece
-					bones_to_add = sum([1 for bone_name in tri_bones if bone_name not in bones_pieces[i]])
-					
-					#so can we add it to this piece? if not go to the next loop/piece
-					if len(bones_pieces[i]) + bones_to_add > MAX_BONES_PER_PIECE:
-						continue
-						
-					#ok we can add it, so add it to the bones
-					#add only unique - don't use a set here because it must be sorted. then we can do the bone lookup in the same step
-					#all second order pieces will use the same bone list!
-					for bone_name in tri_bones:
-						if bone_name not in bones_pieces[i]:
-							bones_pieces[i].append(bone_name)
-					
-					#also add the tri
-					tris_pieces[i].append(polygon.loop_indices)
-					
-					#ok, done, skip the other pieces because the tri is already added
-					break
+				#weld loops with the same position, uv and bone indices into one vertex
+				#so all verts that are used in piece 0 will exist for piece 1 (incase we want to reuse them)
+				keys = np.empty(len(loops), dtype = [("co", "<f4", 3), ("uv", "<f4", 2), ("bones", "u1", 4)])
+				keys["co"] = co[verts]
+				keys["uv"] = loop_uvs
+				keys["bones"] = loop_bones
+				first, indices = weld_array(keys.view(np.uint8).reshape(len(keys), -1))
+				#the final verts, we could probably spread them out by pieces, but it doesn't seem to be required
+				mesh_vertices = np.empty(len(first), dtype = tmd_format.VERTEX_DTYPE)
+				mesh_vertices["co"] = keys["co"][first]
+				mesh_vertices["normal"] = normals[loops[first]]
+				mesh_vertices["weights"] = table_weights[verts[first]]
+				mesh_vertices["bones"] = loop_bones[first]
+				mesh_vertices["uv"] = loop_uvs[first]
 			
-			uv_layer = me.uv_layers[0].data
-			piece_data = []
-			mesh_vertices = []
-			dummy_vertices = []
-			#do the second splitting
-			for temp_piece_i in range(0, MAX_PIECES):
-				if bones_pieces[temp_piece_i]:
-					print("Processing temp piece", temp_piece_i)
-					
-					#at this point we have the tris in the right pieces, so all verts that are used in piece 0 will exist for piece 1 (incase we want to reuse them)
-					tmd_piece_tris = []
-					for tri in tris_pieces[temp_piece_i]:
-						tmd_tri=[]
-						for loop_index in tri:
-							vertex = me.vertices[me.loops[loop_index].vertex_index]
-							co = vertex.co
-							no = me.loops[loop_index].normal
-							w = []
-							#we can only look up the name here, and index it per piece
-							for vertex_group in vertex.groups:
-								bone_name = ob.vertex_groups[vertex_group.group].name
-								bone_weight = vertex_group.weight
-								#should this vertex group be used?
-								if bone_weight > 0 and bone_name in bone_names:
-									w.append((int(bones_pieces[temp_piece_i].index(bone_name) * 3), bone_weight))
-
-							if not w:
-								log_error("Weight painting error, at least one vertex is not weighted!")
-								return errors
-								
-							#only use the 4 biggest keys
-							w_s = sorted(w, key = lambda x:x[1], reverse = True)[0:4]
-							
-							#for normalization
-							w_sum = sum([weight for id, weight in w_s])
-							
-							#pad the weight list to 4 bones, ie. add empty bones if missing
-							for i in range(0, 4-len(w_s)): w_s.append((0,0))
-							
-							#index the bone names, and build the list of bones used in this piece's strip
-							b = [id for id, weight in w_s]
-							w = [int(weight / w_sum * 255) for id, weight in w_s]
-							
-							dummy = pack('3f 2f 4B', co.x, co.y, co.z, uv_layer[loop_index].uv.x, -uv_layer[loop_index].uv.y, *b)
-							#we could probably spread them out by pieces, but it doesn't seem to be required
-							if dummy not in dummy_vertices:
-								dummy_vertices.append(dummy)
-								#save the final vert
-								mesh_vertices.append( pack('3f 3f 4B 4B 2f', co.x, co.y, co.z, no.x, no.y, no.z, *w, *b, uv_layer[loop_index].uv.x, -uv_layer[loop_index].uv.y ) )
-							
-							# get the corrected index for this tri
-							tmd_tri.append(dummy_vertices.index(dummy))
-						tmd_piece_tris.append(tmd_tri)
-					#there is just one input strip created from the triangles
-					in_strip = stripify(tmd_piece_tris, stitchstrips = True)[0]
-					
-					#then we must split
-					for n in range(0, len(in_strip), PIECE_LEN):
-						piece_data.append((in_strip[n : PIECE_LEN+n+2], bones_pieces[temp_piece_i]))
-						
-			num_pieces = len(piece_data)
-			num_all_strip_indices = sum([len(strip) for strip, piece_bone_names in piece_data])
-			num_all_verts = len(mesh_vertices)
+			#index of the strip job and bone names of each temporary piece
+			temp_pieces = []
+			start = 0
+			for (piece_bones, piece_tris), piece_loop in zip(bones_tris_pieces, piece_loops):
+				temp_pieces.append((len(strip_jobs), [bone_names[bone] for bone in piece_bones]))
+				strip_jobs.append(indices[start : start + len(piece_loop)].reshape(-1, 3).tolist())
+				start += len(piece_loop)
 			
-			print("\nWriting mesh",ob.name)
+			profiler.count("verts", len(mesh_vertices))
+			profiler.count("tris", len(loop_start))
 			try:
 				material_name = me.materials[0].name
 			except:
 				material_name = "none"
 				log_error(ob.name+" has no material, set to 'none'!")
+			meshes.append((ob, material_name, mesh_vertices, temp_pieces))
+		lod_meshes.append(meshes)
+	
+	#the pieces are independent, so they can be stripified in parallel
+	#each is stitched into just one input strip
+	with profiler.span("stripify"):
+		stripified = stripify_all(strip_jobs, engine = strip_engine, workers = strip_workers, optimize_cache = optimize_cache)
+	
+	max_lod_distance = 2 * max(max(ob.dimensions) for ob in armature.children)
+	lod_bytes.append(pack('I f', len(lods), max_lod_distance))
+	for meshes in lod_meshes:
+		#todo: get these from the bounding box or center of gravity; note that x and y should be swizzled
+		s_x = 0.05 * max_lod_distance
+		s_y = -0.02 * max_lod_distance
+		s_z = 0.1 * max_lod_distance
+		d = 0.9 * max_lod_distance
+		#meshes without faces were skipped, so only count the written ones
+		lod_bytes.append(pack('I f 4f ',len(meshes), 0, s_x, s_y, s_z, d))
+		for ob, material_name, mesh_vertices, temp_pieces in meshes:
+			piece_strips = []
+			#cache misses, tris and verts before and after ordering the strips for the vertex cache
+			cache_stats = np.zeros((2, 3), dtype = np.int64)
+			for job_i, piece_bone_names in temp_pieces:
+				in_strip, num_stitches, piece_cache_stats = stripified[job_i]
+				profiler.count("stitches", num_stitches)
+				piece_strips.append((in_strip, piece_bone_names))
+				if piece_cache_stats:
+					cache_stats += piece_cache_stats
+			if optimize_cache and piece_strips:
+				with profiler.span("vertex cache"):
+					#renumber the vertices in the order the strips use them
+					order, remap = vertexcache.first_use_order([in_strip for in_strip, piece_bone_names in piece_strips], len(mesh_vertices))
+					mesh_vertices = mesh_vertices[order]
+					piece_strips = [(remap[np.asarray(in_strip, dtype = np.int64)].tolist(), piece_bone_names) for in_strip, piece_bone_names in piece_strips]
+				print(ob.name, "vertex cache", vertexcache.format_stats(*cache_stats[0]), "->", vertexcache.format_stats(*cache_stats[1]))
+				profiler.count("cache misses", int(cache_stats[1, 0]))
+			piece_data = []
+			for in_strip, piece_bone_names in piece_strips:
+				#then we must split
+				for n in range(0, len(in_strip), PIECE_LEN):
+					piece_data.append((in_strip[n : PIECE_LEN+n+2], piece_bone_names))
+						
+			num_pieces = len(piece_data)
+			num_all_strip_indices = sum([len(strip) for strip, piece_bone_names in piece_data])
+			num_all_verts = len(mesh_vertices)
+			
+			profiler.count("pieces", num_pieces)
 			lod_bytes.append(pack("3I 32s ", num_pieces, num_all_strip_indices, num_all_verts, material_name.encode("utf-8")))
-			for piece_i in range(0, len(piece_data)):
-				print("Writing piece",piece_i)
-				strip, piece_bone_names = piece_data[piece_i]
+			with profiler.span("write"):
+				for piece_i in range(0, len(piece_data)):
+					strip, piece_bone_names = piece_data[piece_i]
 
-				#note that these are for the whole object and not the piece - might have to be adjusted
-				bbc_x, bbc_y, bbc_z = 0.125 * sum((mathutils.Vector(b) for b in ob.bound_box), mathutils.Vector())
-				bbe_x, bbe_y, bbe_z = ob.dimensions
+					#note that these are for the whole object and not the piece - might have to be adjusted
+					bbc_x, bbc_y, bbc_z = 0.125 * sum((mathutils.Vector(b) for b in ob.bound_box), mathutils.Vector())
+					bbe_x, bbe_y, bbe_z = ob.dimensions
 			
-				#just dump all verts into the last piece
-				piece_verts = []
-				#if piece_i == len(piece_data)-1:
-				if piece_i == 0:
-					piece_verts = mesh_vertices
+					#just dump all verts into the last piece
+					piece_verts = mesh_vertices[:0]
+					#if piece_i == len(piece_data)-1:
+					if piece_i == 0:
+						piece_verts = mesh_vertices
 				
-				#write the mesh_piece header
-				lod_bytes.append(pack("4I 3f 3f", len(strip), len(piece_verts), len(piece_bone_names), max(strip), bbc_x, bbc_y, bbc_z, bbe_x, bbe_y, bbe_z))
+					#write the mesh_piece header
+					lod_bytes.append(pack("4I 3f 3f", len(strip), len(piece_verts), len(piece_bone_names), max(strip), bbc_x, bbc_y, bbc_z, bbe_x, bbe_y, bbe_z))
 				
-				#write the piece_bones
-				lod_bytes.append(pack(str(len(piece_bone_names))+"I", *[bone_names.index(bone_name) for bone_name in piece_bone_names]))
+					#write the piece_bones
+					lod_bytes.append(pack(str(len(piece_bone_names))+"I", *[bone_names.index(bone_name) for bone_name in piece_bone_names]))
 				
-				#write the verts
-				lod_bytes.append(b"".join(piece_verts))
+					#write the verts
+					lod_bytes.append(piece_verts.tobytes())
 				
-				#write the whole tristrip
-				lod_bytes.append(pack(str(len(strip))+"h", *strip))
+					#write the whole tristrip
+					lod_bytes.append(pack(str(len(strip))+"h", *strip))
 		
 	lod_bytes = b"".join(lod_bytes)
 	try:
-		with open(filepath, 'wb') as f:
+		with open(filepath, 'wb') as f, profiler.span("write"):
 			remaining_bytes = 112 + len(bones_bytes) + len(anim_bytes) + len(lod_bytes)
 			
 			lod_offset = anim_pointer-60+len(anim_bytes)
@@ -2,22 +2,70 @@ import os
 import time
 import bpy
 import mathutils
-from struct import iter_unpack, unpack_from
-from subprocess import check_call
-from .utils.tristrip import triangulate
+import numpy as np
+from . import tmd_format
+from . import tml_format
+from .utils import keymath
+from .utils.tristrip import triangulate_array
+from .utils.profiling import Profiler
+from .utils.texcache import TextureCache
 from .common_tmd import LOD, errors, log_error, correction_local, correction_global, name_to_blender
 
+#value of 'LINEAR' in the keyframe interpolation enum
+KEY_LINEAR = 1
+
 def create_ob(ob_name, ob_data):
 	ob = bpy.data.objects.new(ob_name, ob_data)
 	bpy.context.scene.collection.objects.link(ob)
 	bpy.context.view_layer.objects.active = ob
 	return ob
 
-def select_layer(layer_nr): return tuple(i == layer_nr for i in range(0, 20))
+def fill_mesh(me, co, tris):
+	"""Create the geometry of a mesh from (n,3) arrays of vertex positions and triangle indices."""
+	num_tris = len(tris)
+	me.vertices.add(len(co))
+	me.vertices.foreach_set("co", np.ascontiguousarray(co, dtype=np.float32).ravel())
+	me.loops.add(3 * num_tris)
+	me.loops.foreach_set("vertex_index", np.ascontiguousarray(tris, dtype=np.int32).ravel())
+	me.polygons.add(num_tris)
+	me.polygons.foreach_set("loop_start", np.arange(0, 3 * num_tris, 3, dtype=np.int32))
+	me.polygons.foreach_set("loop_total", np.full(num_tris, 3, dtype=np.int32))
+	me.update(calc_edges=True)
+
+def set_linear_keys(fcurve, frames, values):
+	"""Fill an empty fcurve with linearly interpolated keys in one go."""
+	#insert() would replace keys on the same frame, so keep the last of each, sorted by time
+	frames, last = np.unique(frames[::-1], return_index=True)
+	values = values[::-1][last]
+	num_keys = len(frames)
+	fcurve.keyframe_points.add(num_keys)
+	fcurve.keyframe_points.foreach_set("co", np.stack((frames, values), axis=1).astype(np.float32).ravel())
+	fcurve.keyframe_points.foreach_set("interpolation", np.full(num_keys, KEY_LINEAR, dtype=np.int32))
+	fcurve.update()
+
+_texture_cache = None
+
+def texture_cache():
+	"""The cache of decoded textures, shared by all imports of this session."""
+	global _texture_cache
+	if _texture_cache is None:
+		_texture_cache = TextureCache(os.path.join(tml_format.cache_dir(), "textures"))
+	return _texture_cache
 
-def get_matrix(datastr): return mathutils.Matrix(list(iter_unpack('4f',datastr)))
+def select_layer(layer_nr): return tuple(i == layer_nr for i in range(0, 20))
 			
-def load(operator, context, filepath = "", use_custom_normals = False, use_anims=False, extract_textures=False, set_fps=False):
+def load(operator, context, filepath = "", use_custom_normals = False, use_anims=False, extract_textures=False, set_fps=False, profiler=None):
+	"""Import a TMD and return the errors. Pass a Profiler to time the stages."""
+	if profiler is None:
+		profiler = Profiler(enabled=False)
+	with profiler:
+		with profiler.span("parse"):
+			tmd = tmd_format.read_tmd(filepath)
+		#unmap the file in any case, so that it can be exported over
+		with tmd:
+			return _load(operator, context, filepath, tmd, use_custom_normals, use_anims, extract_textures, set_fps, profiler)
+
+def _load(operator, context, filepath, tmd, use_custom_normals, use_anims, extract_textures, set_fps, profiler):
 
 	#collection = bpy.data.collections.new("Objects")
 	#bpy.context.scene.collection.children.link(collection)
@@ -37,363 +85,294 @@ def load(operator, context, filepath = "", use_custom_normals = False, use_anims
 	except: pass
 	root_name = os.path.basename(filepath)
 	print("\nImporting",root_name)
-	with open(filepath, 'rb') as f:
-		datastream = f.read()
-	
-	#header
-	remaining_bytes, tkl_ref, magic_value1, magic_value2, lod_data_offset, salt, u1, u2	 = unpack_from("I 8s 2L 4I", datastream, 8)
-	scene_block_bytes, num_nodes, u3, num_anims, u4 = unpack_from("I 4H", datastream, 60)
-	aux_node_data, node_data, anim_pointer = unpack_from("3I", datastream, 60+56)
-	
-	#print(aux_node_data, node_data, anim_pointer)
-	#decrypt the addresses
-	aux_node_data += 60 - salt
-	node_data += 60 - salt
-	anim_pointer += 60 - salt
-	if aux_node_data == 124:
-		anim_pointer = node_data
-		node_data = aux_node_data
-	#else:
-		#what does the aux node data do?
-		#node_aux = unpack_from(str(num_nodes)+"i", datastream, aux_node_data)
-		#print("node_aux",node_aux)
-	#print(aux_node_data, node_data, anim_pointer)
 
-	#create the armature
-	arm_name = root_name[:-4]
-	arm_data = bpy.data.armatures.new(arm_name)
-	arm_data.show_axes = True
-	arm_data.display_type = 'STICK'
-	armature = create_ob(arm_name, arm_data)
-	armature.show_in_front = True
-	armature["tmd_path"] = filepath
-	bpy.ops.object.mode_set(mode = 'EDIT')
+	with profiler.span("textures"):
+		matlibs = os.path.join(os.path.dirname(os.path.dirname(filepath)), "matlibs")
+		if not os.path.isdir(matlibs):
+			log_error(matlibs+' is missing. Models should be imported from JPOG-like folder structure.')
+			matlibs = os.path.dirname(filepath)
+		matnames = set(tmd_mesh.material for lod in tmd.lods for tmd_mesh in lod.meshes)
+		#without materials, there is nothing to look up
+		matlib_index = tml_format.matlib_index(matlibs, scan_tmls=extract_textures) if matnames else None
+		#start unpacking the textures now, so that it happens while the meshes and animations are built
+		texture_jobs = []
+		if extract_textures and matnames:
+			cache = texture_cache()
+			hits, misses = cache.hits, cache.misses
+			#we only have to unpack each TML once
+			for tml_path in sorted(set(matlib_index.find_tml(matname) for matname in matnames) - {None}):
+				try:
+					texture_jobs.append((tml_path, tml_format.extract_tml_async(tml_path, cache)))
+				except OSError:
+					log_error(os.path.basename(tml_path)+': TML reading failed! Could not extract textures.')
+
+	with profiler.span("armature"):
+		#create the armature
+		arm_name = root_name[:-4]
+		arm_data = bpy.data.armatures.new(arm_name)
+		arm_data.show_axes = True
+		arm_data.display_type = 'STICK'
+		armature = create_ob(arm_name, arm_data)
+		armature.show_in_front = True
+		armature["tmd_path"] = filepath
+		bpy.ops.object.mode_set(mode = 'EDIT')
 	
-	#read the bones
-	fallback_matrix = {}
-	pos = node_data
-	#note that these are not necessarily sorted, so we must build a list manually and can't just take the bones from the armature in the end!
-	bone_names = []
-	for i in range(0, num_nodes):
-		x, y, z, w = unpack_from("4f", datastream, pos)
-		fallback_quat = mathutils.Quaternion((w,x,y,z))
-		#this is the finished matrix in armature ie. world space
-		bind = get_matrix(datastream[pos+16:pos+80]).transposed()
-		#inv_bind = get_matrix(datastream[pos+80:pos+144]).transposed()
-		name_len =  unpack_from("B", datastream, pos+144)[0]
-		bone_name = name_to_blender(unpack_from(str(name_len)+"s", datastream, pos+145)[0])
-		bone_names.append(bone_name)
-		parent_id, updates, x, y, z = unpack_from("hH 3f", datastream, pos+160)
-		fallback_trans = mathutils.Vector((x,y,z))
+		#read the bones
+		fallback_matrix = {}
+		fallback_quats = {}
+		#note that these are not necessarily sorted, so we must build a list manually and can't just take the bones from the armature in the end!
+		bone_names = []
+		for node in tmd.nodes:
+			x, y, z, w = node.quat
+			fallback_quat = mathutils.Quaternion((w,x,y,z))
+			#this is the finished matrix in armature ie. world space
+			bind = mathutils.Matrix(node.bind).transposed()
+			bone_name = name_to_blender(node.raw_name)
+			bone_names.append(bone_name)
+			parent_id = node.parent_id
 		
-		#create a matrix from the fallback values
-		fallback_matrix[bone_name] = fallback_quat.to_matrix().to_4x4()
-		fallback_matrix[bone_name].translation = fallback_trans
-		pos+=176
+			#create a matrix from the fallback values
+			fallback_quats[bone_name] = (w,x,y,z)
+			fallback_matrix[bone_name] = fallback_quat.to_matrix().to_4x4()
+			fallback_matrix[bone_name].translation = node.translation
 
-		#create a bone
-		bone = arm_data.edit_bones.new(bone_name)
-		#parent it and get the armature space matrix
-		if parent_id > -1:
-			bone.parent = arm_data.edit_bones[bone_names[parent_id]]
+			#create a bone
+			bone = arm_data.edit_bones.new(bone_name)
+			#parent it and get the armature space matrix
+			if parent_id > -1:
+				bone.parent = arm_data.edit_bones[bone_names[parent_id]]
 		
-		#create and pose the bone
-		#correct the bind pose matrix axis
-		#blender bones are Y forward, while bind is X forward - correction_local takes care of that
-		#this will result in a good looking skeleton, just globally rotated - correction_global fixes that
-		bind = correction_global @ correction_local @ bind @ correction_local.inverted()
+			#create and pose the bone
+			#correct the bind pose matrix axis
+			#blender bones are Y forward, while bind is X forward - correction_local takes care of that
+			#this will result in a good looking skeleton, just globally rotated - correction_global fixes that
+			bind = correction_global @ correction_local @ bind @ correction_local.inverted()
 		
-		tail, roll = bpy.types.Bone.AxisRollFromMatrix(bind.to_3x3())
-		bone.head = bind.to_translation()
-		bone.tail = tail + bone.head
-		bone.roll = roll
-		bone.use_deform = False if updates else True
-	
-	# #fix the bone length
-	for bone in arm_data.edit_bones:
-		if bone.parent:
-			if bone.children:
-				childheads = mathutils.Vector()
-				for child in bone.children:
-					childheads += child.head
-				#do it like this to avoid deleting zero-length bones inbetween!
-				bone_length = (bone.head - childheads/len(bone.children)).length
-				if bone_length < 0.01:
-					bone_length = 0.25
-				bone.length = bone_length
-			# end of a chain
-			else:
-				bone.length = bone.parent.length
-	bpy.ops.object.mode_set(mode = 'OBJECT')
-	#layers_set(armature, select_layer(5))
+			tail, roll = bpy.types.Bone.AxisRollFromMatrix(bind.to_3x3())
+			bone.head = bind.to_translation()
+			bone.tail = tail + bone.head
+			bone.roll = roll
+			bone.use_deform = False if node.updates else True
 	
-	#hide_collection("5", True)
-	#armature.layers = select_layer(5)
+		# #fix the bone length
+		for bone in arm_data.edit_bones:
+			if bone.parent:
+				if bone.children:
+					childheads = mathutils.Vector()
+					for child in bone.children:
+						childheads += child.head
+					#do it like this to avoid deleting zero-length bones inbetween!
+					bone_length = (bone.head - childheads/len(bone.children)).length
+					if bone_length < 0.01:
+						bone_length = 0.25
+					bone.length = bone_length
+				# end of a chain
+				else:
+					bone.length = bone.parent.length
+		bpy.ops.object.mode_set(mode = 'OBJECT')
 
-	pos = lod_data_offset + 60
-	#max_lod_distance just a gues
-	num_lods, max_lod_distance = unpack_from("I f", datastream, pos)
-	print("Number of LODs:",num_lods)
-	pos+=8
-
-	for level in range(0,num_lods):
-		#these are apparently a bounding volume as a sphere, but not certainly - seemingly unimportant
-		num_meshes_in_lod, u6, s_x, s_y, s_z, d = unpack_from("I f 4f ", datastream, pos)
-		
-		print("Meshes in LOD:",num_meshes_in_lod)
-		pos+=24
-		for mesh in range(0,num_meshes_in_lod):
-			num_pieces, num_all_strip_indices, num_all_verts, matname = unpack_from("3I 32s ", datastream, pos)
-			pos+=44
-			#these lists are extended by every piece
-			mesh_verts = []
-			mesh_tris = []
-			#we must store them for each piece, so we can do the rigging correctly
-			mesh_piece_node_indices = []
-			mesh_tristrips = []
-			#i = (b, b, b, b), (w,w,w,w)
-			mesh_weights = {}
-			
-			for meshpiece in range(0,num_pieces):
-				print("Piece:",meshpiece)
-				num_strip_indices, num_verts, num_piece_nodes, num_highest_index, bbc_x, bbc_y, bbc_z, bbe_x, bbe_y, bbe_z = unpack_from("4I 3f 3f", datastream, pos)
-				pos += 40
-				#the nodes used by this mesh - used in the lookup for the bone weights
-				mesh_piece_node_indices.append(unpack_from(str(num_piece_nodes)+"I ", datastream, pos))
-				pos += 4*num_piece_nodes
-				#read the verts of this piece
-				#store verts and tristrip
-				mesh_verts.extend(list(iter_unpack("3f 3f 4B 4B 2f", datastream[pos : pos+40*num_verts])))
-				pos += 40*num_verts
+	for level, lod in enumerate(tmd.lods):
+		for mesh, tmd_mesh in enumerate(lod.meshes):
+			with profiler.span("mesh build"):
 				#verts can be referred to from another piece!
-				mesh_tristrips.append(unpack_from(str(num_strip_indices)+"h ", datastream, pos))
-				#print([bone_names[i] for i in mesh_piece_node_indices[meshpiece]])
-				pos += 2*num_strip_indices
-			for tristrip, piece_node_indices in zip(mesh_tristrips, mesh_piece_node_indices):
-				#to resolve the rigging correctly, the weights must be resolved in the piece where they are used in the tristrip
-				for i in tristrip:
-					#we could do
-					if i not in mesh_weights:
-						bones = []
-						weights = []
-						for b, w in zip([int(x/3) for x in mesh_verts[i][10:14]], [ x/255 for x in mesh_verts[i][6:10]]):
-							if w > 0:
-								bones.append(bone_names[piece_node_indices[b]])
-								weights.append(w)
-						mesh_weights[i] = (bones, weights)
-			matname = matname.split(b"\x00")[0].decode("utf-8")
-			
-			if matname not in mat_2_obj.keys():
-				mat_2_obj[matname] = []
-			name = matname+"_LOD"+str(level)+"_MESH"+str(mesh)
+				mesh_verts = tmd_mesh.vertices()
+				mesh_tristrips = [piece.strip for piece in tmd_mesh.pieces]
+				matname = tmd_mesh.material
+				
+				if matname not in mat_2_obj.keys():
+					mat_2_obj[matname] = []
+				name = matname+"_LOD"+str(level)+"_MESH"+str(mesh)
+				
+				#build the mesh
+				me = bpy.data.meshes.new(name)
+				with profiler.span("triangulate"):
+					tris = triangulate_array(mesh_tristrips)
+				fill_mesh(me, mesh_verts["co"], tris)
+				ob = create_ob(name, me)
+				mat_2_obj[matname].append(ob)
+				LOD(ob, level)
+			profiler.count("meshes")
+			profiler.count("verts", len(mesh_verts))
+			profiler.count("tris", len(tris))
 			
-			#build the mesh
-			me = bpy.data.meshes.new(name)
-			me.from_pydata([v[0:3] for v in mesh_verts], [], triangulate(mesh_tristrips))
-			me.update()
-			ob = create_ob(name, me)
-			mat_2_obj[matname].append(ob)
-			LOD(ob, level)
-			#weight painting
-			ob.parent = armature
-			mod = ob.modifiers.new('SkinDeform', 'ARMATURE')
-			mod.object = armature
-			for i, weights in mesh_weights.items():
-				for bone_name, weight in zip(weights[0], weights[1]):
-					#could also do this in a preceding loop via used indices - faster!
+			with profiler.span("rigging"):
+				#to resolve the rigging correctly, the weights must be resolved in the piece where they are used in the tristrip
+				try:
+					skin_nodes, skin_weights = tmd_mesh.skin(mesh_verts)
+				except ValueError as err:
+					log_error(name+": "+str(err)+". These weights are not imported.")
+					skin_nodes, skin_weights = tmd_mesh.skin(mesh_verts, strict=False)
+				#weight painting
+				ob.parent = armature
+				mod = ob.modifiers.new('SkinDeform', 'ARMATURE')
+				mod.object = armature
+				#one call per bone and distinct weight
+				for node_i, weight, indices in tmd_format.weight_buckets(skin_nodes, skin_weights):
+					bone_name = bone_names[node_i]
 					if bone_name not in ob.vertex_groups: ob.vertex_groups.new(name=bone_name)
-					ob.vertex_groups[bone_name].add([i], weight, 'REPLACE')
+					ob.vertex_groups[bone_name].add(indices.tolist(), weight/255, 'REPLACE')
 					
-			#UV: flip V coordinate
-			me.uv_layers.new(name="UV")
-			me.uv_layers[-1].data.foreach_set("uv", [uv for pair in [mesh_verts[l.vertex_index][14:16] for l in me.loops] for uv in (pair[0], -pair[1])])
+			with profiler.span("uv"):
+				#UV: flip V coordinate
+				me.uv_layers.new(name="UV")
+				#loops were created in the order of tris
+				uvs = mesh_verts["uv"][tris.ravel()] * np.array((1, -1), dtype=np.float32)
+				me.uv_layers[-1].data.foreach_set("uv", uvs.ravel())
 			
 			#setting the normals works, but the effect is ruined by remove_doubles
-			#build a correctly sorted normals array, sorted by the order of faces
-			no_array = []
-			for face in me.polygons:
-				for vertex_index in face.vertices:
-					no_array.append(mesh_verts[vertex_index][3:6])
-				face.use_smooth = True
-				#and for rendering, make sure each poly is assigned to the material
-				face.material_index = 0
+			me.polygons.foreach_set("use_smooth", np.ones(len(tris), dtype=bool))
+			#and for rendering, make sure each poly is assigned to the material
+			me.polygons.foreach_set("material_index", np.zeros(len(tris), dtype=np.int32))
 			if use_custom_normals:
-				me.use_auto_smooth = True
-				me.normals_split_custom_set(no_array)
+				with profiler.span("normals"):
+					me.use_auto_smooth = True
+					#the TMD normals are per vertex, so blender can sort them by loop itself
+					me.normals_split_custom_set_from_vertices(mesh_verts["normal"])
 			else:	
-				#so ugly, working with context and operators - perhaps there is a better solution
-				bpy.ops.object.mode_set(mode = 'EDIT')
-				bpy.ops.mesh.remove_doubles(threshold = 0.0001, use_unselected = False)
-				bpy.ops.uv.seams_from_islands()
-				bpy.ops.object.mode_set(mode = 'OBJECT')
+				with profiler.span("remove_doubles"):
+					#so ugly, working with context and operators - perhaps there is a better solution
+					bpy.ops.object.mode_set(mode = 'EDIT')
+					bpy.ops.mesh.remove_doubles(threshold = 0.0001, use_unselected = False)
+					bpy.ops.uv.seams_from_islands()
+					bpy.ops.object.mode_set(mode = 'OBJECT')
 			
-	tkl_path = os.path.join(os.path.dirname(filepath), tkl_ref.split(b"\x00")[0].decode("utf-8")+".tkl")
+	tkl_path = tmd_format.tkl_path_for(filepath, tmd)
 	if use_anims:
-		#read the tkl
-		print("\nReading",tkl_path)
-		try:
-			with open(tkl_path, 'rb') as f:
-				tklstream = f.read()
-			loc_lut = {}
-			rot_lut = {}
-			tkl_b00, tkl_b01, tkl_b02, tkl_b03, tkl_remaining_bytes, tkl_name, tkl_b04, tkl_b05, tkl_b06, tkl_b07, tkl_b08, tkl_b09, tkl_b10, tkl_b11, tkl_b12, tkl_b13, num_loc, num_rot, tkl_i00, tkl_i01, tkl_i02, tkl_i03, tkl_i04	=  unpack_from("4B I 6s 10B 2I 5I", tklstream, 4)
-			#tkl_i04 probably another size value, close to tkl_remaining_bytes
-			pos = 56
-			print("Num Keys:",num_loc,num_rot)
-			for i in range(0, num_loc):
-				loc_lut[i] = mathutils.Vector((unpack_from("3f", tklstream, pos)))
-				pos+=12
-			for i in range(0, num_rot):
-				x,y,z,w = unpack_from("4f", tklstream, pos)
-				rot_lut[i] = mathutils.Quaternion((w,x,y,z))
-				pos+=16
+		with profiler.span("anims"):
+			#read the tkl
+			print("\nReading",tkl_path)
+			try:
+				tkl = tmd_format.read_tkl(tkl_path)
+				print("Num Keys:",tkl.num_loc,tkl.num_rot)
+				#mathutils objects are only created for the keys that are actually used
+				loc_lut = tkl.locs()
+				rot_lut = tkl.rots()
 			
-			if set_fps:
-				bpy.context.scene.render.fps = 30
-				print("Adjusted scene FPS!")
-			fps = bpy.context.scene.render.fps
-			armature.animation_data_create()
-			pos = anim_pointer
-			anim_offsets = unpack_from(str(num_anims)+"I", datastream, pos)
-			#read all anims
-			for anim_offset in anim_offsets:
-				pos = anim_offset + 60 - salt
-				name_len =  unpack_from("B", datastream, pos)[0]
-				anim_name = unpack_from(str(name_len)+"s", datastream, pos+1)[0].rstrip(b"\x00").decode("utf-8")
-				ub1, ub2, num_groups, duration =  unpack_from("3I f", datastream, pos+16)
-				channel_offsets = unpack_from(str(num_nodes)+"I", datastream, pos+32)
-				#create the action
-				action = bpy.data.actions.new(name = anim_name+str(ub1)+str(ub2))
-				action.use_fake_user = True
-				armature.animation_data.action = action
-				#read all bone channels
-				for i, channel_offset in enumerate(channel_offsets):
-					bone_name = bone_names[i]
-					channel_offset += 60 - salt
-					pos = channel_offset
-					channel_mode, num_frames =  unpack_from("2H", datastream, pos)
-					pos += 4
-					if channel_mode != 2:
-						# 0 = fallback trans, quat key
-						# 1 = trans + quat keys
-						# 2 = skip
-						# 3 = fallback quat, trans key
-						#initialize all fcurves
-						if channel_mode in (3, 1):
-							loc_fcurves = [action.fcurves.new(data_path = 'pose.bones["'+bone_name+'"].location', index = i, action_group = bone_name) for i in (0,1,2)]
-						if channel_mode in (0, 1):
-							rot_fcurves = [action.fcurves.new(data_path = 'pose.bones["'+bone_name+'"].rotation_quaternion', index = i, action_group = bone_name) for i in (0,1,2,3)]
-						for i in range(0,num_frames):
-							key_time, loc_index, rot_index = unpack_from("f H H", datastream, pos)
-							#build a matrix from this key and save it
-							key_matrix = rot_lut[rot_index].to_matrix().to_4x4()
-							#use the fallback if we should
-							if channel_mode == 0:
-								key_matrix.translation = fallback_matrix[bone_name].translation
-							if channel_mode == 1:
-								key_matrix.translation = loc_lut[loc_index]
+				if set_fps:
+					bpy.context.scene.render.fps = 30
+					print("Adjusted scene FPS!")
+				fps = bpy.context.scene.render.fps
+				armature.animation_data_create()
+				#the inverses are the same for every key of a bone
+				correction_local_inv = np.array(correction_local.inverted())
+				key_spaces = {bone_name: np.array(correction_local @ fallback_matrix[bone_name].inverted()) for bone_name in bone_names}
+				#read all anims
+				for anim in tmd.anims:
+					anim_name = anim.name
+					#create the action
+					action = bpy.data.actions.new(name = anim_name+str(anim.ub1)+str(anim.ub2))
+					action.use_fake_user = True
+					armature.animation_data.action = action
+					#read all bone channels
+					for bone_name, channel in zip(bone_names, anim.channels):
+						channel_mode = channel.mode
+						if channel_mode != 2:
+							# 0 = fallback trans, quat key
+							# 1 = trans + quat keys
+							# 2 = skip
+							# 3 = fallback quat, trans key
+							#initialize all fcurves
+							if channel_mode in (3, 1):
+								loc_fcurves = [action.fcurves.new(data_path = 'pose.bones["'+bone_name+'"].location', index = i, action_group = bone_name) for i in (0,1,2)]
+							if channel_mode in (0, 1):
+								rot_fcurves = [action.fcurves.new(data_path = 'pose.bones["'+bone_name+'"].rotation_quaternion', index = i, action_group = bone_name) for i in (0,1,2,3)]
+							keys = channel.keys()
+							#build the key matrices from the TKL, using the fallback if we should
 							if channel_mode == 3:
-								key_matrix = fallback_matrix[bone_name]
-								key_matrix.translation = loc_lut[loc_index]
-							
+								quats = np.broadcast_to(fallback_quats[bone_name], (len(keys), 4))
+							else:
+								quats = rot_lut[keys["rot"]][:, (3, 0, 1, 2)]
+							if channel_mode == 0:
+								locs = np.broadcast_to(tuple(fallback_matrix[bone_name].translation), (len(keys), 3))
+							else:
+								locs = loc_lut[keys["loc"]]
 							#and do local space correction only (as keyframes do not act in global space)
 							#we must make this matrix relative to the rest pose to conform with how blender bones work
-							key_matrix = fallback_matrix[bone_name].inverted() @ key_matrix
-							key_matrix = correction_local @ key_matrix @ correction_local.inverted()
-							key_frame = key_time * fps
+							key_locs, key_quats = keymath.transform_keys(key_spaces[bone_name], quats, locs, correction_local_inv)
+							key_quats = keymath.make_continuous(key_quats)
+							key_frames = keys["time"] * fps
 							if channel_mode in (3, 1):
-								for fcurve, key in zip(loc_fcurves, key_matrix.to_translation()):
-									fcurve.keyframe_points.insert(key_frame, key).interpolation = "LINEAR"
+								for fcurve, values in zip(loc_fcurves, key_locs.T):
+									set_linear_keys(fcurve, key_frames, values)
 							if channel_mode in (0, 1):
-								for fcurve, key in zip(rot_fcurves, key_matrix.to_quaternion()):
-									fcurve.keyframe_points.insert(key_frame, key).interpolation = "LINEAR"
-							pos+=8
+								for fcurve, values in zip(rot_fcurves, key_quats.T):
+									set_linear_keys(fcurve, key_frames, values)
 				
-				#loop looped anims
-				if "_lp" in anim_name.lower():
-					for fcurve in action.fcurves:
-						mod = fcurve.modifiers.new('CYCLES')
-		except FileNotFoundError:
-			log_error(tkl_path+' is missing. Models should be imported from JPOG-like folder structure.')
+					#loop looped anims
+					if "_lp" in anim_name.lower():
+						for fcurve in action.fcurves:
+							mod = fcurve.modifiers.new('CYCLES')
+			except FileNotFoundError:
+				log_error(tkl_path+' is missing. Models should be imported from JPOG-like folder structure.')
+		
+	if texture_jobs:
+		with profiler.span("textures"):
+			for tml_path, future in texture_jobs:
+				try:
+					written, tml_errors = future.result()
+				except:
+					log_error(os.path.basename(tml_path)+': TML reading failed! Could not extract textures.')
+					continue
+				matlib_index.add_files(written)
+				for error in tml_errors:
+					log_error(os.path.basename(tml_path)+": "+error)
+			profiler.count("texture cache hits", cache.hits - hits)
+			profiler.count("texture cache misses", cache.misses - misses)
+			print(cache.report())
 		
 	#find the right material
 	#create material and texture if they don't already exist
-	matlibs = os.path.join(os.path.dirname(os.path.dirname(filepath)), "matlibs")
-	if not os.path.isdir(matlibs):
-		log_error(matlibs+' is missing. Models should be imported from JPOG-like folder structure.')
-		matlibs = os.path.dirname(filepath)
-	if extract_textures:
-		tmls = [file for file in os.listdir(matlibs) if file.lower().endswith(".tml")]
-		try:
-			for tml in tmls:
-				tml_path = os.path.join(matlibs, tml)
-				with open(tml_path, 'rb') as f:
-					#read the last 2048 bytes, a select few (UI) seem to be shorter, maybe we can skip the exception
-					try: f.seek(-2048,2)
-					except: f.seek(0)
-					datastream = f.read()
-					# see if the matname is in it
-					for matname in mat_2_obj.keys():
-						if any((b"\x00"+matname.encode('utf-8')+b"\x00" in datastream, b"\x00"+matname.title().encode('utf-8')+b"\x00" in datastream, b"\x00"+matname.lower().encode('utf-8')+b"\x00" in datastream)):
-							#extract all to bmp
-							check_call(os.path.join(os.path.dirname(__file__), 'ConvertTML.exe "'+tml_path+'"'))
-							#we only have to unpack this TML once
-							break
-		except:
-			log_error('TML reading failed! Could not extract textures.')
-		
-	for matname in mat_2_obj.keys():
-		print("Material:",matname)
-		#create or retrieve a material
-		if matname not in bpy.data.materials:
-			mat = bpy.data.materials.new(matname)
-			mat.specular_intensity = 0.0
-			mat.use_nodes = True
-			#mat.ambient = 1
-			#mat.use_transparency = True
-		else:
-			mat = bpy.data.materials[matname]
+	with profiler.span("materials"):
+		for matname in mat_2_obj.keys():
+			#create or retrieve a material
+			if matname not in bpy.data.materials:
+				mat = bpy.data.materials.new(matname)
+				mat.specular_intensity = 0.0
+				mat.use_nodes = True
+				#mat.ambient = 1
+				#mat.use_transparency = True
+			else:
+				mat = bpy.data.materials[matname]
 			
-		#find the image file candidates
-		textures = [file for file in os.listdir(matlibs) if file.lower() == matname.lower()+".tga"]
-		#do something better?
-		if textures:
-			texture = textures[-1]
-			if texture not in bpy.data.textures:
-				tex = bpy.data.textures.new(texture, type = 'IMAGE')
-				try:
-					img = bpy.data.images.load(os.path.join(matlibs, texture))
-				except:
-					print("Could not find image "+texture+", generating blank image!")
-					img = bpy.data.images.new(texture,1,1)
-				tex.image = img
-			else: tex = bpy.data.textures[texture]
-			#now create the slot in the material for the texture
-			bsdf = mat.node_tree.nodes["Principled BSDF"]
-			mtex = mat.node_tree.nodes.new("ShaderNodeTexImage")
+			#find the image file
+			texture_path = matlib_index.find_texture(matname)
+			if texture_path:
+				texture = os.path.basename(texture_path)
+				if texture not in bpy.data.textures:
+					tex = bpy.data.textures.new(texture, type = 'IMAGE')
+					try:
+						img = bpy.data.images.load(texture_path)
+					except:
+						print("Could not find image "+texture+", generating blank image!")
+						img = bpy.data.images.new(texture,1,1)
+					tex.image = img
+				else: tex = bpy.data.textures[texture]
+				#now create the slot in the material for the texture
+				bsdf = mat.node_tree.nodes["Principled BSDF"]
+				mtex = mat.node_tree.nodes.new("ShaderNodeTexImage")
 			
-			mtex.image = tex.image
-			mat.node_tree.links.new(bsdf.inputs['Base Color'], mtex.outputs['Color'])
-			#mtex.texture = tex
-			#mtex.texture_coords = 'UV'
-			#mtex.use_map_color_diffuse = True 
-			#mtex.use_map_color_emission = True 
-			#mtex.emission_color_factor = 0.5
-			#mtex.uv_layer = "UV"
+				mtex.image = tex.image
+				mat.node_tree.links.new(bsdf.inputs['Base Color'], mtex.outputs['Color'])
+				#mtex.texture = tex
+				#mtex.texture_coords = 'UV'
+				#mtex.use_map_color_diffuse = True 
+				#mtex.use_map_color_emission = True 
+				#mtex.emission_color_factor = 0.5
+				#mtex.uv_layer = "UV"
 
 			
-		#even if no TMLs were found, we still get a dummy material (for re-export!)
-		for ob in mat_2_obj[matname]:
-			me = ob.data
-			me.materials.append(mat)
-			#assign textures to mesh
-			#reversed so the last is shown
-			for mtex in reversed(mat.node_tree.nodes):
-				if mtex.type == 'TEX_IMAGE':
-					for texface in me.uv_layers["UV"].data:
-						mtex.select = True
-						mat.node_tree.nodes.active = mtex
-						#texface.image = mtex.image
+			#even if no TMLs were found, we still get a dummy material (for re-export!)
+			for ob in mat_2_obj[matname]:
+				me = ob.data
+				me.materials.append(mat)
+				#assign textures to mesh
+				#reversed so the last is shown
+				for mtex in reversed(mat.node_tree.nodes):
+					if mtex.type == 'TEX_IMAGE':
+						for texface in me.uv_layers["UV"].data:
+							mtex.select = True
+							mat.node_tree.nodes.active = mtex
+							#texface.image = mtex.image
 	
 	success = '\nFinished TMD Import in %.2f seconds\n' %(time.process_time()-starttime)
 	print(success)
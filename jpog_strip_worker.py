@@ -0,0 +1,10 @@
+"""Entry point of the stripify worker processes started by utils/parallel.py.
+
+Jobs are pickled by module name, so the workers need a top level module
+to find. This one has a name no other addon will use, and only imports
+the top level 'utils' inside the workers, so registering it in Blender
+does not shadow or get shadowed by another addon's 'utils'."""
+
+def stripify_piece(job):
+	from utils.parallel import stripify_piece
+	return stripify_piece(job)
@@ -0,0 +1,429 @@
+"""Blender-free reader for Toshi TMD models and TKL keyframe libraries.
+
+Every structure is a thin view over a single memoryview of the file;
+offsets are resolved when a block is first visited and the actual
+values are only unpacked when they are accessed. Files are memory
+mapped, so only the pages that are touched are read from disk. Nothing in here may
+import bpy or mathutils, so it can be used from plain Python tools."""
+
+import mmap
+import os
+from struct import Struct, iter_unpack
+import numpy as np
+
+#offsets stored in the file are relative to the end of the 60 byte header and salted
+HEADER_SIZE = 60
+NODE_SIZE = 176
+VERTEX_SIZE = 40
+KEY_SIZE = 8
+
+#one vertex of a mesh piece, '3f 3f 4B 4B 2f'
+#bone indices are stored as 3 * index into the piece's node table
+VERTEX_DTYPE = np.dtype([
+	("co", "<f4", (3,)),
+	("normal", "<f4", (3,)),
+	("weights", "u1", (4,)),
+	("bones", "u1", (4,)),
+	("uv", "<f4", (2,)),
+	])
+
+#one key of an animation channel, 'f H H'
+KEY_DTYPE = np.dtype([
+	("time", "<f4"),
+	("loc", "<u2"),
+	("rot", "<u2"),
+	])
+
+_header = Struct("<8s I 16s 4I")
+_scene = Struct("<I 4H")
+_pointers = Struct("<3I")
+_quat = Struct("<4f")
+_node_name = Struct("<B 15s")
+_node_tail = Struct("<hH 3f")
+_lods = Struct("<I f")
+_lod = Struct("<I f 4f")
+_mesh = Struct("<3I 32s")
+_piece = Struct("<4I 3f 3f")
+_anim = Struct("<B 15s 3I f")
+_channel = Struct("<2H")
+_tkl_header = Struct("<4s I I 16s 2I 5I")
+
+def _close(data, view):
+	"""Release a view and unmap its data. Arrays still referencing the file keep the mapping alive."""
+	try:
+		view.release()
+		if isinstance(data, mmap.mmap):
+			data.close()
+	except BufferError:
+		pass
+
+def _cstr(b):
+	"""Decode a zero padded byte string."""
+	return bytes(b).split(b"\x00")[0].decode("utf-8")
+
+class TmdNode:
+	"""A bone of the TMD skeleton, 176 bytes."""
+	__slots__ = ("_view", "_pos", "index")
+
+	def __init__(self, view, pos, index):
+		self._view = view
+		self._pos = pos
+		self.index = index
+
+	@property
+	def quat(self):
+		"""Fallback rotation as stored, (x, y, z, w)."""
+		return _quat.unpack_from(self._view, self._pos)
+
+	@property
+	def bind(self):
+		"""Bind matrix in armature space, as 4 rows of the stored (transposed) matrix."""
+		return tuple(iter_unpack("<4f", self._view[self._pos+16 : self._pos+80]))
+
+	@property
+	def inv_bind(self):
+		return tuple(iter_unpack("<4f", self._view[self._pos+80 : self._pos+144]))
+
+	@property
+	def raw_name(self):
+		name_len, name = _node_name.unpack_from(self._view, self._pos+144)
+		return name[:name_len]
+
+	@property
+	def name(self):
+		return _cstr(self.raw_name)
+
+	@property
+	def parent_id(self):
+		return _node_tail.unpack_from(self._view, self._pos+160)[0]
+
+	@property
+	def updates(self):
+		return _node_tail.unpack_from(self._view, self._pos+160)[1]
+
+	@property
+	def translation(self):
+		"""Fallback translation, (x, y, z)."""
+		return _node_tail.unpack_from(self._view, self._pos+160)[2:]
+
+class TmdPiece:
+	"""A piece of a mesh: its bone table, vertices and one triangle strip."""
+	__slots__ = ("_view", "_nodes_pos", "_verts_pos", "_strip_pos", "end",
+				 "num_strip_indices", "num_verts", "num_piece_nodes", "num_highest_index", "bb_center", "bb_extent")
+
+	def __init__(self, view, pos):
+		self._view = view
+		(self.num_strip_indices, self.num_verts, self.num_piece_nodes, self.num_highest_index,
+		 *bb) = _piece.unpack_from(view, pos)
+		self.bb_center = tuple(bb[0:3])
+		self.bb_extent = tuple(bb[3:6])
+		self._nodes_pos = pos + _piece.size
+		self._verts_pos = self._nodes_pos + 4 * self.num_piece_nodes
+		self._strip_pos = self._verts_pos + VERTEX_SIZE * self.num_verts
+		self.end = self._strip_pos + 2 * self.num_strip_indices
+
+	@property
+	def node_indices(self):
+		"""Indices into the TMD nodes, referenced by the bone indices of the vertices."""
+		return self._view[self._nodes_pos : self._verts_pos].cast("I")
+
+	@property
+	def vertex_bytes(self):
+		return self._view[self._verts_pos : self._strip_pos]
+
+	def vertices(self):
+		"""The vertices of this piece as a read-only structured array of VERTEX_DTYPE, without copying."""
+		return np.frombuffer(self.vertex_bytes, dtype=VERTEX_DTYPE)
+
+	@property
+	def strip(self):
+		"""The triangle strip, indexing the vertices of the whole mesh."""
+		return self._view[self._strip_pos : self.end].cast("h")
+
+class TmdMesh:
+	"""A mesh of a LOD level, using a single material."""
+	__slots__ = ("num_pieces", "num_all_strip_indices", "num_all_verts", "raw_material", "pieces", "end")
+
+	def __init__(self, view, pos):
+		self.num_pieces, self.num_all_strip_indices, self.num_all_verts, self.raw_material = _mesh.unpack_from(view, pos)
+		pos += _mesh.size
+		self.pieces = []
+		for i in range(self.num_pieces):
+			piece = TmdPiece(view, pos)
+			self.pieces.append(piece)
+			pos = piece.end
+		self.end = pos
+
+	@property
+	def material(self):
+		return _cstr(self.raw_material)
+
+	def vertices(self):
+		"""All vertices of this mesh; strips of any piece may refer to vertices stored in another piece."""
+		if len(self.pieces) == 1:
+			return self.pieces[0].vertices()
+		return np.concatenate([piece.vertices() for piece in self.pieces])
+
+	def skin(self, verts=None, strict=True):
+		"""Resolve the bone indices of all vertices into TMD node indices.
+
+		The bone indices of a vertex refer to the node table of the first piece
+		whose strip uses the vertex. Returns (n,4) node indices and (n,4) uint8
+		weights; vertices that no strip uses get zero weights. A weighted bone
+		index outside of its piece's node table raises ValueError, or with
+		strict=False loses its weight."""
+		if verts is None:
+			verts = self.vertices()
+		#assign in reverse so the first piece that uses a vertex wins
+		piece_of = np.full(len(verts), -1, dtype=np.int32)
+		for piece_i in reversed(range(len(self.pieces))):
+			piece_of[np.asarray(self.pieces[piece_i].strip)] = piece_i
+		num_piece_nodes = np.array([p.num_piece_nodes for p in self.pieces]+[0], dtype=np.int32)
+		node_table = np.zeros((len(self.pieces), max(num_piece_nodes.max(), 1)), dtype=np.int32)
+		for piece_i, piece in enumerate(self.pieces):
+			node_table[piece_i, :piece.num_piece_nodes] = piece.node_indices
+		pieces = np.maximum(piece_of, 0)
+		local = verts["bones"].astype(np.int32) // 3
+		weights = np.where(piece_of[:, None] > -1, verts["weights"], 0).astype(np.uint8)
+		invalid = (local >= num_piece_nodes[pieces][:, None]) & (weights > 0)
+		if invalid.any():
+			if strict:
+				vert, slot = np.argwhere(invalid)[0]
+				raise ValueError("Vertex %d uses bone %d of piece %d, which has only %d bones (%d such weights)"
+								 % (vert, local[vert, slot], pieces[vert], num_piece_nodes[pieces[vert]], invalid.sum()))
+			weights[invalid] = 0
+		#unweighted slots may hold anything
+		local = np.where(local < num_piece_nodes[pieces][:, None], local, 0)
+		nodes = node_table[pieces[:, None], local]
+		return nodes, weights
+
+def weight_buckets(nodes, weights):
+	"""Group the skin of a mesh by node and weight.
+
+	Takes the (n,4) arrays returned by TmdMesh.skin and yields
+	(node index, uint8 weight, array of vertex indices) for every distinct
+	pair, so that each bucket can be assigned with a single call."""
+	rows, slots = np.nonzero(weights)
+	bucket_nodes = nodes[rows, slots]
+	bucket_weights = weights[rows, slots]
+	order = np.lexsort((rows, bucket_weights, bucket_nodes))
+	keys = bucket_nodes[order].astype(np.int64) * 256 + bucket_weights[order]
+	for chunk in np.split(order, np.flatnonzero(np.diff(keys)) + 1):
+		if len(chunk):
+			yield int(bucket_nodes[chunk[0]]), int(bucket_weights[chunk[0]]), rows[chunk]
+
+class TmdLod:
+	"""A level of detail, holding its meshes and a (presumed) bounding sphere."""
+	__slots__ = ("num_meshes", "u6", "sphere", "meshes", "end")
+
+	def __init__(self, view, pos):
+		self.num_meshes, self.u6, *sphere = _lod.unpack_from(view, pos)
+		self.sphere = tuple(sphere)
+		pos += _lod.size
+		self.meshes = []
+		for i in range(self.num_meshes):
+			mesh = TmdMesh(view, pos)
+			self.meshes.append(mesh)
+			pos = mesh.end
+		self.end = pos
+
+class TmdChannel:
+	"""Keys of one bone in one animation.
+
+	mode 0 = fallback trans, quat key
+	mode 1 = trans + quat keys
+	mode 2 = skip
+	mode 3 = fallback quat, trans key"""
+	__slots__ = ("_view", "_pos", "mode", "num_keys")
+
+	def __init__(self, view, pos):
+		self._view = view
+		self._pos = pos
+		self.mode, self.num_keys = _channel.unpack_from(view, pos)
+
+	@property
+	def key_bytes(self):
+		start = self._pos + _channel.size
+		return self._view[start : start + KEY_SIZE * self.num_keys]
+
+	def keys(self):
+		"""All keys as a read-only structured array of KEY_DTYPE (time in seconds, loc and rot indices into the TKL)."""
+		return np.frombuffer(self.key_bytes, dtype=KEY_DTYPE)
+
+class TmdAnim:
+	"""An animation, with one channel per node."""
+	__slots__ = ("_tmd", "_pos", "raw_name", "ub1", "ub2", "num_groups", "duration", "_channels")
+
+	def __init__(self, tmd, pos):
+		self._tmd = tmd
+		self._pos = pos
+		name_len, name, self.ub1, self.ub2, self.num_groups, self.duration = _anim.unpack_from(tmd.view, pos)
+		self.raw_name = name[:name_len]
+		self._channels = None
+
+	@property
+	def name(self):
+		return _cstr(self.raw_name)
+
+	@property
+	def channels(self):
+		if self._channels is None:
+			offsets = self._tmd.view[self._pos+32 : self._pos+32+4*self._tmd.num_nodes].cast("I")
+			self._channels = [TmdChannel(self._tmd.view, self._tmd.decrypt(offset)) for offset in offsets]
+		return self._channels
+
+class TmdFile:
+	"""A parsed TMD model. Blocks are only walked when first accessed."""
+
+	def __init__(self, data):
+		self._data = data
+		self.view = memoryview(data).cast("B")
+		(self.magic, self.remaining_bytes, self.raw_tkl_ref, self.lod_data_offset,
+		 self.salt, self.u1, self.u2) = _header.unpack_from(self.view, 0)
+		self.scene_block_bytes, self.num_nodes, self.u3, self.num_anims, self.u4 = _scene.unpack_from(self.view, 60)
+		aux_node_data, node_data, anim_pointer = (self.decrypt(x) for x in _pointers.unpack_from(self.view, 60+56))
+		if aux_node_data == 124:
+			anim_pointer = node_data
+			node_data = aux_node_data
+		#else: what does the aux node data do?
+		self.aux_node_data = aux_node_data
+		self.node_data = node_data
+		self.anim_pointer = anim_pointer
+		self._nodes = None
+		self._lods = None
+		self._anims = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		"""Unmap the file, eg. before it is overwritten. Nothing may be read afterwards."""
+		#the anims point back to this file, don't leave the cycle to the garbage collector
+		self._nodes = None
+		self._lods = None
+		self._anims = None
+		_close(self._data, self.view)
+
+	def decrypt(self, offset):
+		"""Turn a salted offset from the file into an absolute position."""
+		return offset + HEADER_SIZE - self.salt
+
+	@property
+	def tkl_ref(self):
+		return _cstr(self.raw_tkl_ref)
+
+	@property
+	def lod_pointer(self):
+		return self.lod_data_offset + HEADER_SIZE
+
+	@property
+	def nodes(self):
+		#note that these are not necessarily sorted the same way as in blender's armature!
+		if self._nodes is None:
+			self._nodes = [TmdNode(self.view, self.node_data + i * NODE_SIZE, i) for i in range(self.num_nodes)]
+		return self._nodes
+
+	@property
+	def node_bytes(self):
+		return self.view[self.node_data : self.node_data + NODE_SIZE * self.num_nodes]
+
+	@property
+	def anim_bytes(self):
+		"""The raw animation block, anim pointers and all channels."""
+		return self.view[self.anim_pointer : self.lod_pointer]
+
+	@property
+	def max_lod_distance(self):
+		return _lods.unpack_from(self.view, self.lod_pointer)[1]
+
+	@property
+	def lods(self):
+		if self._lods is None:
+			num_lods = _lods.unpack_from(self.view, self.lod_pointer)[0]
+			pos = self.lod_pointer + _lods.size
+			self._lods = []
+			for i in range(num_lods):
+				lod = TmdLod(self.view, pos)
+				self._lods.append(lod)
+				pos = lod.end
+		return self._lods
+
+	@property
+	def anims(self):
+		if self._anims is None:
+			offsets = self.view[self.anim_pointer : self.anim_pointer + 4 * self.num_anims].cast("I")
+			self._anims = [TmdAnim(self, self.decrypt(offset)) for offset in offsets]
+		return self._anims
+
+class TklFile:
+	"""A parsed TKL keyframe library, holding the loc and rot lookup tables shared by all TMDs of a dig site."""
+
+	def __init__(self, data):
+		self._data = data
+		self.view = memoryview(data).cast("B")
+		(self.magic, self.offset_start, self.offset_end, self.raw_name, self.num_loc, self.num_rot,
+		 self.num_scales, self.loc_size, self.quat_size, self.scale_size, self.len_data) = _tkl_header.unpack_from(self.view, 0)
+		self.loc_pointer = _tkl_header.size
+		self.rot_pointer = self.loc_pointer + 12 * self.num_loc
+
+	def close(self):
+		_close(self._data, self.view)
+
+	@property
+	def name(self):
+		return _cstr(self.raw_name)
+
+	def locs(self):
+		"""All translation keys as a read-only (n,3) float32 array."""
+		return np.frombuffer(self.view[self.loc_pointer : self.rot_pointer], dtype="<f4").reshape(-1, 3)
+
+	def rots(self):
+		"""All rotation keys as a read-only (n,4) float32 array, (x, y, z, w) like in the file."""
+		return np.frombuffer(self.view[self.rot_pointer : self.rot_pointer + 16 * self.num_rot], dtype="<f4").reshape(-1, 4)
+
+def _read(filepath):
+	"""The file mapped read-only, or its bytes where it can't be mapped, eg. if it is empty."""
+	with open(filepath, 'rb') as f:
+		try:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return f.read()
+
+def read_tmd(filepath):
+	return TmdFile(_read(filepath))
+
+#dig sites share one TKL between many TMDs, so keep the parsed and mapped ones around
+_tkl_cache = {}
+
+def read_tkl(filepath):
+	"""Read a TKL, reusing the last parse of the same file if it has not changed on disk.
+	The file stays mapped until it changes or release_tkl is called."""
+	stat = os.stat(filepath)
+	key = os.path.normcase(os.path.abspath(filepath))
+	stamp = (stat.st_mtime_ns, stat.st_size)
+	cached = _tkl_cache.get(key)
+	if cached:
+		if cached[0] == stamp:
+			return cached[1]
+		cached[1].close()
+	tkl = TklFile(_read(filepath))
+	_tkl_cache[key] = (stamp, tkl)
+	return tkl
+
+def release_tkl(filepath):
+	"""Forget and unmap the cached parse of a TKL, eg. before it is overwritten."""
+	cached = _tkl_cache.pop(os.path.normcase(os.path.abspath(filepath)), None)
+	if cached:
+		cached[1].close()
+
+def read_tkl_header(filepath):
+	"""Read only the header of a TKL, for its name and key counts. The keys can't be accessed."""
+	with open(filepath, 'rb') as f:
+		return TklFile(f.read(_tkl_header.size))
+
+def tkl_path_for(tmd_path, tmd):
+	"""The TKL referenced by a TMD is expected next to it."""
+	return os.path.join(os.path.dirname(tmd_path), tmd.tkl_ref+".tkl")
@@ -0,0 +1,423 @@
+"""Blender-free reader for Toshi TML texture libraries.
+
+A TML holds a list of texture blocks followed by a table that names the
+textures after the materials using them. Pixels are decoded into (h, w, 4)
+RGBA uint8 arrays with the first row at the top, and can be written as TGA
+files just like ConvertTML.exe did. Nothing in here may import bpy, so it
+can be used from plain Python tools and worker processes."""
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct, error as StructError
+import numpy as np
+
+_header = Struct("<4s 2I")
+_texture = Struct("<4I 4H I")
+_count = Struct("<I")
+_material = Struct("<I 2H")
+_dds_size = Struct("<2I")
+_tga_header = Struct("<3B H H B 4H 2B")
+
+MATERIAL_NAME_SIZE = 32
+
+#bump when the layout of the matlibs index cache changes
+INDEX_VERSION = 1
+
+#formats of the texture blocks
+FORMAT_RGBA32 = 0
+FORMAT_RGB5A1 = 2
+FORMAT_DDS = 6
+FORMAT_RGBA4 = 7
+SUPPORTED_FORMATS = (FORMAT_RGBA32, FORMAT_RGB5A1, FORMAT_RGBA4, FORMAT_DDS)
+
+def _cstr(b):
+	"""Decode a zero padded byte string."""
+	return bytes(b).split(b"\x00")[0].decode("utf-8", "replace")
+
+def _expand(values, bits):
+	"""Scale integer channels of the given bit depth to 0-255, like the game's converter."""
+	return (values.astype(np.uint32) * 255 // ((1 << bits) - 1)).astype(np.uint8)
+
+def _decode_rgb5a1(data, width, height):
+	pixels = np.frombuffer(data, dtype="<u2", count=width*height).reshape(height, width)
+	rgba = np.empty((height, width, 4), dtype=np.uint8)
+	rgba[..., 0] = _expand(pixels & 31, 5)
+	rgba[..., 1] = _expand((pixels >> 5) & 31, 5)
+	rgba[..., 2] = _expand((pixels >> 10) & 31, 5)
+	rgba[..., 3] = np.where(pixels & 0x8000, 255, 0)
+	return rgba
+
+def _decode_rgba4(data, width, height):
+	pixels = np.frombuffer(data, dtype="<u2", count=width*height).reshape(height, width)
+	rgba = np.empty((height, width, 4), dtype=np.uint8)
+	for channel in range(4):
+		rgba[..., channel] = ((pixels >> (4 * channel)) & 15) * 17
+	return rgba
+
+def _color_palettes(colors, four_colors):
+	"""(n, 4, 4) RGBA palettes of (n, 2) 565 endpoint colors."""
+	c = colors.astype(np.uint32)
+	endpoints = np.stack((_expand(c >> 11, 5), _expand((c >> 5) & 63, 6), _expand(c & 31, 5)), axis=-1).astype(np.uint32)
+	c0, c1 = endpoints[:, 0], endpoints[:, 1]
+	palettes = np.empty((len(colors), 4, 4), dtype=np.uint8)
+	palettes[:, 0, :3] = c0
+	palettes[:, 1, :3] = c1
+	palettes[..., 3] = 255
+	#DXT1 blocks with c0 <= c1 have one interpolated color and transparent black
+	opaque = four_colors | (colors[:, 0] > colors[:, 1])
+	palettes[:, 2, :3] = np.where(opaque[:, None], (2 * c0 + c1) // 3, (c0 + c1) // 2)
+	palettes[:, 3, :3] = np.where(opaque[:, None], (c0 + 2 * c1) // 3, 0)
+	palettes[:, 3, 3] = np.where(opaque, 255, 0)
+	return palettes
+
+def _alpha_palettes(endpoints):
+	"""(n, 8) DXT5 alpha palettes of (n, 2) alpha endpoints."""
+	a0, a1 = endpoints[:, 0].astype(np.uint32), endpoints[:, 1].astype(np.uint32)
+	eight = (a0 > a1)[:, None]
+	steps = np.arange(1, 7, dtype=np.uint32)
+	seven = ((7 - steps) * a0[:, None] + steps * a1[:, None]) // 7
+	#blocks with a0 <= a1 interpolate 4 values and add fully transparent and opaque
+	five = np.zeros_like(seven)
+	five[:, :4] = ((5 - steps[:4]) * a0[:, None] + steps[:4] * a1[:, None]) // 5
+	five[:, 5] = 255
+	palettes = np.empty((len(endpoints), 8), dtype=np.uint8)
+	palettes[:, 0] = a0
+	palettes[:, 1] = a1
+	palettes[:, 2:] = np.where(eight, seven, five)
+	return palettes
+
+def decode_dxt(data, width, height, fourcc):
+	"""Decode DXT1, DXT3 or DXT5 compressed data to an (h, w, 4) RGBA array."""
+	blocks_w = (width + 3) // 4
+	blocks_h = (height + 3) // 4
+	num_blocks = blocks_w * blocks_h
+	block_size = 8 if fourcc == b"DXT1" else 16
+	blocks = np.frombuffer(data, dtype=np.uint8, count=num_blocks*block_size).reshape(num_blocks, block_size)
+	color_block = blocks[:, block_size-8:]
+	colors = color_block[:, :4].copy().view("<u2")
+	codes = color_block[:, 4:].copy().view("<u4")[:, 0]
+	#2 bit palette index of each of the 16 texels, row by row
+	shifts = np.arange(16, dtype=np.uint32) * 2
+	indices = (codes[:, None] >> shifts) & 3
+	palettes = _color_palettes(colors, fourcc != b"DXT1")
+	texels = palettes[np.arange(num_blocks)[:, None], indices]
+	if fourcc == b"DXT3":
+		alpha = blocks[:, :8].copy().view("<u8")[:, 0]
+		texels[..., 3] = ((alpha[:, None] >> (np.arange(16, dtype=np.uint64) * 4)) & 15).astype(np.uint8) * 17
+	elif fourcc == b"DXT5":
+		alpha_codes = np.zeros((num_blocks, 8), dtype=np.uint8)
+		alpha_codes[:, :6] = blocks[:, 2:8]
+		alpha_codes = alpha_codes.view("<u8")[:, 0]
+		alpha_indices = (alpha_codes[:, None] >> (np.arange(16, dtype=np.uint64) * 3)) & 7
+		texels[..., 3] = _alpha_palettes(blocks[:, :2])[np.arange(num_blocks)[:, None], alpha_indices]
+	#(block row, block column, texel row, texel column) to image rows and columns
+	rgba = texels.reshape(blocks_h, blocks_w, 4, 4, 4).transpose(0, 2, 1, 3, 4).reshape(blocks_h * 4, blocks_w * 4, 4)
+	return np.ascontiguousarray(rgba[:height, :width])
+
+def _texture_names(view, pos, indices, name):
+	"""Read the material table at pos and name the textures with the given block indices after it.
+	Returns the material names and the name of each texture."""
+	num_textures = len(indices)
+	num_materials = _count.unpack_from(view, pos)[0]
+	pos += _count.size
+	material_names = [_cstr(view[pos + i * MATERIAL_NAME_SIZE : pos + (i + 1) * MATERIAL_NAME_SIZE]) for i in range(num_materials)]
+	pos += num_materials * MATERIAL_NAME_SIZE
+	names = [""] * num_textures
+	for i in range(num_materials):
+		name_index, _, num_refs = _material.unpack_from(view, pos)
+		pos += _material.size
+		for texture_index in view[pos : pos + 4 * num_refs].cast("I"):
+			if texture_index < num_textures:
+				names[texture_index] = material_names[name_index]
+		pos += 4 * num_refs
+	#same naming as ConvertTML.exe: repeated names get a counter, unnamed ones the TML's name
+	seen = {}
+	for i, (texture_name, index) in enumerate(zip(names, indices)):
+		if texture_name:
+			count = seen.get(texture_name, 0) + 1
+			seen[texture_name] = count
+			if count > 1:
+				names[i] = "%s-%d" % (texture_name, count)
+		else:
+			names[i] = "%s_%02d" % (name, index)
+	return material_names, names
+
+def _unsupported(format, index):
+	return "Sub-format %d not supported for texture block %d" % (format, index)
+
+class TmlTexture:
+	"""A texture block of a TML, 28 bytes of header followed by its data."""
+	__slots__ = ("_view", "_pos", "index", "size", "format", "width", "height", "name")
+
+	def __init__(self, view, pos):
+		self._view = view
+		self._pos = pos
+		self.index, self.size, _, _, self.format, self.width, self.height, _, _ = _texture.unpack_from(view, pos)
+		self.name = ""
+
+	@property
+	def end(self):
+		return self._pos + _texture.size + self.size
+
+	@property
+	def data(self):
+		start = self._pos + _texture.size
+		return self._view[start : start + self.size]
+
+	def rgba(self):
+		"""Decoded pixels as an (h, w, 4) uint8 array, top row first."""
+		data = self.data
+		width, height = self.width, self.height
+		if self.format == FORMAT_RGBA32:
+			return np.frombuffer(data, dtype=np.uint8, count=width*height*4).reshape(height, width, 4).copy()
+		if self.format == FORMAT_RGB5A1:
+			return _decode_rgb5a1(data, width, height)
+		if self.format == FORMAT_RGBA4:
+			return _decode_rgba4(data, width, height)
+		if self.format == FORMAT_DDS:
+			if bytes(data[:4]).lower() != b"dds ":
+				raise ValueError("Texture block %d is not a DDS" % self.index)
+			dds_height, dds_width = _dds_size.unpack_from(data, 12)
+			if (dds_width, dds_height) != (width, height):
+				raise ValueError("DDS size of texture block %d does not match its header" % self.index)
+			fourcc = bytes(data[84:88])
+			if fourcc not in (b"DXT1", b"DXT3", b"DXT5"):
+				raise ValueError("DDS format %r of texture block %d not supported" % (fourcc, self.index))
+			return decode_dxt(data[128:], width, height, fourcc)
+		raise ValueError(_unsupported(self.format, self.index))
+
+class TmlFile:
+	"""A parsed TML texture library."""
+
+	def __init__(self, data, name=""):
+		self.view = memoryview(data).cast("B")
+		self.magic, self.unknown, num_textures = _header.unpack_from(self.view, 0)
+		if self.magic.lower() != b"tml1":
+			raise ValueError("Not a TML file")
+		self.textures = []
+		pos = _header.size
+		for i in range(num_textures):
+			texture = TmlTexture(self.view, pos)
+			self.textures.append(texture)
+			pos = texture.end
+		self.material_names, names = _texture_names(self.view, pos, [texture.index for texture in self.textures], name)
+		for texture, texture_name in zip(self.textures, names):
+			texture.name = texture_name
+
+def write_tga(filepath, rgba):
+	"""Write (h, w, 4) RGBA pixels, top row first, as an uncompressed 32 bit TGA."""
+	height, width = rgba.shape[:2]
+	bgra = np.ascontiguousarray(rgba[::-1, :, [2, 1, 0, 3]])
+	with open(filepath, "wb") as f:
+		f.write(_tga_header.pack(0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 0))
+		f.write(bgra.tobytes())
+
+def _read(filepath):
+	"""The file mapped read-only, or its bytes where it can't be mapped."""
+	with open(filepath, 'rb') as f:
+		try:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return f.read()
+
+def read_tml(filepath):
+	return TmlFile(_read(filepath), os.path.splitext(os.path.basename(filepath))[0])
+
+#TMLs are extracted in parallel and may name the same texture, so the writes of one TGA are serialized
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+def _path_lock(path):
+	key = os.path.normcase(os.path.abspath(path))
+	with _path_locks_lock:
+		return _path_locks.setdefault(key, threading.Lock())
+
+def extract_tml(filepath, out_dir=None, cache=None):
+	"""Decode every texture of a TML to a TGA named after its material, next to the TML by default.
+	With a TextureCache, textures are only decoded if they are not in it, and TGAs that were
+	written from it and not touched since are left alone.
+	Returns the paths of the written files and the errors of the textures that were skipped."""
+	if out_dir is None:
+		out_dir = os.path.dirname(filepath)
+	tml_hash = cache.tml_hash(filepath) if cache else None
+	#only read and parse the whole file if something has to be decoded
+	tml = None
+	written = []
+	errors = []
+	for i, (index, format, name) in enumerate(read_toc(filepath)):
+		if format not in SUPPORTED_FORMATS:
+			errors.append(_unsupported(format, index))
+			continue
+		path = os.path.join(out_dir, name+".tga")
+		with _path_lock(path):
+			rgba = None
+			if cache:
+				key = cache.key(tml_hash, name)
+				if cache.output_current(path, key):
+					cache.count(True)
+					written.append(path)
+					continue
+				rgba = cache.get(key)
+				cache.count(rgba is not None)
+			if rgba is None:
+				if tml is None:
+					tml = read_tml(filepath)
+				try:
+					rgba = tml.textures[i].rgba()
+				except ValueError as err:
+					errors.append(str(err))
+					continue
+				if cache:
+					cache.put(key, rgba)
+			write_tga(path, rgba)
+			if cache:
+				cache.record_output(path, key)
+			written.append(path)
+	if cache:
+		cache.save()
+	return written, errors
+
+#decoding is mostly numpy and file io, which release the GIL, so threads overlap with the importer's work
+_pool = None
+#tml path: ((mtime, size), future) of the extractions of this session
+_extractions = {}
+
+def _extracted(future):
+	"""True if a finished extraction succeeded and its files are still there."""
+	return future.exception() is None and all(os.path.isfile(path) for path in future.result()[0])
+
+def extract_tml_async(filepath, cache=None):
+	"""Extract a TML in a background thread and return a future of the result of extract_tml.
+	A TML that was already extracted in this session and did not change since is not extracted again."""
+	global _pool
+	if _pool is None:
+		_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+	stat = os.stat(filepath)
+	key = os.path.normcase(os.path.abspath(filepath))
+	stamp = (stat.st_mtime_ns, stat.st_size)
+	cached = _extractions.get(key)
+	if cached and cached[0] == stamp and (not cached[1].done() or _extracted(cached[1])):
+		return cached[1]
+	future = _pool.submit(extract_tml, filepath, None, cache)
+	_extractions[key] = (stamp, future)
+	return future
+
+def read_toc(filepath):
+	"""(block index, format, name) of each texture of a TML, without reading the pixel data."""
+	with open(filepath, 'rb') as f:
+		magic, _, num_textures = _header.unpack(f.read(_header.size))
+		if magic.lower() != b"tml1":
+			raise ValueError("Not a TML file")
+		indices = []
+		formats = []
+		for i in range(num_textures):
+			index, size, _, _, format = _texture.unpack(f.read(_texture.size))[:5]
+			indices.append(index)
+			formats.append(format)
+			f.seek(size, 1)
+		table = memoryview(f.read())
+	names = _texture_names(table, 0, indices, os.path.splitext(os.path.basename(filepath))[0])[1]
+	return list(zip(indices, formats, names))
+
+def cache_dir():
+	"""Folder for caches, outside of the game's folders which may not be writable."""
+	return os.environ.get("JPOG_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "jpog-blender")
+
+class MatlibIndex:
+	"""Case-insensitive lookup of material names in a matlibs folder, to the TML holding
+	their texture and to the TGA it was extracted to."""
+
+	def __init__(self, folder, tmls, files):
+		self.folder = folder
+		#tml file name: ((mtime, size), texture names)
+		self.tmls = tmls
+		self.files = {}
+		self.add_files(files)
+		#the first TML in sorted order wins if several have the same texture
+		self.materials = {}
+		for tml in sorted(tmls):
+			for i, name in enumerate(tmls[tml][1]):
+				self.materials.setdefault(name.lower(), (tml, i))
+
+	def add_files(self, paths):
+		"""Make newly extracted files known to the index."""
+		for path in paths:
+			name = os.path.basename(path)
+			self.files[name.lower()] = name
+
+	def find_tml(self, matname):
+		"""Path of the TML holding the texture of matname, or None."""
+		entry = self.materials.get(matname.lower())
+		return os.path.join(self.folder, entry[0]) if entry else None
+
+	def find_texture(self, matname):
+		"""Path of the extracted texture of matname, or None."""
+		name = self.files.get(matname.lower()+".tga")
+		return os.path.join(self.folder, name) if name else None
+
+#a dig site's animals share one matlibs folder, so keep the scans around
+_index_cache = {}
+
+def _index_path(folder):
+	return os.path.join(cache_dir(), "matlibs-%s.json" % hashlib.sha1(folder.encode("utf-8")).hexdigest()[:16])
+
+def _load_index(folder):
+	try:
+		with open(_index_path(folder), "r") as f:
+			data = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	if data.get("version") != INDEX_VERSION or data.get("folder") != folder:
+		return {}
+	return {tml: (tuple(stamp), names) for tml, (stamp, names) in data["tmls"].items()}
+
+def _save_index(folder, tmls):
+	path = _index_path(folder)
+	data = {"version": INDEX_VERSION, "folder": folder, "tmls": {tml: (list(stamp), names) for tml, (stamp, names) in tmls.items()}}
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temp_path = "%s.%d.tmp" % (path, os.getpid())
+		with open(temp_path, "w") as f:
+			json.dump(data, f)
+		os.replace(temp_path, path)
+	except OSError:
+		pass
+
+def matlib_index(folder, scan_tmls=True):
+	"""Index a matlibs folder with a single listing. The table of contents of a TML is only read
+	again if its mtime or size changed, otherwise it comes from memory or the index cache file.
+	Without scan_tmls, only the files in the folder are indexed and no cache file is touched."""
+	folder = os.path.normcase(os.path.abspath(folder))
+	files = []
+	stamps = {}
+	for entry in os.scandir(folder):
+		if not entry.is_file():
+			continue
+		files.append(entry.name)
+		if entry.name.lower().endswith(".tml"):
+			stat = entry.stat()
+			stamps[entry.name] = (stat.st_mtime_ns, stat.st_size)
+	if not scan_tmls:
+		return MatlibIndex(folder, {}, files)
+	cached = _index_cache.get(folder)
+	if cached is None:
+		cached = _load_index(folder)
+	tmls = {}
+	for tml, stamp in stamps.items():
+		if tml in cached and cached[tml][0] == stamp:
+			tmls[tml] = cached[tml]
+			continue
+		try:
+			names = [name for index, format, name in read_toc(os.path.join(folder, tml))]
+		except (OSError, ValueError, StructError):
+			print("Could not read the table of contents of "+tml)
+			names = []
+		tmls[tml] = (stamp, names)
+	if tmls != cached:
+		_save_index(folder, tmls)
+	_index_cache[folder] = tmls
+	return MatlibIndex(folder, tmls, files)
@@ -0,0 +1,110 @@
+"""A fast greedy triangle stripifier.
+
+Faces are walked over the half-edge adjacency of trianglemesh.Mesh, in
+the manner of the SGI tomesh algorithm: every strip starts at the free
+face with the fewest free neighbours, is grown from each of the three
+edges of that face in both directions, and the longest of these is
+kept. Every face is only visited a constant number of times, so the
+whole mesh is stripified in linear time."""
+
+import numpy as np
+
+from .trianglemesh import Mesh
+
+class GreedyStripifier:
+	"""Stripifies a list of triangles, with the same winding as triangulate()."""
+
+	def __init__(self, triangles):
+		self.mesh = Mesh(triangles)
+		self.verts = self.mesh._verts
+		self.start = self.mesh._adjacency_start
+		self.adjacency = self.mesh._adjacency
+		#0 = free, -1 = used by a strip, > 0 = claimed by that experiment
+		self.owner = [0] * self.mesh.num_faces
+		self.token = 0
+
+	def neighbours(self, f):
+		"""Faces that share an edge with f and could follow it in a strip."""
+		return self.adjacency[self.start[3 * f]:self.start[3 * f + 3]]
+
+	def _walk(self, f, p, q, step):
+		"""Claim faces across the edge p, q of face f on. step is 1 to walk forward and -1 to walk backward.
+		Returns the new vertices and their faces."""
+		verts = self.verts
+		start = self.start
+		adjacency = self.adjacency
+		owner = self.owner
+		token = self.token
+		new_verts = []
+		claimed = []
+		while True:
+			#the slot of the edge p, q is that of the vertex opposite it
+			i = 3 * f
+			a, b = verts[i], verts[i + 1]
+			slot = i if a != p and a != q else i + 1 if b != p and b != q else i + 2
+			#the faces across an edge always have the winding the strip needs next, see triangulate()
+			for n in range(start[slot], start[slot + 1]):
+				f = adjacency[n]
+				if owner[f] >= 0 and owner[f] != token:
+					break
+			else:
+				return new_verts, claimed
+			owner[f] = token
+			claimed.append(f)
+			i = 3 * f
+			r = verts[i] + verts[i + 1] + verts[i + 2] - p - q
+			new_verts.append(r)
+			if step > 0:
+				p, q = q, r
+			else:
+				p, q = r, p
+
+	def _experiment(self, f, rotation):
+		"""Grow a strip from face f, starting with one of its three edges."""
+		self.token += 1
+		self.owner[f] = self.token
+		i = 3 * f
+		a, b, c = self.verts[i], self.verts[i + 1], self.verts[i + 2]
+		if rotation == 1:
+			a, b, c = b, c, a
+		elif rotation == 2:
+			a, b, c = c, a, b
+		forward, forward_faces = self._walk(f, b, c, 1)
+		backward, backward_faces = self._walk(f, a, b, -1)
+		strip = backward[::-1] + [a, b, c] + forward
+		if len(backward) & 1:
+			#keep the winding of the first triangle with a degenerate one
+			strip.insert(0, strip[0])
+		return strip, [f] + forward_faces + backward_faces
+
+	def find_all_strips(self):
+		owner = self.owner
+		#bucket queue of the free faces by their number of free neighbours
+		degree = np.diff(self.mesh.adjacency_start).reshape(-1, 3).sum(axis=1).tolist()
+		buckets = [set() for i in range(4)]
+		for f, d in enumerate(degree):
+			buckets[min(d, 3)].add(f)
+		strips = []
+		while True:
+			f = None
+			for bucket in buckets:
+				if bucket:
+					f = bucket.pop()
+					break
+			if f is None:
+				return strips
+			strip, used = max((self._experiment(f, rotation) for rotation in range(3)), key=lambda experiment: len(experiment[1]))
+			#commit the faces of the best experiment
+			for g in used:
+				owner[g] = -1
+				if g != f:
+					buckets[min(degree[g], 3)].discard(g)
+			for g in used:
+				for n in self.neighbours(g):
+					if owner[n] >= 0:
+						d = degree[n]
+						degree[n] = d - 1
+						if d <= 3:
+							buckets[d].discard(n)
+							buckets[d - 1].add(n)
+			strips.append(strip)
@@ -0,0 +1,88 @@
+"""Vectorized kernels for converting animation keys between TMD and blender space.
+
+Quaternions are (w, x, y, z) like in mathutils, and matrices follow the
+math convention of mathutils (translation in the last column). Keys are
+stacked along the first axis, so a whole channel is converted at once."""
+
+import numpy as np
+
+def quat_to_matrix(quats):
+	"""(n,4) quaternions to (n,3,3) rotation matrices. Quaternions are normalized first."""
+	q = np.asarray(quats, dtype=np.float64)
+	norm = np.linalg.norm(q, axis=-1, keepdims=True)
+	norm[norm == 0] = 1
+	w, x, y, z = np.moveaxis(q / norm, -1, 0)
+	m = np.empty(q.shape[:-1] + (3, 3))
+	m[..., 0, 0] = 1 - 2*(y*y + z*z)
+	m[..., 0, 1] = 2*(x*y - w*z)
+	m[..., 0, 2] = 2*(x*z + w*y)
+	m[..., 1, 0] = 2*(x*y + w*z)
+	m[..., 1, 1] = 1 - 2*(x*x + z*z)
+	m[..., 1, 2] = 2*(y*z - w*x)
+	m[..., 2, 0] = 2*(x*z - w*y)
+	m[..., 2, 1] = 2*(y*z + w*x)
+	m[..., 2, 2] = 1 - 2*(x*x + y*y)
+	return m
+
+def matrix_to_quat(mats):
+	"""(n,3,3) or (n,4,4) matrices to (n,4) unit quaternions with w >= 0. Scale is ignored."""
+	m = np.asarray(mats, dtype=np.float64)[..., :3, :3]
+	norm = np.linalg.norm(m, axis=-2, keepdims=True)
+	norm[norm == 0] = 1
+	m = m / norm
+	m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+	m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+	m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+	#4 * the squares of w, x, y, z; derive the quaternion from the biggest for stability
+	d = np.stack((1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22), axis=-1)
+	#each row is 4 * one component * the quaternion
+	rows = np.stack((
+		np.stack((d[..., 0], m21 - m12, m02 - m20, m10 - m01), axis=-1),
+		np.stack((m21 - m12, d[..., 1], m01 + m10, m02 + m20), axis=-1),
+		np.stack((m02 - m20, m01 + m10, d[..., 2], m12 + m21), axis=-1),
+		np.stack((m10 - m01, m02 + m20, m12 + m21, d[..., 3]), axis=-1),
+		), axis=-2)
+	k = np.argmax(d, axis=-1)
+	q = np.take_along_axis(rows, k[..., None, None], axis=-2)[..., 0, :]
+	q /= np.linalg.norm(q, axis=-1, keepdims=True)
+	q[q[..., 0] < 0] *= -1
+	return q
+
+def compose(quats, locs):
+	"""Build (n,4,4) matrices from (n,4) quaternions and (n,3) translations."""
+	rot = quat_to_matrix(quats)
+	mats = np.zeros(rot.shape[:-2] + (4, 4))
+	mats[..., :3, :3] = rot
+	mats[..., :3, 3] = locs
+	mats[..., 3, 3] = 1
+	return mats
+
+def decompose(mats):
+	"""Split (n,4,4) matrices into (n,3) translations and (n,4) quaternions."""
+	mats = np.asarray(mats, dtype=np.float64)
+	return mats[..., :3, 3].copy(), matrix_to_quat(mats)
+
+def transform_keys(pre, quats, locs, post):
+	"""Apply pre @ key @ post to every key given as quaternion and translation.
+
+	pre and post are single 4x4 matrices (eg. from mathutils via np.array),
+	so any inverses they contain are only computed once per bone.
+	Returns the new (n,3) translations and (n,4) quaternions."""
+	mats = np.asarray(pre, dtype=np.float64) @ compose(quats, locs) @ np.asarray(post, dtype=np.float64)
+	return decompose(mats)
+
+def make_continuous(quats):
+	"""Flip the signs of quaternions so that consecutive keys lie in the same hemisphere.
+
+	Blender interpolates quaternion fcurves per component, so a sign flip
+	between two keys would spin the bone the long way round."""
+	q = np.array(quats, dtype=np.float64)
+	if len(q) > 1:
+		dots = np.einsum("ij,ij->i", q[1:], q[:-1])
+		flips = np.concatenate(((False,), np.cumsum(dots < 0) % 2 == 1))
+		q[flips] *= -1
+	return q
+
+def scale_keys(co, value_scale=1.0, time_scale=1.0):
+	"""Scale (n,2) keyframe coordinates, (frame, value)."""
+	return np.asarray(co, dtype=np.float64) * (time_scale, value_scale)
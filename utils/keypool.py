@@ -0,0 +1,80 @@
+"""Lookup tables for TKL translation and rotation keys.
+
+Keys are deduplicated by their packed float32 bytes, so identical keys
+only take one entry. With a tolerance, keys closer than it to an
+existing entry are merged into that entry; candidates are found with a
+spatial hash whose cells are twice the tolerance wide, so only the own
+cell and one neighbour per axis have to be searched."""
+
+from itertools import product
+from math import floor
+from struct import Struct
+
+#keys are referenced by unsigned shorts in the TMD
+MAX_KEYS = 65536
+
+class KeyPool:
+	"""A table of unique keys for one kind of TKL entry, eg. '3f' locs or '4f' quats."""
+
+	def __init__(self, fmt, tolerance=0.0):
+		self.struct = Struct("<"+fmt)
+		self.tolerance = tolerance
+		#packed entries, as written to the TKL
+		self.keys = []
+		#the entries as float32 precision tuples, used for the tolerance search
+		self.values = []
+		self.exact = {}
+		self.grid = {}
+		self.merged = 0
+
+	def __len__(self):
+		return len(self.keys)
+
+	def _cell(self, value):
+		size = 2 * self.tolerance
+		return tuple(floor(x / size) for x in value)
+
+	def _neighbour_cells(self, value):
+		size = 2 * self.tolerance
+		options = []
+		for x in value:
+			c = x / size
+			cell = floor(c)
+			#a match within the tolerance lies in this cell or the closer of the two neighbours
+			options.append((cell, cell - 1 if c - cell < 0.5 else cell + 1))
+		return product(*options)
+
+	def _nearest(self, value):
+		best = None
+		best_dist = self.tolerance * self.tolerance
+		for cell in self._neighbour_cells(value):
+			for i in self.grid.get(cell, ()):
+				dist = sum((a - b) * (a - b) for a, b in zip(value, self.values[i]))
+				if dist <= best_dist:
+					best = i
+					best_dist = dist
+		return best
+
+	def index(self, value):
+		"""Get the index of the entry for value, adding it if there is no match."""
+		packed = self.struct.pack(*value)
+		i = self.exact.get(packed)
+		if i is not None:
+			return i
+		value = self.struct.unpack(packed)
+		if self.tolerance > 0:
+			i = self._nearest(value)
+			if i is not None:
+				self.exact[packed] = i
+				self.merged += 1
+				return i
+		i = len(self.keys)
+		self.keys.append(packed)
+		self.values.append(value)
+		self.exact[packed] = i
+		if self.tolerance > 0:
+			self.grid.setdefault(self._cell(value), []).append(i)
+		return i
+
+	def to_bytes(self):
+		return b"".join(self.keys)
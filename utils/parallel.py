@@ -0,0 +1,90 @@
+"""Stripification of independent triangle lists in worker processes.
+
+Workers are spawned as plain python processes, so they must not import
+the addon package (and with it bpy). Their jobs go through the top level
+module jpog_strip_worker in the addon folder instead, which imports this
+module as the top level 'utils.parallel' in the worker, needing only numpy.
+If that is not possible, or the work is too small to pay for starting
+processes, everything runs serially in this process."""
+
+import importlib.util
+import multiprocessing
+import os
+import site
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .tristrip import stripify, stitch_strips
+from . import vertexcache
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(UTILS_DIR)
+WORKER_MODULE = "jpog_strip_worker"
+#starting the workers takes about a second, smaller jobs are done faster serially;
+#nvtristrip does about 7000 triangles per second, greedy about 100000, so even
+#with 4 cores greedy only gains from the pool on huge meshes
+MIN_PARALLEL_TRIS = {"nvtristrip": 20000, "greedy": 250000}
+
+def _num_stitches(strip, strips):
+	"""The number of degenerate indices that stitching strips into strip inserted."""
+	return len(strip) - sum(len(s) for s in strips if len(s) >= 3)
+
+def stripify_piece(job):
+	"""Stripify and stitch one triangle list. Returns the strip, the number of stitch indices that
+	were inserted and, if the strips were ordered for the vertex cache, the cache stats before and after."""
+	triangles, engine, optimize_cache = job
+	strips = stripify(triangles, engine=engine)
+	strip = stitch_strips(strips)
+	if not optimize_cache:
+		return strip, _num_stitches(strip, strips), None
+	stats = vertexcache.cache_stats(strip)
+	cached_strip = vertexcache.optimize_strips(strips)
+	cached_stats = vertexcache.cache_stats(cached_strip)
+	#keep the shorter strip unless the cache is used better
+	if cached_stats[0] >= stats[0]:
+		return strip, _num_stitches(strip, strips), (stats, stats)
+	return cached_strip, _num_stitches(cached_strip, strips), (stats, cached_stats)
+
+def _worker_module():
+	"""The worker entry point module, registered under its top level name so that jobs can be pickled."""
+	module = sys.modules.get(WORKER_MODULE)
+	if module is None:
+		try:
+			spec = importlib.util.spec_from_file_location(WORKER_MODULE, os.path.join(ADDON_DIR, WORKER_MODULE+".py"))
+			module = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(module)
+		except (ImportError, OSError):
+			return None
+		sys.modules[WORKER_MODULE] = module
+	return module
+
+def _context():
+	context = multiprocessing.get_context("spawn")
+	try:
+		import bpy
+		#before 2.91, sys.executable is blender itself
+		python = getattr(bpy.app, "binary_path_python", None)
+		if python:
+			context.set_executable(python)
+	except ImportError:
+		pass
+	return context
+
+def stripify_all(pieces, engine="nvtristrip", workers=0, optimize_cache=False):
+	"""Stripify each triangle list of pieces, in parallel if it pays off. workers = 0 uses all cores.
+	Returns the results of stripify_piece, in the order of pieces."""
+	jobs = [(triangles, engine, optimize_cache) for triangles in pieces]
+	workers = min(workers or os.cpu_count() or 1, len(jobs))
+	if workers > 1 and sum(len(triangles) for triangles in pieces) >= MIN_PARALLEL_TRIS.get(engine, 0):
+		module = _worker_module()
+		if module is not None:
+			try:
+				with ProcessPoolExecutor(max_workers=workers, mp_context=_context(), initializer=site.addsitedir, initargs=(ADDON_DIR,)) as pool:
+					#biggest first, so one big piece does not end up last
+					order = sorted(range(len(jobs)), key=lambda i: -len(jobs[i][0]))
+					futures = {i: pool.submit(module.stripify_piece, jobs[i]) for i in order}
+					return [futures[i].result() for i in range(len(jobs))]
+			except (OSError, BrokenProcessPool):
+				pass
+	return [stripify_piece(job) for job in jobs]
@@ -0,0 +1,87 @@
+"""Splitting of a mesh into pieces that each use a limited number of bones.
+
+Triangles are grouped by the set of bones they use, stored as a bitset.
+Each piece is started from the open group with the most bones and grown
+by always adding the group that needs the fewest new bones, preferring
+groups that share many bones with the piece. This keeps the triangles of
+a body part together and needs fewer pieces, and so draw calls, than
+placing every triangle into the first piece it fits in."""
+
+def bone_mask(bones):
+	"""Bitset of bone indices."""
+	mask = 0
+	for bone in bones:
+		mask |= 1 << bone
+	return mask
+
+def mask_bones(mask):
+	"""Sorted bone indices of a bitset."""
+	bones = []
+	bone = 0
+	while mask:
+		if mask & 1:
+			bones.append(bone)
+		mask >>= 1
+		bone += 1
+	return bones
+
+def _count(mask):
+	return bin(mask).count("1")
+
+def partition(triangle_bones, max_bones, max_pieces):
+	"""Split triangles into at most max_pieces pieces of at most max_bones bones.
+	triangle_bones holds the bone indices used by each triangle.
+	Returns a list of (sorted bone indices, sorted triangle indices) per piece,
+	and the indices of the triangles that fit into no piece."""
+
+	groups = {}
+	for i, bones in enumerate(triangle_bones):
+		groups.setdefault(bone_mask(bones), []).append(i)
+	unplaced = []
+	#bone count of every group that still has to be placed
+	open_groups = {}
+	for mask, triangles in groups.items():
+		num_bones = _count(mask)
+		if num_bones > max_bones:
+			unplaced.extend(triangles)
+		else:
+			open_groups[mask] = num_bones
+
+	pieces = []
+	while open_groups:
+		if len(pieces) == max_pieces:
+			for mask in open_groups:
+				unplaced.extend(groups[mask])
+			break
+		seed = max(open_groups, key = lambda mask: (open_groups[mask], len(groups[mask])))
+		piece_mask = seed
+		members = [seed]
+		del open_groups[seed]
+		while open_groups:
+			room = max_bones - _count(piece_mask)
+			best = None
+			best_key = None
+			absorbed = []
+			for mask, num_bones in open_groups.items():
+				new_bones = _count(mask & ~piece_mask)
+				if new_bones == 0:
+					#fits for free, no need to compare it
+					absorbed.append(mask)
+				elif new_bones <= room:
+					key = (new_bones, -(num_bones - new_bones), -len(groups[mask]))
+					if best_key is None or key < best_key:
+						best = mask
+						best_key = key
+			if absorbed:
+				for mask in absorbed:
+					members.append(mask)
+					del open_groups[mask]
+				continue
+			if best is None:
+				break
+			members.append(best)
+			piece_mask |= best
+			del open_groups[best]
+		pieces.append((mask_bones(piece_mask), sorted(i for mask in members for i in groups[mask])))
+	unplaced.sort()
+	return pieces, unplaced
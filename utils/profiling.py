@@ -0,0 +1,130 @@
+"""Instrumentation for import and export.
+
+A Profiler collects nested timing spans and counters while a file is
+processed, and can optionally capture a cProfile of the whole run. A
+disabled Profiler hands out a shared no-op span, so the instrumentation
+can stay in the hot paths."""
+
+import cProfile
+import io
+import pstats
+import time
+
+class Span:
+	"""Accumulated wall time and number of calls of one stage, with its sub stages."""
+	__slots__ = ("name", "seconds", "calls", "children")
+
+	def __init__(self, name):
+		self.name = name
+		self.seconds = 0.0
+		self.calls = 0
+		self.children = {}
+
+	def child(self, name):
+		span = self.children.get(name)
+		if span is None:
+			span = self.children[name] = Span(name)
+		return span
+
+	def to_dict(self):
+		return {"name": self.name, "seconds": self.seconds, "calls": self.calls, "children": [child.to_dict() for child in self.children.values()]}
+
+class _Timer:
+	__slots__ = ("profiler", "name", "span", "start")
+
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		stack = self.profiler.stack
+		self.span = stack[-1].child(self.name)
+		stack.append(self.span)
+		self.start = time.perf_counter()
+		return self.span
+
+	def __exit__(self, *exc):
+		self.span.seconds += time.perf_counter() - self.start
+		self.span.calls += 1
+		self.profiler.stack.pop()
+
+class _NullTimer:
+	__slots__ = ()
+
+	def __enter__(self):
+		return None
+
+	def __exit__(self, *exc):
+		pass
+
+_NULL_TIMER = _NullTimer()
+
+class Profiler:
+	"""Use as context manager around a whole run, and span() around its stages."""
+
+	def __init__(self, enabled=True, use_cprofile=False):
+		self.enabled = enabled or use_cprofile
+		self.root = Span("total")
+		self.stack = [self.root]
+		self.counters = {}
+		self.cprofile = cProfile.Profile() if use_cprofile else None
+		self.cprofile_text = None
+		self.start = None
+
+	def __enter__(self):
+		if self.enabled:
+			self.start = time.perf_counter()
+			if self.cprofile:
+				self.cprofile.enable()
+		return self
+
+	def __exit__(self, *exc):
+		if self.enabled:
+			if self.cprofile:
+				self.cprofile.disable()
+			self.root.seconds += time.perf_counter() - self.start
+			self.root.calls += 1
+
+	def span(self, name):
+		"""Time a stage, nested in the span that is currently open."""
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, name)
+
+	def count(self, name, n=1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def cprofile_stats(self, sort="cumulative", limit=40):
+		"""The top of the cProfile capture as text."""
+		if self.cprofile is None:
+			return None
+		if self.cprofile_text is None:
+			stream = io.StringIO()
+			pstats.Stats(self.cprofile, stream=stream).sort_stats(sort).print_stats(limit)
+			self.cprofile_text = stream.getvalue()
+		return self.cprofile_text
+
+	def report(self):
+		"""All measurements as a JSON serializable dict."""
+		return {"seconds": self.root.seconds, "spans": [child.to_dict() for child in self.root.children.values()], "counters": dict(self.counters), "cprofile": self.cprofile_stats()}
+
+	def format(self):
+		"""A readable table of the spans and counters."""
+		total = self.root.seconds or 1.0
+		lines = ["%-32s %10s %6s %6s" % ("stage", "seconds", "%", "calls")]
+		def add(span, depth):
+			lines.append("%-32s %10.4f %6.1f %6d" % ("  " * depth + span.name, span.seconds, 100 * span.seconds / total, span.calls))
+			for child in span.children.values():
+				add(child, depth + 1)
+		add(self.root, 0)
+		for name, value in sorted(self.counters.items()):
+			lines.append("%-32s %10d" % (name, value))
+		return "\n".join(lines)
+
+	def summary(self):
+		"""One line with the total time and the most expensive top level stage."""
+		if not self.root.children:
+			return "Finished in %.2f seconds" % self.root.seconds
+		slowest = max(self.root.children.values(), key=lambda span: span.seconds)
+		return "Finished in %.2f seconds, slowest stage '%s' took %.2f seconds" % (self.root.seconds, slowest.name, slowest.seconds)
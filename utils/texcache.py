@@ -0,0 +1,173 @@
+"""Persistent cache of decoded textures, shared by all imports.
+
+Entries are keyed by the hash of a TML's content and the name of the
+texture, so copies of the same TML in another install or backup hit the
+same entries. Pixels are stored zlib compressed with a small header below
+the user's cache folder, and the least recently used entries are removed
+once the cache grows over its size limit. The TGAs written from the cache
+are remembered too, so they are only written again if they were changed
+or deleted."""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from struct import Struct
+
+import numpy as np
+
+#bump when the layout of the entries or the manifest changes
+CACHE_VERSION = 1
+MAX_BYTES = 1024 * 1024 * 1024
+MANIFEST = "manifest.json"
+
+_entry_header = Struct("<4s 2H")
+_ENTRY_MAGIC = b"rgba"
+
+def _stamp(path):
+	stat = os.stat(path)
+	return [stat.st_mtime_ns, stat.st_size]
+
+def _key(path):
+	return os.path.normcase(os.path.abspath(path))
+
+class TextureCache:
+	"""Decoded textures by TML content and texture name. Safe to use from several threads."""
+
+	def __init__(self, folder, max_bytes=MAX_BYTES):
+		self.folder = folder
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._manifest = self._load()
+
+	def _load(self):
+		try:
+			with open(os.path.join(self.folder, MANIFEST), "r") as f:
+				manifest = json.load(f)
+			if manifest.get("version") == CACHE_VERSION:
+				return manifest
+		except (OSError, ValueError):
+			pass
+		#tml path: (mtime, size, hash), tga path: (mtime, size, key), key: (bytes, last use)
+		return {"version": CACHE_VERSION, "tmls": {}, "outputs": {}, "entries": {}}
+
+	def _entry_path(self, key):
+		return os.path.join(self.folder, key[:2], key+".rgba")
+
+	def tml_hash(self, filepath):
+		"""Content hash of a TML, only computed again if its mtime or size changed."""
+		stamp = _stamp(filepath)
+		with self._lock:
+			known = self._manifest["tmls"].get(_key(filepath))
+		if known and known[:2] == stamp:
+			return known[2]
+		sha = hashlib.sha1()
+		with open(filepath, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 20), b""):
+				sha.update(chunk)
+		digest = sha.hexdigest()
+		with self._lock:
+			self._manifest["tmls"][_key(filepath)] = stamp + [digest]
+		return digest
+
+	@staticmethod
+	def key(tml_hash, name):
+		return hashlib.sha1((tml_hash+"/"+name).encode("utf-8")).hexdigest()
+
+	def output_current(self, path, key):
+		"""True if path was written from key and has not been touched since."""
+		with self._lock:
+			known = self._manifest["outputs"].get(_key(path))
+		try:
+			current = known is not None and known[2] == key and known[:2] == _stamp(path)
+		except OSError:
+			current = False
+		if current:
+			self._touch(key)
+		return current
+
+	def record_output(self, path, key):
+		with self._lock:
+			self._manifest["outputs"][_key(path)] = _stamp(path) + [key]
+
+	def _touch(self, key):
+		with self._lock:
+			entry = self._manifest["entries"].get(key)
+			if entry:
+				entry[1] = time.time()
+
+	def get(self, key):
+		"""The (h, w, 4) RGBA pixels of key, or None."""
+		try:
+			with open(self._entry_path(key), "rb") as f:
+				data = f.read()
+			magic, width, height = _entry_header.unpack_from(data)
+			if magic != _ENTRY_MAGIC:
+				return None
+			rgba = np.frombuffer(zlib.decompress(data[_entry_header.size:]), dtype=np.uint8).reshape(height, width, 4)
+		except (OSError, ValueError, zlib.error):
+			return None
+		with self._lock:
+			self._manifest["entries"][key] = [len(data), time.time()]
+		return rgba
+
+	def put(self, key, rgba):
+		height, width = rgba.shape[:2]
+		data = _entry_header.pack(_ENTRY_MAGIC, width, height) + zlib.compress(np.ascontiguousarray(rgba).tobytes(), 1)
+		path = self._entry_path(key)
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+			with open(temp_path, "wb") as f:
+				f.write(data)
+			os.replace(temp_path, path)
+		except OSError:
+			return
+		with self._lock:
+			self._manifest["entries"][key] = [len(data), time.time()]
+
+	def count(self, hit):
+		with self._lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+	def report(self):
+		return "Texture cache: %d hits, %d misses" % (self.hits, self.misses)
+
+	def save(self):
+		"""Merge the manifest with the one on disk, which other processes may have changed, evict
+		the least recently used entries over the size limit and write it back."""
+		with self._lock:
+			disk = self._load()
+			manifest = self._manifest
+			for section in ("tmls", "outputs"):
+				for path, value in disk[section].items():
+					manifest[section].setdefault(path, value)
+			entries = manifest["entries"]
+			for key, value in disk["entries"].items():
+				if key not in entries or entries[key][1] < value[1]:
+					entries[key] = value
+			total = sum(size for size, last_use in entries.values())
+			for key in sorted(entries, key=lambda key: entries[key][1]):
+				if total <= self.max_bytes:
+					break
+				total -= entries.pop(key)[0]
+				try:
+					os.remove(self._entry_path(key))
+				except OSError:
+					pass
+			try:
+				os.makedirs(self.folder, exist_ok=True)
+				path = os.path.join(self.folder, MANIFEST)
+				temp_path = "%s.%d.tmp" % (path, os.getpid())
+				with open(temp_path, "w") as f:
+					json.dump(manifest, f)
+				os.replace(temp_path, path)
+			except OSError:
+				pass
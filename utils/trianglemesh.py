@@ -61,164 +61,228 @@
 ##~
 ##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# The original kept a Face object with three weak sets of adjacent faces
+# per triangle, and an Edge object per directed edge. Here the connectivity
+# lives in flat NumPy arrays: the face-vertex array, the faces across each
+# half-edge in compressed sparse row layout, and a bitmap of faces that are
+# still in the mesh. Face is a light view into these arrays, so code
+# written against the old objects keeps working.
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Imports
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-import operator # itemgetter
-
-from weakref import WeakSet
+import numpy as np
 
-class Edge:
-	"""A directed edge which keeps track of its faces."""
+def _normalize_faces(triangles):
+	"""Non-degenerate faces of an (n,3) array rotated so that their lowest vertex comes first,
+	without duplicates and sorted."""
+	tris = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+	tris = tris[(tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) & (tris[:, 2] != tris[:, 0])]
+	if not len(tris):
+		return np.zeros((0, 3), dtype=np.int64)
+	first = np.argmin(tris, axis=1)
+	tris = np.take_along_axis(tris, (first[:, None] + np.arange(3)) % 3, axis=1)
+	#sorting helps with ensuring that the strips in faces are close together
+	return np.unique(tris, axis=0)
 
-	def __init__(self, ev0, ev1):
-		"""Edge constructor."""
-		
-		if ev0 == ev1:
-			raise ValueError("Degenerate edge.")
+def _half_edge_adjacency(faces):
+	"""For every half-edge, ie. the edge opposite vertex i of face f at slot 3 * f + i, find the
+	faces that have the same edge in the opposite direction. Returns start, adjacent in CSR layout."""
+	num_slots = 3 * len(faces)
+	if not num_slots:
+		return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	stride = int(faces.max()) + 1
+	#the directed edge opposite vertex i runs from vertex i+1 to vertex i+2
+	tails = faces[:, (1, 2, 0)].ravel()
+	heads = faces[:, (2, 0, 1)].ravel()
+	keys = tails * stride + heads
+	order = np.argsort(keys, kind="stable")
+	sorted_keys = keys[order]
+	opposite = heads * stride + tails
+	lo = np.searchsorted(sorted_keys, opposite, side="left")
+	hi = np.searchsorted(sorted_keys, opposite, side="right")
+	counts = hi - lo
+	start = np.zeros(num_slots + 1, dtype=np.int64)
+	np.cumsum(counts, out=start[1:])
+	offsets = np.arange(start[-1]) - np.repeat(start[:-1], counts)
+	adjacent = order[np.repeat(lo, counts) + offsets] // 3
+	return start, adjacent
 
-		self.verts = (ev0, ev1)
-		"""Vertices of the edge."""
+class Face:
+	"""An oriented face which keeps track of its adjacent faces.
 
-		self.faces = WeakSet()
-		"""Weak set of faces that have this edge."""
+	Either a view of face index in a locked mesh, or a detached face
+	built from three vertices."""
 
-	def __repr__(self):
-		"""String representation."""
-		return "Edge(%s, %s)" % self.verts
-
-class Face:
-	"""An oriented face which keeps track its adjacent faces."""
+	__slots__ = ("mesh", "index", "_verts")
 
 	def __init__(self, v0, v1, v2):
-		"""Construct face from vertices."""
+		"""Construct detached face from vertices."""
 		if v0 == v1 or v1 == v2 or v2 == v0:
 			raise ValueError("Degenerate face.")
 		if v0 < v1 and v0 < v2:
-			self.verts = (v0, v1, v2)
-		if v1 < v0 and v1 < v2:
-			self.verts = (v1, v2, v0)
-		if v2 < v0 and v2 < v1:
-			self.verts = (v2, v0, v1)
+			self._verts = (v0, v1, v2)
+		elif v1 < v2:
+			self._verts = (v1, v2, v0)
+		else:
+			self._verts = (v2, v0, v1)
+		self.mesh = None
 		# no index yet
 		self.index = None
 
-		self.adjacent_faces = (WeakSet(), WeakSet(), WeakSet())
-		"""Weak sets of adjacent faces along edge opposite each vertex."""
+	@classmethod
+	def _view(cls, mesh, index):
+		face = cls.__new__(cls)
+		face.mesh = mesh
+		face.index = index
+		face._verts = None
+		return face
+
+	@property
+	def verts(self):
+		"""Vertices of the face, lowest first."""
+		if self._verts is not None:
+			return self._verts
+		verts = self.mesh._verts
+		i = 3 * self.index
+		return (verts[i], verts[i + 1], verts[i + 2])
 
 	def __repr__(self):
 		"""String representation."""
 		return "Face(%s, %s, %s)" % self.verts
 
+	def __eq__(self, other):
+		return isinstance(other, Face) and self.verts == other.verts and self.mesh is other.mesh
+
+	def __hash__(self):
+		return hash(self.verts)
+
 	def get_next_vertex(self, vi):
 		"""Get next vertex of face."""
-		return self.verts[(1, 2, 0)[self.verts.index(vi)]]
+		verts = self.verts
+		return verts[(1, 2, 0)[verts.index(vi)]]
 
 	def get_adjacent_faces(self, vi):
-		"""Get adjacent faces associated with the edge opposite a vertex."""
-		return self.adjacent_faces[self.verts.index(vi)]
+		"""Get the faces, which are still in the mesh, that are adjacent along the edge opposite a vertex."""
+		mesh = self.mesh
+		if mesh is None:
+			return ()
+		slot = 3 * self.index + self.verts.index(vi)
+		start = mesh._adjacency_start
+		adjacent = mesh._adjacency
+		alive = mesh._alive
+		return [Face._view(mesh, adjacent[i]) for i in range(start[slot], start[slot + 1]) if alive[adjacent[i]]]
+
+	@property
+	def adjacent_faces(self):
+		"""Adjacent faces along the edge opposite each vertex."""
+		return tuple(self.get_adjacent_faces(vi) for vi in self.verts)
+
+class _FaceList:
+	"""Sequence of the faces of a locked mesh, None for discarded faces."""
+
+	__slots__ = ("mesh",)
+
+	def __init__(self, mesh):
+		self.mesh = mesh
+
+	def __len__(self):
+		return self.mesh.num_faces
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("face index out of range")
+		if not self.mesh._alive[index]:
+			return None
+		return Face._view(self.mesh, index)
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
 
 class Mesh:
 	"""A mesh of interconnected faces."""
+
 	def __init__(self, faces=None, lock=True):
 		"""Initialize a mesh, and optionally assign its faces and lock.
 		"""
-		self._faces = {}
-		self._edges = {}
+		self._pending = []
+		#faces returned by add_face, resolved to the locked faces by lock
+		self._added = []
 		if faces is not None:
-			for v0, v1, v2 in faces:
-				self.add_face(v0, v1, v2)
+			self._pending.extend(tuple(face) for face in faces)
 			if lock:
 				self.lock()
 
 	def __repr__(self):
 		"""String representation."""
-		try:
-			self.faces
-		except AttributeError:
+		if self._pending is not None:
 			# unlocked
-			if not self._faces:
+			if not self._pending:
 				# special case
 				return "Mesh()"
 			return ("Mesh(faces=[%s], lock=False)"
-					% ', '.join(repr(faceverts)
-								for faceverts in sorted(self._faces)))
+					% ', '.join(repr(tuple(faceverts))
+								for faceverts in _normalize_faces(self._pending).tolist()))
 		else:
 			# locked
 			return ("Mesh(faces=[%s])"
 					% ', '.join(repr(face.verts)
-								for face in self.faces))
-
-	def _add_edge(self, face, pv0, pv1):
-		"""Create new edge for mesh for given face, or return existing
-		edge. Lists of faces of the new/existing edge is also updated,
-		as well as lists of adjacent faces. For internal use only,
-		called on each edge of the face in add_face.
-		"""
-		# create edge if not found
-		try:
-			edge = self._edges[(pv0, pv1)]
-		except KeyError:
-			# create edge
-			edge = Edge(pv0, pv1)
-			self._edges[(pv0, pv1)] = edge
-
-		# update edge's faces
-		edge.faces.add(face)
-
-		# find reverse edge in mesh
-		try:
-			otheredge = self._edges[(pv1, pv0)]
-		except KeyError:
-			pass
-		else:
-			# update adjacent faces
-			pv2 = face.get_next_vertex(pv1)
-			for otherface in otheredge.faces:
-				otherpv2 = otherface.get_next_vertex(pv0)
-				face.get_adjacent_faces(pv2).add(otherface)
-				otherface.get_adjacent_faces(otherpv2).add(face)
+								for face in self.faces if face is not None))
 
 	def add_face(self, v0, v1, v2):
-		"""Create new face for mesh, or return existing face. List of
-		adjacent faces is also updated.
+		"""Add a face to an unlocked mesh. Duplicates are merged when the mesh is locked.
+		Returns the face, which becomes the face of the locked mesh once it is locked.
 		"""
+		# raises ValueError for degenerate faces
 		face = Face(v0, v1, v2)
-		try:
-			face = self._faces[face.verts]
-		except KeyError:
-			# create edges and update links between faces
-			self._add_edge(face, v0, v1)
-			self._add_edge(face, v1, v2)
-			self._add_edge(face, v2, v0)
-			# register face in mesh
-			self._faces[face.verts] = face
-
+		self._pending.append((v0, v1, v2))
+		self._added.append(face)
 		return face
 
 	def lock(self):
-		"""Lock the mesh. Frees memory by clearing the structures
-		which are only used to update the face adjacency lists. Sets
-		the faces attribute to the sorted list of all faces (sorting helps
-		with ensuring that the strips in faces are close together).
+		"""Lock the mesh. Builds the connectivity arrays from all added faces,
+		and sets the faces attribute to the sorted sequence of all faces
+		(sorting helps with ensuring that the strips in faces are close together).
 		"""
-		# store faces and set their index
-		self.faces = []
-		for i, (verts, face) in enumerate(sorted(iter(self._faces.items()),
-										  key=operator.itemgetter(0))):
-			face.index = i
-			self.faces.append(face)
-		# remove helper structures
-		del self._faces
-		del self._edges
+		faces = _normalize_faces(self._pending)
+		self.set_face_array(faces)
+		if self._added:
+			index_of = {verts: i for i, verts in enumerate(map(tuple, faces.tolist()))}
+			for face in self._added:
+				face.mesh = self
+				face.index = index_of[face.verts]
+		self._added = None
+
+	def set_face_array(self, faces):
+		"""Lock the mesh with the connectivity of an (n,3) array of normalized, unique faces."""
+		self._pending = None
+		self.face_array = faces
+		self.num_faces = len(faces)
+		start, adjacent = _half_edge_adjacency(faces)
+		self.adjacency_start = start
+		self.adjacency = adjacent
+		self.alive = np.ones(self.num_faces, dtype=np.bool_)
+		#memoryviews index faster than arrays from python code
+		self._verts = memoryview(faces.reshape(-1))
+		self._adjacency_start = memoryview(start)
+		self._adjacency = memoryview(adjacent)
+		self._alive = memoryview(self.alive)
+		self.faces = _FaceList(self)
+
+	def adjacent_face_indices(self, index, slot):
+		"""Indices of the faces which are still in the mesh, adjacent to face index along the edge opposite its vertex slot."""
+		i = 3 * index + slot
+		adjacent = self.adjacency[self.adjacency_start[i]:self.adjacency_start[i + 1]]
+		return adjacent[self.alive[adjacent]]
 
 	def discard_face(self, face):
 		"""Remove the face from the mesh."""
-		# note: don't delete, but set to None, to ensure that other
+		# note: don't delete, but flag it, to ensure that other
 		# face indices remain valid
-		self.faces[face.index] = None
-		for adj_faces in face.adjacent_faces:
-			for adj_face in adj_faces:
-				for adj_adj_faces in adj_face.adjacent_faces:
-					adj_adj_faces.discard(face)
\ No newline at end of file
+		self.alive[face.index] = False
@@ -40,27 +40,43 @@ and triangulation of strips."""
 # ***** END LICENSE BLOCK *****
 
 
+from collections import deque
+
+import numpy as np
+
 from .trianglestripifier import TriangleStripifier
 from .trianglemesh import Mesh
+from .greedystrip import GreedyStripifier
+
+#available stripifier backends; nvtristrip samples many strips per step and gives slightly shorter strips, greedy is much faster
+ENGINES = ("nvtristrip", "greedy")
+
+def triangulate_array(strips):
+	"""Faces of a set of strips as (n,3) int32 array, all strips at once.
+	Degenerate triangles in strips are discarded."""
+
+	strips = [np.asarray(strip, dtype=np.int32) for strip in strips if len(strip) >= 3]
+	if not strips:
+		return np.zeros((0, 3), dtype=np.int32)
+	lengths = np.array([len(strip) for strip in strips])
+	verts = np.concatenate(strips)
+	# position of each vertex in its strip, and how many vertices follow it there
+	offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+	local = np.arange(len(verts)) - offsets
+	first = np.nonzero(np.repeat(lengths, lengths) - local >= 3)[0]
+	t0 = verts[first]
+	t1 = verts[first + 1]
+	t2 = verts[first + 2]
+	# every other triangle has flipped winding
+	odd = (local[first] & 1).astype(bool)
+	triangles = np.stack((t0, np.where(odd, t2, t1), np.where(odd, t1, t2)), axis=1)
+	return triangles[(t0 != t1) & (t1 != t2) & (t2 != t0)]
 
 def triangulate(strips):
-	"""A generator for iterating over the faces in a set of
-	strips. Degenerate triangles in strips are discarded."""
-
-	triangles = []
+	"""The faces in a set of strips as a list of tuples.
+	Degenerate triangles in strips are discarded."""
 
-	for strip in strips:
-		if len(strip) < 3: continue # skip empty strips
-		i = strip.__iter__()
-		j = False
-		t1, t2 = next(i), next(i)
-		for k in range(2, len(strip)):
-			j = not j
-			t0, t1, t2 = t1, t2, next(i)
-			if t0 == t1 or t1 == t2 or t2 == t0: continue
-			triangles.append((t0, t1, t2) if j else (t0, t2, t1))
-
-	return triangles
+	return [tuple(triangle) for triangle in triangulate_array(strips).tolist()]
 
 def _generate_faces_from_triangles(triangles):
 	i = triangles.__iter__()
@@ -104,23 +120,27 @@ def _check_strips(triangles, strips):
 			   triangles - strips_triangles,
 			   strips_triangles - triangles))
 
-def stripify(triangles, stitchstrips = False):
-	"""Converts triangles into a list of strips."""
-
-	strips = []
-	# build a mesh from triangles
-	mesh = Mesh()
-	for face in triangles:
-		try:
-			mesh.add_face(*face)
-		except ValueError:
-			# degenerate face
-			pass
-	mesh.lock()
-
-	# calculate the strip
-	stripifier = TriangleStripifier(mesh)
-	strips = stripifier.find_all_strips()
+def stripify(triangles, stitchstrips = False, engine = "nvtristrip"):
+	"""Converts triangles into a list of strips, using one of ENGINES."""
+
+	if engine == "greedy":
+		strips = GreedyStripifier(triangles).find_all_strips()
+	elif engine == "nvtristrip":
+		# build a mesh from triangles
+		mesh = Mesh()
+		for face in triangles:
+			try:
+				mesh.add_face(*face)
+			except ValueError:
+				# degenerate face
+				pass
+		mesh.lock()
+
+		# calculate the strip
+		stripifier = TriangleStripifier(mesh)
+		strips = stripifier.find_all_strips()
+	else:
+		raise ValueError("Unknown stripifier engine %s" % engine)
 
 	# stitch the strips if needed
 	if stitchstrips:
@@ -242,54 +262,102 @@ class OrientedStrip:
 		return result
 
 def stitch_strips(strips):
-	"""Stitch strips keeping stitch size minimal."""
-
-	class ExperimentSelector:
-		"""Helper class to select best experiment."""
-		def __init__(self):
-			self.best_ostrip1 = None
-			self.best_ostrip2 = None
-			self.best_num_stitches = None
-			self.best_ostrip_index = None
-
-		def update(self, ostrip_index, ostrip1, ostrip2):
-			num_stitches = ostrip1.get_num_stitches(ostrip2)
-			if ((self.best_num_stitches is None)
-				or (num_stitches < self.best_num_stitches)):
-				self.best_ostrip1 = ostrip1
-				self.best_ostrip2 = ostrip2
-				self.best_ostrip_index = ostrip_index
-				self.best_num_stitches = num_stitches
+	"""Stitch strips keeping stitch size minimal.
+
+	The strips are indexed by their end vertices and winding, so the
+	cheapest strip to glue to either end of the result is found without
+	scanning all remaining strips, and the result is built by appending
+	to buffers instead of copying it for every strip."""
 
 	# get all strips and their orientation, and their reverse
-	ostrips = [(OrientedStrip(strip), OrientedStrip(strip))
-			   for strip in strips if len(strip) >= 3]
-	for ostrip, reversed_ostrip in ostrips:
-		reversed_ostrip.reverse()
-	# start with one of the strips
+	ostrips = []
+	for strip in strips:
+		if len(strip) >= 3:
+			ostrip = OrientedStrip(strip)
+			reversed_ostrip = OrientedStrip(ostrip)
+			reversed_ostrip.reverse()
+			ostrips.append((ostrip, reversed_ostrip))
 	if not ostrips:
 		# no strips!
 		return []
-	result = ostrips.pop()[0]
-	# go on as long as there are strips left to process
-	while ostrips:
-		selector = ExperimentSelector()
-
-		for ostrip_index, (ostrip, reversed_ostrip) in enumerate(ostrips):
-			# try various ways of stitching strips
-			selector.update(ostrip_index, result, ostrip)
-			selector.update(ostrip_index, ostrip, result)
-			selector.update(ostrip_index, result, reversed_ostrip)
-			selector.update(ostrip_index, reversed_ostrip, result)
-			# break early if global optimum is already reached
-			if selector.best_num_stitches == 0:
+	# start with one of the strips
+	start = ostrips.pop()[0]
+
+	# candidates to append by (first vertex, reversed) and by reversed,
+	# candidates to prepend by (last vertex, winding of their end) and by winding;
+	# all in order of strip index, used strips are skipped lazily
+	append_by_vertex = {}
+	append_by_winding = (deque(), deque())
+	prepend_by_vertex = {}
+	prepend_by_winding = (deque(), deque())
+	for index, orientations in enumerate(ostrips):
+		for ostrip in orientations:
+			candidate = (index, ostrip)
+			append_by_vertex.setdefault((ostrip.vertices[0], ostrip.reversed), deque()).append(candidate)
+			append_by_winding[ostrip.reversed].append(candidate)
+			# prepending gives a winding match if this equals the reversed flag of the result
+			end_winding = ostrip.reversed != bool(len(ostrip.vertices) & 1)
+			prepend_by_vertex.setdefault((ostrip.vertices[-1], end_winding), deque()).append(candidate)
+			prepend_by_winding[end_winding].append(candidate)
+	used = [False] * len(ostrips)
+
+	def first_unused(candidates):
+		while candidates and used[candidates[0][0]]:
+			candidates.popleft()
+		return candidates[0] if candidates else None
+
+	head_chunks = []
+	tail = list(start.vertices)
+	first = tail[0]
+	last = tail[-1]
+	is_reversed = start.reversed
+	length = len(tail)
+	for _ in range(len(ostrips)):
+		# windings match when appending a strip with this reversed flag
+		append_winding = is_reversed if length & 1 == 0 else not is_reversed
+		options = (
+			(append_by_vertex.get((last, append_winding)), prepend_by_vertex.get((first, is_reversed))),
+			(append_by_vertex.get((last, not append_winding)), prepend_by_vertex.get((first, not is_reversed))),
+			(append_by_winding[append_winding], prepend_by_winding[is_reversed]),
+			(append_by_winding[not append_winding], prepend_by_winding[not is_reversed]),
+			)
+		for num_stitches, (append_candidates, prepend_candidates) in enumerate(options):
+			append = first_unused(append_candidates) if append_candidates else None
+			prepend = first_unused(prepend_candidates) if prepend_candidates else None
+			if append or prepend:
 				break
-		# get best result, perform the actual stitching, and remove
-		# strip from ostrips
-		result = selector.best_ostrip1 + selector.best_ostrip2
-		ostrips.pop(selector.best_ostrip_index)
+		if append and (not prepend or append[0] <= prepend[0]):
+			index, ostrip = append
+			vertices = ostrip.vertices
+			# append stitches
+			if num_stitches >= 1:
+				tail.append(last)
+			if num_stitches >= 2:
+				tail.append(vertices[0])
+			if num_stitches >= 3:
+				tail.append(vertices[0])
+			tail.extend(vertices)
+			last = vertices[-1]
+		else:
+			index, ostrip = prepend
+			vertices = ostrip.vertices
+			chunk = list(vertices)
+			if num_stitches >= 1:
+				chunk.append(vertices[-1])
+			if num_stitches >= 2:
+				chunk.append(first)
+			if num_stitches >= 3:
+				chunk.append(first)
+			head_chunks.append(chunk)
+			first = vertices[0]
+			is_reversed = ostrip.reversed
+		used[index] = True
+		length += num_stitches + len(vertices)
 	# get strip
-	strip = list(result)
+	strip = [first] if is_reversed else []
+	for chunk in reversed(head_chunks):
+		strip.extend(chunk)
+	strip.extend(tail)
 	# check if we can remove first vertex by reversing strip
 	if strip[0] == strip[1] and (len(strip) & 1 == 0):
 		strip = strip[1:]
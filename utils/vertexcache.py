@@ -0,0 +1,140 @@
+"""Post-transform vertex cache optimization of triangle strips.
+
+The GPU keeps the last few transformed vertices in a FIFO cache, so a
+vertex that is used again shortly after does not have to be transformed
+again. The cache use of a strip is measured by its ACMR, the average
+number of cache misses per triangle, and its ATVR, the average number
+of times each vertex is transformed (1 is ideal). Strips are reordered
+for the cache with vertex scores as in Forsyth's linear-speed vertex
+cache optimisation, and vertices are renumbered in the order they are
+first used."""
+
+from collections import deque
+
+import numpy as np
+
+from .tristrip import OrientedStrip, triangulate_array
+
+#the cache size NvTriStrip assumes for GeForce 1 and 2 class cards, the smallest of JPOG's era
+CACHE_SIZE = 16
+
+#vertex score parameters from Forsyth's paper
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+def cache_misses(indices, cache_size = CACHE_SIZE):
+	"""Number of vertices that are transformed when drawing indices through a FIFO cache."""
+	cache = deque()
+	cached = set()
+	misses = 0
+	for v in indices:
+		if v not in cached:
+			misses += 1
+			cache.append(v)
+			cached.add(v)
+			if len(cache) > cache_size:
+				cached.discard(cache.popleft())
+	return misses
+
+def cache_stats(strip, cache_size = CACHE_SIZE):
+	"""Cache misses, triangles and unique vertices of a strip."""
+	return cache_misses(strip, cache_size), len(triangulate_array([strip])), len(set(strip))
+
+def format_stats(misses, tris, verts):
+	return "ACMR %.3f ATVR %.3f" % (misses / max(tris, 1), misses / max(verts, 1))
+
+def _vertex_score(position, remaining, cache_size):
+	"""Score of a cached vertex at position (0 = newest) that is used by remaining strips."""
+	if position < 3:
+		score = LAST_TRI_SCORE
+	else:
+		score = (1.0 - (position - 3) / (cache_size - 3)) ** CACHE_DECAY_POWER
+	return score + VALENCE_BOOST_SCALE * remaining ** -VALENCE_BOOST_POWER
+
+def optimize_strips(strips, cache_size = CACHE_SIZE):
+	"""Stitch strips into one strip, in the order that makes the most use of the vertex cache.
+
+	After every strip, the next one is the one whose vertices score best
+	in the simulated cache, and it is oriented for the fewest stitches."""
+
+	ostrips = [OrientedStrip(strip) for strip in strips if len(strip) >= 3]
+	if not ostrips:
+		return []
+	verts_of = [set(ostrip.vertices) for ostrip in ostrips]
+	strips_of = {}
+	for i, verts in enumerate(verts_of):
+		for v in verts:
+			strips_of.setdefault(v, []).append(i)
+	remaining = {v: len(indices) for v, indices in strips_of.items()}
+	used = [False] * len(ostrips)
+	next_unused = 0
+	#newest vertex last
+	cache = deque(maxlen = cache_size)
+
+	strip = []
+	first = last = None
+	is_reversed = False
+	for _ in range(len(ostrips)):
+		#only strips that share a vertex with the cache can score
+		scores = {}
+		for position, v in enumerate(reversed(cache)):
+			if remaining[v]:
+				score = _vertex_score(position, remaining[v], cache_size)
+				for i in strips_of[v]:
+					if not used[i]:
+						scores[i] = scores.get(i, 0.0) + score
+		if scores:
+			best = max(scores, key = lambda i: scores[i] / len(verts_of[i]))
+		else:
+			while used[next_unused]:
+				next_unused += 1
+			best = next_unused
+		used[best] = True
+		for v in verts_of[best]:
+			remaining[v] -= 1
+
+		ostrip = ostrips[best]
+		if not strip:
+			strip = list(ostrip.vertices)
+			first, last = strip[0], strip[-1]
+			is_reversed = ostrip.reversed
+		else:
+			#windings match when appending a strip with this reversed flag
+			append_winding = is_reversed if len(strip) & 1 == 0 else not is_reversed
+			reversed_ostrip = OrientedStrip(ostrip)
+			reversed_ostrip.reverse()
+			def stitches(candidate):
+				return (0 if candidate.vertices[0] == last else 2) + (0 if candidate.reversed == append_winding else 1)
+			ostrip = min((ostrip, reversed_ostrip), key = stitches)
+			num_stitches = stitches(ostrip)
+			vertices = ostrip.vertices
+			if num_stitches >= 1:
+				strip.append(last)
+			if num_stitches >= 2:
+				strip.append(vertices[0])
+			if num_stitches >= 3:
+				strip.append(vertices[0])
+			strip.extend(vertices)
+			last = vertices[-1]
+		for v in ostrip.vertices:
+			if v not in cache:
+				cache.append(v)
+	if is_reversed:
+		strip.insert(0, first)
+	# check if we can remove first vertex by reversing strip
+	if strip[0] == strip[1] and (len(strip) & 1 == 0):
+		strip = strip[1:]
+		strip.reverse()
+	return strip
+
+def first_use_order(strips, num_verts):
+	"""Old vertex indices in the order they are first used by strips, followed by the unused ones,
+	and the new index of every old index."""
+	indices = np.concatenate([np.asarray(strip, dtype = np.int64) for strip in strips] + [np.arange(num_verts)])
+	unique, first = np.unique(indices, return_index = True)
+	order = unique[np.argsort(first, kind = "stable")]
+	remap = np.empty(num_verts, dtype = np.int64)
+	remap[order] = np.arange(num_verts)
+	return order, remap
@@ -0,0 +1,29 @@
+"""Per vertex skin weights, in the layout of TMD vertices."""
+
+import numpy as np
+
+#a TMD vertex has 4 bone slots
+MAX_INFLUENCES = 4
+
+def weight_table(vertex_indices, bones, weights, num_verts, max_influences = MAX_INFLUENCES):
+	"""The strongest max_influences bones of each vertex and their weights as bytes.
+	vertex_indices, bones and weights list all weights of all vertices, weights <= 0 are ignored.
+	Returns (num_verts, max_influences) arrays of bone indices padded with -1, and of uint8 weights
+	normalized to sum up to at most 255, like the game's own models."""
+	vertex_indices = np.asarray(vertex_indices, dtype = np.int64)
+	bones = np.asarray(bones, dtype = np.int32)
+	weights = np.asarray(weights, dtype = np.float64)
+	used = weights > 0
+	vertex_indices, bones, weights = vertex_indices[used], bones[used], weights[used]
+	#by vertex, then by descending weight; stable, so equal weights keep their order
+	order = np.lexsort((-weights, vertex_indices))
+	vertex_indices, bones, weights = vertex_indices[order], bones[order], weights[order]
+	rank = np.arange(len(vertex_indices)) - np.searchsorted(vertex_indices, vertex_indices)
+	top = rank < max_influences
+	table_bones = np.full((num_verts, max_influences), -1, dtype = np.int32)
+	table_bones[vertex_indices[top], rank[top]] = bones[top]
+	table_weights = np.zeros((num_verts, max_influences))
+	table_weights[vertex_indices[top], rank[top]] = weights[top]
+	sums = table_weights.sum(axis = 1, keepdims = True)
+	byte_weights = (table_weights / np.where(sums > 0, sums, 1.0) * 255).astype(np.uint8)
+	return table_bones, byte_weights
@@ -0,0 +1,39 @@
+"""Vertex welding for export: merges loops that produce identical vertex
+records and hands out stable indices in order of first appearance."""
+
+import numpy as np
+
+class VertexWelder:
+	"""Hash based welder for hashable vertex keys (eg. packed bytes)."""
+
+	def __init__(self):
+		self.indices = {}
+
+	def __len__(self):
+		return len(self.indices)
+
+	def add(self, key):
+		"""Get the index for key, and whether it was newly added."""
+		index = self.indices.get(key)
+		if index is None:
+			index = len(self.indices)
+			self.indices[key] = index
+			return index, True
+		return index, False
+
+def weld_array(keys):
+	"""Weld all rows of an array at once, comparing their raw bytes.
+
+	Returns first, inverse: first holds the row index of the first
+	occurrence of each unique key, in order of appearance, and inverse
+	holds the welded index of every input row."""
+	keys = np.ascontiguousarray(keys)
+	if not len(keys):
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	rows = keys.reshape(len(keys), -1).view(np.dtype((np.void, keys.itemsize * (keys.size // len(keys))))).ravel()
+	_, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+	#np.unique sorts the keys, so restore the order of appearance
+	order = np.argsort(first, kind="stable")
+	rank = np.empty_like(order)
+	rank[order] = np.arange(len(order))
+	return first[order], rank[inverse.ravel()]